@@ -0,0 +1,139 @@
+"""プレイヤー統計の集計CLI
+
+users / game_states のJSONから作った生成列（storage.USER_COLUMNS など）と
+そのインデックスを使うので、JSONを読み込まずに集計できる。
+
+使い方:
+    python analytics.py classes                          クラス別の人数・平均レベル・平均ゴールド
+    python analytics.py count [条件...]                   条件に合うプレイヤー数（例: level>=10 player_class=hero）
+    python analytics.py aggregate <列> [--by <列>] [条件...]  列の合計・平均・最小・最大
+    python analytics.py dungeons                         ダンジョンごとのプレイ中のセッション数
+    python analytics.py bench [users]                    生成列とJSON全件走査の速度比較
+"""
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Any, List, Tuple
+
+import database
+from storage import USER_COLUMNS, SQLiteBackend
+
+CONDITION_PATTERN = re.compile(r"^(\w+)(>=|<=|!=|=|<|>)(.+)$")
+
+
+def parse_condition(text: str) -> Tuple[str, str, Any]:
+    """"level>=10" のような条件を (列, 演算子, 値) にする"""
+    match = CONDITION_PATTERN.match(text)
+    if not match or match.group(1) not in USER_COLUMNS:
+        raise ValueError(f"Invalid condition: {text} (columns: {', '.join(USER_COLUMNS)})")
+    column, op, value = match.groups()
+    if USER_COLUMNS[column] == "INTEGER":
+        return column, op, int(value)
+    if USER_COLUMNS[column] == "REAL":
+        return column, op, float(value)
+    return column, op, value
+
+
+def print_aggregates(results, field: str = None):
+    for key in sorted(results, key=lambda k: (k is None, k)):
+        entry = results[key]
+        line = f"{'(all)' if key is None else key:>12}  count={entry['count']:,}"
+        if field:
+            line += f"  sum={entry['sum']:,.0f}  avg={entry['avg']:,.2f}  min={entry['min']}  max={entry['max']}"
+        print(line)
+
+
+def timed(fn, *args) -> Tuple[Any, float]:
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+
+def bench(n_users: int):
+    """旧スキーマのDBを作り、マイグレーション時間と集計クエリの速度を比べる"""
+    from models import INITIAL_INDICATORS, UserProfile
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    conn = sqlite3.connect(path)
+    # 生成列がない以前のスキーマ
+    conn.execute("""
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT UNIQUE NOT NULL,
+            data TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    classes = ["hero", "rogue", "sage"]
+    rows = []
+    for i in range(n_users):
+        profile = UserProfile(player_class=classes[i % 3], level=1 + (i * 7919) % 30,
+                              xp=(i * 31) % 1000, gold=(i * 104729) % 50000,
+                              total_profit=((i * 613) % 20001) - 10000.0,
+                              indicators=INITIAL_INDICATORS)
+        rows.append((f"user-{i}", profile.model_dump_json()))
+    with conn:
+        conn.executemany("INSERT INTO users (session_id, data) VALUES (?, ?)", rows)
+    conn.close()
+    print(f"users: {n_users:,}, file: {os.path.getsize(path) / 1e6:.1f} MB")
+
+    # JSONをそのまま読む場合（以前の方法）
+    conn = sqlite3.connect(path)
+    _, json_count_ms = timed(lambda: conn.execute(
+        "SELECT COUNT(*) FROM users WHERE json_extract(data, '$.level') >= 10").fetchone())
+    _, json_group_ms = timed(lambda: conn.execute(
+        "SELECT json_extract(data, '$.player_class'), AVG(json_extract(data, '$.gold')) "
+        "FROM users GROUP BY 1").fetchall())
+    conn.close()
+
+    backend = SQLiteBackend(path)
+    _, migrate_ms = timed(backend.init)
+    print(f"online migration (add columns + build indexes): {migrate_ms:,.0f} ms")
+
+    results, count_ms = timed(backend.aggregate_users, None, None, [("level", ">=", 10)])
+    _, group_ms = timed(backend.aggregate_users, "gold", "player_class", [])
+    _, top_ms = timed(backend.aggregate_users, "total_profit", None, [("total_profit", ">=", 9990.0)])
+    print(f"Lv.10+ players ({results[None]['count']:,}): json_extract {json_count_ms:,.1f} ms "
+          f"-> generated column {count_ms:,.1f} ms")
+    print(f"avg gold by class: json_extract {json_group_ms:,.1f} ms -> generated column {group_ms:,.1f} ms")
+    print(f"total_profit range query: {top_ms:,.1f} ms")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("classes", "count", "aggregate", "dungeons", "bench"):
+        print(__doc__)
+        sys.exit(1)
+
+    command, args = sys.argv[1], sys.argv[2:]
+    if command == "bench":
+        bench(int(args[0]) if args else 200000)
+        sys.exit(0)
+
+    database.init_db()
+    if command == "classes":
+        levels = database.aggregate_users("level", "player_class")
+        golds = database.aggregate_users("gold", "player_class")
+        for player_class, entry in sorted(levels.items(), key=lambda item: str(item[0])):
+            print(f"{player_class:>8}  players={entry['count']:,}  avg level={entry['avg']:.1f}  "
+                  f"avg gold={golds[player_class]['avg']:,.0f}")
+    elif command == "count":
+        results = database.aggregate_users(filters=[parse_condition(arg) for arg in args])
+        print(sum(entry["count"] for entry in results.values()))
+    elif command == "aggregate":
+        if not args:
+            print("usage: python analytics.py aggregate <column> [--by <column>] [conditions...]")
+            sys.exit(1)
+        field, rest = args[0], args[1:]
+        group_by = None
+        if len(rest) >= 2 and rest[0] == "--by":
+            group_by, rest = rest[1], rest[2:]
+        filters: List = [parse_condition(arg) for arg in rest]
+        print_aggregates(database.aggregate_users(field, group_by, filters), field)
+    elif command == "dungeons":
+        counts = database.count_sessions_by_dungeon()
+        for dungeon_id, count in sorted(counts.items(), key=lambda item: -item[1]):
+            print(f"{dungeon_id:>16}  {count:,}")
@@ -0,0 +1,318 @@
+"""テンプレートと静的ファイルの配信（本番向け）
+
+- テンプレート: Jinjaのバイトコードキャッシュを TEMPLATE_CACHE_DIR に保存し、プロセス起動後の初回描画でコンパイルしない
+- 動的なレスポンス: Accept-Encoding に応じて brotli か gzip で圧縮する（brotliパッケージが入っていなければ gzip のみ）
+  （COMPRESS_MIN_SIZE バイト未満と、圧縮しても縮まない種類は圧縮しない）
+- 静的ファイル: 内容のハッシュを含むURL（/static/css/style.<hash>.css）を static_url() で作り、
+  そのURLは内容が変わらないので1年間の immutable キャッシュにする。ハッシュなしのURLは毎回再検証させる
+- ビルド時に静的ファイルの .gz / .br を作っておくと、配信時に圧縮せずにそのまま返す
+  （元のファイルより古い圧縮済みファイルは使わない）
+
+使い方:
+    python assets.py build              静的ファイルの .gz / .br を作る（デプロイ時に実行）
+    python assets.py bench [dungeon_id] ダンジョン画面の転送量と応答時間を圧縮・キャッシュの有無で比較
+"""
+import gzip
+import hashlib
+import os
+import sys
+import time
+import zlib
+from typing import Dict, List, Optional, Set
+
+from jinja2 import FileSystemBytecodeCache
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:  # brotliがなければgzipのみ
+    brotli = None
+
+STATIC_DIR = "static"
+TEMPLATE_CACHE_DIR = "template_cache"
+
+# これより小さいレスポンスは圧縮しない（ヘッダーと圧縮の手間の方が大きい）
+COMPRESS_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# ビルド時の圧縮は時間をかけて最大にする
+BUILD_GZIP_LEVEL = 9
+BUILD_BROTLI_QUALITY = 11
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "image/svg+xml")
+COMPRESSIBLE_SUFFIXES = (".css", ".js", ".svg", ".html", ".json", ".txt")
+# 静的ファイルの圧縮済みファイル（優先する順）
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+def bytecode_cache() -> FileSystemBytecodeCache:
+    """テンプレートのバイトコードキャッシュ（テンプレートが変われば自動で作り直される）"""
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    return FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+
+
+def _accepted(accept_encoding: str) -> Set[str]:
+    """Accept-Encoding で受け入れられる方式（q=0 のものは除く）"""
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = params.strip().replace(" ", "")
+        if quality.startswith("q=") and quality[2:].strip("0.") == "":
+            continue
+        accepted.add(name.strip())
+    return accepted
+
+
+def accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """Accept-Encoding から動的に圧縮する方式を選ぶ（brotliが使えればbrを優先、どちらも不可ならNone）"""
+    accepted = _accepted(accept_encoding)
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def _compressible(headers: Headers) -> bool:
+    return headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES) and "content-encoding" not in headers
+
+
+class _Compressor:
+    """ストリーミング圧縮（gzip / br）"""
+
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=brotli_quality)
+            self.compress, self._finish = self._compressor.process, self._compressor.finish
+        else:
+            # wbits=31 で gzip ヘッダーつき
+            self._compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+            self.compress, self._finish = self._compressor.compress, self._compressor.flush
+
+    def finish(self) -> bytes:
+        return self._finish()
+
+
+class CompressionMiddleware:
+    """レスポンスをAccept-Encodingに応じて圧縮するASGIミドルウェア
+
+    本文が1回で送られるレスポンス（テンプレートなど）は大きさを見てから圧縮し、
+    分けて送られるレスポンス（ファイルなど）はContent-Lengthが閾値以上なら逐次圧縮する。
+    すでにContent-Encodingがあるもの（圧縮済みの静的ファイル）はそのまま通す。
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_SIZE, gzip_level: int = GZIP_LEVEL,
+                 brotli_quality: int = BROTLI_QUALITY):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = accepted_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor: Optional[_Compressor] = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                # 本文の最初の部分を見るまでヘッダーを送らない
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+            if compressor is None:
+                headers = MutableHeaders(raw=start_message["headers"])
+                declared = int(headers.get("content-length", len(body)) or 0)
+                if (start_message["status"] != 200 or not _compressible(headers)
+                        or (declared if more_body else len(body)) < self.minimum_size):
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                compressor = _Compressor(encoding, self.gzip_level, self.brotli_quality)
+                headers["content-encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    del headers["content-length"]
+                else:
+                    body = compressor.compress(body) + compressor.finish()
+                    headers["content-length"] = str(len(body))
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                await send(start_message)
+
+            chunk = compressor.compress(body)
+            if not more_body:
+                chunk += compressor.finish()
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+def _fingerprint(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+
+def _hashed_name(name: str, digest: str) -> str:
+    root, ext = os.path.splitext(name)
+    return f"{root}.{digest}{ext}"
+
+
+def _static_files(directory: str) -> List[str]:
+    """静的ファイルの相対パス（圧縮済みファイルは除く）"""
+    names = []
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            if not file_name.endswith((".gz", ".br")):
+                names.append(os.path.relpath(os.path.join(root, file_name), directory).replace(os.sep, "/"))
+    return sorted(names)
+
+
+class FingerprintedStaticFiles(StaticFiles):
+    """内容のハッシュつきURLと圧縮済みファイルに対応した静的ファイル配信"""
+
+    def __init__(self, directory: str = STATIC_DIR, prefix: str = "/static", **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        self.prefix = prefix
+        # 元のパス -> ハッシュつきのパス、とその逆
+        self.manifest: Dict[str, str] = {}
+        self._originals: Dict[str, str] = {}
+        self.refresh()
+
+    def refresh(self):
+        """ファイルのハッシュを計算し直す（起動時。ファイルを差し替えたら呼ぶ）"""
+        self.manifest = {name: _hashed_name(name, _fingerprint(os.path.join(self.directory, name)))
+                         for name in _static_files(self.directory)}
+        self._originals = {hashed: name for name, hashed in self.manifest.items()}
+
+    def url(self, name: str) -> str:
+        """テンプレート用: ハッシュつきのURL（知らないファイルはそのままのURL）"""
+        return f"{self.prefix}/{self.manifest.get(name, name)}"
+
+    def _fresh_variant(self, name: str, suffix: str) -> bool:
+        source = os.path.join(self.directory, name)
+        variant = source + suffix
+        return os.path.exists(variant) and os.path.getmtime(variant) >= os.path.getmtime(source)
+
+    async def get_response(self, path: str, scope):
+        name = path.replace(os.sep, "/")
+        immutable = name in self._originals
+        if immutable:
+            name = self._originals[name]
+
+        # 圧縮済みファイルはそのまま返すだけなので、brotliパッケージがなくても .br を返せる
+        response = None
+        accepted = _accepted(Headers(scope=scope).get("accept-encoding", ""))
+        for variant_encoding, suffix in PRECOMPRESSED:
+            if variant_encoding in accepted and self._fresh_variant(name, suffix):
+                response = await super().get_response(name + suffix, scope)
+                if response.status_code in (200, 304):
+                    response.headers["content-encoding"] = variant_encoding
+                break
+        if response is None:
+            response = await super().get_response(name, scope)
+
+        response.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+        response.headers.add_vary_header("Accept-Encoding")
+        return response
+
+
+def build_precompressed(directory: str = STATIC_DIR) -> List[str]:
+    """静的ファイルの .gz（と brotli があれば .br）を作り、作ったファイルを返す"""
+    written = []
+    for name in _static_files(directory):
+        if not name.endswith(COMPRESSIBLE_SUFFIXES):
+            continue
+        path = os.path.join(directory, name)
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < COMPRESS_MIN_SIZE:
+            continue
+        variants = {".gz": gzip.compress(data, BUILD_GZIP_LEVEL, mtime=0)}
+        if brotli is not None:
+            variants[".br"] = brotli.compress(data, quality=BUILD_BROTLI_QUALITY)
+        for suffix, compressed in variants.items():
+            with open(path + suffix, "wb") as f:
+                f.write(compressed)
+            written.append(f"{name}{suffix} ({len(data):,} -> {len(compressed):,} bytes)")
+    return written
+
+
+def bench(dungeon_id: str = "tutorial-1", requests: int = 50):
+    """ダンジョン画面とスタイルシートの転送量・応答時間を、以前の配信（圧縮なし・キャッシュなし）と比べる"""
+    from fastapi.testclient import TestClient
+    import main
+
+    client = TestClient(main.app)
+    # クラスを決めてダンジョンに入れるセッションを作る
+    for question_id in range(len(main.DIAGNOSTIC_QUESTIONS)):
+        client.post("/onboarding/answer", data={"question_id": question_id, "option_index": 0})
+    client.get("/onboarding/result")
+
+    def measure(path: str, accept_encoding: str, cold: bool = False):
+        timings, wire = [], 0
+        for _ in range(1 if cold else requests):
+            if cold:
+                # プロセス起動直後と同じく、コンパイル済みテンプレートがない状態にする
+                main.templates.env.cache.clear()
+            started = time.perf_counter()
+            response = client.get(path, headers={"Accept-Encoding": accept_encoding})
+            timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise SystemExit(f"{path}: HTTP {response.status_code}")
+            wire = response.num_bytes_downloaded
+        timings.sort()
+        return wire, timings[len(timings) // 2], response
+
+    page = f"/dungeon/{dungeon_id}"
+    encodings = ["gzip"] + (["br"] if brotli else [])
+    print(f"{page} ({requests} requests each, TTFB = in-process response time)")
+    wire, ttfb, _ = measure(page, "identity")
+    print(f"  uncompressed:         {wire:>8,} bytes  median {ttfb:6.1f} ms")
+    for encoding in encodings:
+        wire, ttfb, _ = measure(page, encoding)
+        print(f"  {encoding + ':':<21} {wire:>8,} bytes  median {ttfb:6.1f} ms")
+
+    bytecode = main.templates.env.bytecode_cache
+    main.templates.env.bytecode_cache = None
+    _, cold_compile, _ = measure(page, "identity", cold=True)
+    main.templates.env.bytecode_cache = bytecode
+    measure(page, "identity", cold=True)  # キャッシュを作る
+    _, cold_cached, _ = measure(page, "identity", cold=True)
+    print(f"  first render after start: compile {cold_compile:.1f} ms -> bytecode cache {cold_cached:.1f} ms")
+
+    css_url = main.static_files.url("css/style.css")
+    for label, path in (("/static/css/style.css", "/static/css/style.css"), (css_url, css_url)):
+        wire, _, response = measure(path, ",".join(encodings))
+        print(f"{label}: {wire:,} bytes on wire, content-encoding={response.headers.get('content-encoding', '-')}, "
+              f"cache-control={response.headers.get('cache-control')}")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "build":
+        for line in build_precompressed() or ["nothing to compress"]:
+            print(line)
+    elif command == "bench":
+        bench(sys.argv[2] if len(sys.argv) > 2 else "tutorial-1")
+    else:
+        print(__doc__)
+        sys.exit(1)
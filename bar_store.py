@@ -0,0 +1,186 @@
+"""分足ダンジョン用のチャンク分割バーストア
+
+日足の約100倍の本数になる分足データを、固定本数のチャンクファイルに分けてディスクに保存する。
+セッションはカーソル周辺のチャンクだけを読み込むため、ダンジョンの長さに関わらず
+1セッションあたりのメモリとゲーム状態のサイズは一定になる。
+
+テクニカル指標は取り込み時に全期間を通して計算してから分割するので、
+チャンク境界をまたいでも値は連続する。
+"""
+import json
+import os
+import sys
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple
+
+import pandas as pd
+import yfinance as yf
+
+from models import GameState, compute_indicators, dataframe_to_records
+
+BAR_STORE_DIR = "bars"
+# 1チャンクあたりの本数
+CHUNK_SIZE = 500
+# プロセス内でキャッシュするチャンク数（全セッション共有）
+CHUNK_CACHE_SIZE = 64
+
+INTRADAY_DATE_FORMAT = "%Y-%m-%d %H:%M"
+
+
+def is_intraday(dungeon: Dict) -> bool:
+    """分足（日足以外）のダンジョンかどうか"""
+    return dungeon.get("resolution", "1d") != "1d"
+
+
+def _dungeon_dir(dungeon_id: str) -> str:
+    return os.path.join(BAR_STORE_DIR, dungeon_id)
+
+
+def _chunk_path(dungeon_id: str, index: int) -> str:
+    return os.path.join(_dungeon_dir(dungeon_id), f"chunk_{index:05d}.json")
+
+
+def import_bars(dungeon: Dict, df: pd.DataFrame) -> int:
+    """OHLCVのDataFrameから指標を計算し、チャンクに分割して保存"""
+    if df.empty:
+        return 0
+
+    records = dataframe_to_records(compute_indicators(df), INTRADAY_DATE_FORMAT)
+
+    dungeon_id = dungeon["id"]
+    os.makedirs(_dungeon_dir(dungeon_id), exist_ok=True)
+    n_chunks = (len(records) + CHUNK_SIZE - 1) // CHUNK_SIZE
+    for index in range(n_chunks):
+        chunk = records[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+        with open(_chunk_path(dungeon_id, index), "w") as f:
+            json.dump(chunk, f, separators=(",", ":"))
+
+    manifest = {
+        "dungeon_id": dungeon_id,
+        "resolution": dungeon.get("resolution"),
+        "total_bars": len(records),
+        "chunk_size": CHUNK_SIZE,
+        "chunks": n_chunks,
+    }
+    with open(os.path.join(_dungeon_dir(dungeon_id), "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+    # 古いキャッシュを破棄
+    load_manifest.cache_clear()
+    load_chunk.cache_clear()
+    return len(records)
+
+
+def fetch_intraday_bars(dungeon: Dict) -> int:
+    """yfinanceから分足を取得してストアに取り込む（取得できる期間は直近のみ）"""
+    try:
+        ticker = yf.Ticker(dungeon["stock_symbol"])
+        df = ticker.history(start=dungeon["start_date"], end=dungeon["end_date"],
+                            interval=dungeon["resolution"])
+        return import_bars(dungeon, df)
+    except Exception as e:
+        print(f"Error fetching intraday data for {dungeon.get('stock_symbol', 'unknown')}: {e}")
+        return 0
+
+
+@lru_cache(maxsize=CHUNK_CACHE_SIZE)
+def load_manifest(dungeon_id: str) -> Optional[Dict]:
+    """ダンジョンのマニフェストを読み込む"""
+    path = os.path.join(_dungeon_dir(dungeon_id), "manifest.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=CHUNK_CACHE_SIZE)
+def load_chunk(dungeon_id: str, index: int) -> Tuple[Dict, ...]:
+    """チャンクを読み込む（変更されないようタプルで返す）"""
+    with open(_chunk_path(dungeon_id, index)) as f:
+        return tuple(json.load(f))
+
+
+def has_bars(dungeon: Dict) -> bool:
+    """分足データがストアに取り込まれているかどうか"""
+    # 未取り込みの結果はキャッシュしない（他プロセスが取り込む場合がある）
+    return os.path.exists(os.path.join(_dungeon_dir(dungeon["id"]), "manifest.json"))
+
+
+def load_window(dungeon_id: str, cursor: int) -> Tuple[int, List[Dict]]:
+    """カーソルを含むチャンクと、その直前のチャンクを読み込む
+
+    直前のチャンクはチャート表示用の過去データ。戻り値は (先頭の通し番号, 足のリスト)。
+    """
+    manifest = load_manifest(dungeon_id)
+    chunk_size = manifest["chunk_size"]
+    index = min(cursor // chunk_size, manifest["chunks"] - 1)
+    first = max(0, index - 1)
+
+    bars: List[Dict] = []
+    for i in range(first, index + 1):
+        bars.extend(load_chunk(dungeon_id, i))
+    return first * chunk_size, bars
+
+
+def load_closes(dungeon_id: str) -> List[float]:
+    """全期間の終値（結果の評価基準の計算用）"""
+    manifest = load_manifest(dungeon_id)
+    closes: List[float] = []
+    for index in range(manifest["chunks"]):
+        closes.extend(bar["close"] for bar in load_chunk(dungeon_id, index))
+    return closes
+
+
+def ensure_window(game_state: GameState) -> bool:
+    """カーソルが読み込み済みの範囲を超えたらウィンドウを進める
+
+    ダンジョンを終えた後（カーソルが最後の足の次）は、最後の足を含むウィンドウにする。
+    """
+    if game_state.positions:
+        # ポートフォリオダンジョンの相場はゲーム状態に持たない（portfolio.Basket）
+        return False
+    cursor = min(game_state.current_day, game_state.total_days - 1)
+    if cursor - game_state.window_start < len(game_state.stock_data):
+        return False
+    window_start, bars = load_window(game_state.dungeon_id, cursor)
+    game_state.window_start = window_start
+    game_state.stock_data = bars
+    return True
+
+
+def new_intraday_state(dungeon: Dict) -> Optional[GameState]:
+    """分足ダンジョンの初期ゲーム状態を作成（取り込み済みでなければNone）"""
+    if not has_bars(dungeon):
+        return None
+    manifest = load_manifest(dungeon["id"])
+    window_start, bars = load_window(dungeon["id"], 0)
+    return GameState(
+        dungeon_id=dungeon["id"],
+        current_day=0,
+        total_days=manifest["total_bars"],
+        cash=10000,
+        shares=0,
+        avg_price=0,
+        stock_data=bars,
+        window_start=window_start,
+        trade_history=[]
+    )
+
+
+if __name__ == "__main__":
+    # 使い方: python bar_store.py <dungeon_id> <csv_path>
+    # CSVは Datetime, Open, High, Low, Close, Volume の列を持つこと
+    from models import DUNGEONS
+
+    if len(sys.argv) != 3:
+        print("usage: python bar_store.py <dungeon_id> <csv_path>")
+        sys.exit(1)
+
+    dungeon = next((d for d in DUNGEONS if d["id"] == sys.argv[1]), None)
+    if not dungeon or not is_intraday(dungeon):
+        print(f"Unknown intraday dungeon: {sys.argv[1]}")
+        sys.exit(1)
+
+    df = pd.read_csv(sys.argv[2], index_col=0, parse_dates=True)
+    count = import_bars(dungeon, df)
+    print(f"Imported {count} bars into {_dungeon_dir(dungeon['id'])}")
@@ -0,0 +1,134 @@
+"""チャートデータ間引きモジュール
+
+長期ダンジョンでもChart.jsに渡す点数を一定に保つため、サーバー側でデータを間引く。
+古い期間はバケットに分割し、ローソク足はOHLC集約、線系列はLTTB
+（Largest-Triangle-Three-Buckets）で代表点を選ぶ。直近の日は常にフル解像度で送る。
+"""
+from typing import List, Dict, Optional, Tuple
+
+# クライアントが幅を報告しない場合のチャート幅（px）
+CHART_DEFAULT_WIDTH = 600
+# 1点あたりに割り当てるピクセル数
+CHART_PIXELS_PER_POINT = 3
+# 送信する点数の下限・上限
+CHART_MIN_POINTS = 60
+CHART_MAX_POINTS = 400
+# 間引かずにそのまま送る直近の日数
+FULL_RESOLUTION_DAYS = 60
+
+# LTTBで間引く線系列（終値は close_line として出力）
+LINE_FIELDS = [
+    "sma_25", "sma_75",
+    "rsi_14",
+    "macd", "macd_signal", "macd_hist",
+    "bb_upper", "bb_middle", "bb_lower",
+]
+
+
+def chart_point_budget(width: Optional[int]) -> int:
+    """チャート幅から送信する最大点数を計算"""
+    if not width or width <= 0:
+        width = CHART_DEFAULT_WIDTH
+    points = width // CHART_PIXELS_PER_POINT
+    return max(CHART_MIN_POINTS, min(CHART_MAX_POINTS, points))
+
+
+def bucket_bounds(start: int, end: int, n_buckets: int) -> List[Tuple[int, int]]:
+    """[start, end) を n_buckets 個のほぼ等しい区間に分割"""
+    length = end - start
+    n_buckets = max(1, min(n_buckets, length))
+    bounds = []
+    for i in range(n_buckets):
+        lo = start + (length * i) // n_buckets
+        hi = start + (length * (i + 1)) // n_buckets
+        bounds.append((lo, hi))
+    return bounds
+
+
+def aggregate_ohlc(points: List[Dict]) -> Dict:
+    """バケット内の日足をひとつのローソク足に集約"""
+    return {
+        "date": points[-1]["date"],
+        "open": points[0]["open"],
+        "high": max(p["high"] for p in points),
+        "low": min(p["low"] for p in points),
+        "close": points[-1]["close"],
+        "volume": sum(p["volume"] for p in points),
+    }
+
+
+def _average(values: List[Optional[float]], lo: int, hi: int) -> Optional[Tuple[float, float]]:
+    """区間内の有効値の平均座標 (x, y) を計算"""
+    xs = [i for i in range(lo, hi) if values[i] is not None]
+    if not xs:
+        return None
+    return sum(xs) / len(xs), sum(values[i] for i in xs) / len(xs)
+
+
+def lttb_select(values: List[Optional[float]], bounds: List[Tuple[int, int]],
+                next_point: Optional[Tuple[float, float]] = None) -> List[Optional[float]]:
+    """LTTBで各バケットの代表値を選ぶ
+
+    前のバケットで選んだ点と次のバケットの平均点が作る三角形の面積が
+    最大になる点を選ぶ。最初のバケットは先頭の有効値を採用する。
+    next_point は最後のバケットの「次」にあたる点（直近のフル解像度部分の先頭）。
+    """
+    selected: List[Optional[float]] = []
+    anchor: Optional[Tuple[float, float]] = None
+
+    for b, (lo, hi) in enumerate(bounds):
+        candidates = [i for i in range(lo, hi) if values[i] is not None]
+        if not candidates:
+            selected.append(None)
+            continue
+
+        if anchor is None:
+            best = candidates[0]
+        else:
+            if b + 1 < len(bounds):
+                target = _average(values, *bounds[b + 1])
+            else:
+                target = next_point
+            if target is None:
+                target = _average(values, lo, hi)
+
+            ax, ay = anchor
+            tx, ty = target
+            best = candidates[0]
+            best_area = -1.0
+            for i in candidates:
+                area = abs((ax - tx) * (values[i] - ay) - (ax - i) * (ty - ay))
+                if area > best_area:
+                    best_area = area
+                    best = i
+
+        anchor = (best, values[best])
+        selected.append(values[best])
+
+    return selected
+
+
+def build_chart_data(stock_data: List[Dict], current_day: int, width: Optional[int] = None) -> List[Dict]:
+    """current_day までのチャート表示用データを作成（必要に応じて間引く）"""
+    visible = stock_data[:current_day + 1]
+    budget = chart_point_budget(width)
+    if len(visible) <= budget:
+        return visible
+
+    # 直近はフル解像度、それ以前をバケットに分割
+    recent_days = min(FULL_RESOLUTION_DAYS, budget // 2)
+    split = len(visible) - recent_days
+    bounds = bucket_bounds(0, split, budget - recent_days)
+
+    points = [aggregate_ohlc(visible[lo:hi]) for lo, hi in bounds]
+
+    # 線系列はLTTBで代表点を選ぶ
+    for field in ["close"] + LINE_FIELDS:
+        values = [d.get(field) for d in visible]
+        next_point = (split, values[split]) if values[split] is not None else None
+        selected = lttb_select(values, bounds, next_point)
+        key = "close_line" if field == "close" else field
+        for point, value in zip(points, selected):
+            point[key] = value
+
+    return points + visible[split:]
@@ -0,0 +1,203 @@
+"""UserProfile / GameState の保存形式（バージョンつき）
+
+保存するJSONの先頭の "v" が形式のバージョン。"v" がないものは以前の形式（model_dump_json そのまま）。
+読み込み時にどの版でも現在のモデルに変換し、次に保存したときに最新の形式で書き直される。
+
+- v2
+  - UserProfile.indicators: インジケーターの説明・RPG名などはユーザーごとに変わらないので
+    INITIAL_INDICATORS を id で参照し、ユーザーごとには {id: フラグ}（INDICATOR_UNLOCKED | INDICATOR_EQUIPPED）だけを持つ
+  - GameState.stock_data: 足ごとに同じキーを繰り返さないよう {"columns": [キー...], "rows": [[値...]...]} の列指向にする
+
+level や dungeon_id などの他の項目は以前と同じくトップレベルに置く（storage の生成列が json_extract で参照する）。
+エンコーダは orjson があればそれを使い、なければ標準の json を使う。
+
+使い方:
+    python codec.py bench [count]    エンコード・デコードの速度と保存サイズを以前の形式と比較
+    python codec.py migrate          保存済みの全ユーザーを最新の形式で書き直す
+"""
+import json
+import sys
+import time
+from operator import itemgetter
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from models import INITIAL_INDICATORS, GameState, UserProfile
+
+try:
+    import orjson
+except ImportError:  # orjsonがなければ標準のjson（形式は同じ）
+    orjson = None
+
+CODEC_VERSION = 2
+
+# インジケーターのフラグ（v2）
+INDICATOR_UNLOCKED = 1
+INDICATOR_EQUIPPED = 2
+
+# 静的なインジケーター情報: id -> フラグ以外の項目
+INDICATOR_CATALOG = {
+    ind["id"]: {key: value for key, value in ind.items() if key not in ("unlocked", "equipped")}
+    for ind in INITIAL_INDICATORS
+}
+
+
+def dumps(data: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _indicator_flags(indicators: List[Dict[str, Any]]) -> Dict[str, int]:
+    return {
+        ind["id"]: (INDICATOR_UNLOCKED if ind.get("unlocked") else 0)
+                   | (INDICATOR_EQUIPPED if ind.get("equipped") else 0)
+        for ind in indicators
+    }
+
+
+# 保存後にカタログに追加されたインジケーターは初期状態のフラグで持たせる
+_INITIAL_FLAGS = _indicator_flags(INITIAL_INDICATORS)
+
+
+def _expand_indicators(flags: Dict[str, int]) -> List[Dict[str, Any]]:
+    """{id: フラグ} をインジケーターの辞書のリストに戻す（カタログの順、カタログにない id は捨てる）"""
+    indicators = []
+    for indicator_id, metadata in INDICATOR_CATALOG.items():
+        flag = flags.get(indicator_id, _INITIAL_FLAGS[indicator_id])
+        indicators.append({**metadata,
+                           "unlocked": bool(flag & INDICATOR_UNLOCKED),
+                           "equipped": bool(flag & INDICATOR_EQUIPPED)})
+    return indicators
+
+
+def _pack_bars(bars: List[Dict[str, Any]]) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+    """足のリストを列指向にする（足によってキーが違う場合はそのまま）"""
+    if not bars:
+        return bars
+    columns = list(bars[0])
+    if any(len(bar) != len(columns) for bar in bars):
+        return bars
+    row = itemgetter(*columns)
+    try:
+        return {"columns": columns, "rows": [row(bar) for bar in bars]}
+    except KeyError:
+        return bars
+
+
+def _unpack_bars(packed: Union[Dict[str, Any], List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    if isinstance(packed, list):
+        return packed
+    columns = packed["columns"]
+    return [dict(zip(columns, row)) for row in packed["rows"]]
+
+
+def encode_user(profile: UserProfile) -> str:
+    data = profile.model_dump(exclude={"indicators"})
+    data["indicators"] = _indicator_flags(profile.indicators)
+    return dumps({"v": CODEC_VERSION, **data})
+
+
+def user_from_dict(data: Dict[str, Any]) -> UserProfile:
+    """保存形式の辞書（どの版でもよい）からUserProfileを作る"""
+    if data.pop("v", 1) >= 2:
+        data["indicators"] = _expand_indicators(data.get("indicators", {}))
+    return UserProfile(**data)
+
+
+def decode_user(data_json: Union[str, bytes]) -> UserProfile:
+    return user_from_dict(loads(data_json))
+
+
+def encode_game_state(state: GameState) -> str:
+    # 足は元から辞書なので model_dump でコピーせずにそのまま列にする
+    data = state.model_dump(exclude={"stock_data"})
+    data["stock_data"] = _pack_bars(state.stock_data)
+    return dumps({"v": CODEC_VERSION, **data})
+
+
+def game_state_from_dict(data: Dict[str, Any]) -> GameState:
+    """保存形式の辞書（どの版でもよい）からGameStateを作る"""
+    version = data.pop("v", 1)
+    # 足は件数が多いので検証せずに後から入れる（中身は辞書のリストで、保存時と同じもの）
+    bars = data.pop("stock_data", [])
+    state = GameState(**data)
+    state.stock_data = _unpack_bars(bars) if version >= 2 else bars
+    return state
+
+
+def decode_game_state(data_json: Union[str, bytes]) -> GameState:
+    return game_state_from_dict(loads(data_json))
+
+
+def _timed(fn: Callable, count: int) -> float:
+    """fnをcount回実行した1回あたりのマイクロ秒"""
+    started = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def bench(count: int = 2000):
+    """以前の形式（json + model_dump_json）とv2の速度・サイズを比べる"""
+    import numpy as np
+    import pandas as pd
+    from models import compute_indicators, dataframe_to_records
+
+    profile = UserProfile(player_class="hero", level=12, xp=3456, gold=23456, total_profit=1234.5,
+                          total_trades=42, win_rate=0.55, completed_dungeons=["tutorial-1", "forest-1"],
+                          indicators=[{**ind, "unlocked": ind["required_level"] <= 12} for ind in INITIAL_INDICATORS])
+    rng = np.random.default_rng(0)
+    close = 2000 * np.exp(np.cumsum(rng.normal(0, 0.02, 250)))
+    df = pd.DataFrame({"Open": close, "High": close * 1.01, "Low": close * 0.99, "Close": close, "Volume": 1e6},
+                      index=pd.bdate_range("2023-01-02", periods=250))
+    state = GameState(dungeon_id="tutorial-1", current_day=120, total_days=250,
+                      stock_data=dataframe_to_records(compute_indicators(df)),
+                      trade_history=[{"day": i, "action": "buy" if i % 2 == 0 else "sell", "price": 2000.0,
+                                      "shares": 5} for i in range(0, 40, 2)])
+
+    print(f"encoder: {'orjson ' + orjson.__version__ if orjson else 'json (orjson not installed)'}, "
+          f"{count:,} iterations")
+    for name, model, legacy_decode, encode, decode in (
+        ("UserProfile", profile, lambda s: UserProfile(**json.loads(s)), encode_user, decode_user),
+        ("GameState (250 bars)", state, lambda s: GameState(**json.loads(s)), encode_game_state, decode_game_state),
+    ):
+        legacy, current = model.model_dump_json(), encode(model)
+        assert decode(current) == model and decode(legacy) == model
+        print(f"{name}")
+        print(f"  size:   v1 {len(legacy.encode()):>8,} bytes -> v2 {len(current.encode()):>8,} bytes "
+              f"({len(current.encode()) / len(legacy.encode()):.0%})")
+        print(f"  encode: v1 {_timed(model.model_dump_json, count):>8,.1f} us    -> v2 "
+              f"{_timed(lambda: encode(model), count):>8,.1f} us")
+        print(f"  decode: v1 {_timed(lambda: legacy_decode(legacy), count):>8,.1f} us    -> v2 "
+              f"{_timed(lambda: decode(current), count):>8,.1f} us   (v1 data via codec: "
+              f"{_timed(lambda: decode(legacy), count):,.1f} us)")
+
+
+def migrate() -> int:
+    """保存済みの全ユーザーを最新の形式で書き直し、件数を返す（ゲーム状態は次のスナップショットで書き直される）"""
+    import database
+
+    database.init_db()
+    count = 0
+    for session_id, profile in list(database.scan_users()):
+        database.save_user(session_id, profile)
+        count += 1
+    database.flush_writes()
+    return count
+
+
+if __name__ == "__main__":
+    command: Optional[str] = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+    elif command == "migrate":
+        print(f"migrated {migrate():,} users")
+    else:
+        print(__doc__)
+        sys.exit(1)
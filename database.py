@@ -1,176 +1,377 @@
 """データベース管理モジュール"""
-import sqlite3
-import json
-from typing import Optional
-from models import UserProfile, GameState
+import os
+import uuid
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+import codec
+from models import UserProfile, GameState, apply_event
+from storage import LEGACY_RUN_PREFIX, StorageBackend, SQLiteBackend, ShardedSQLiteBackend, MemoryBackend
+from onboarding import OnboardingStore, set_answer
+from leaderboard import Leaderboard, Board
+from write_behind import WriteBehindQueue
 
 DB_PATH = "game.db"
+# 診断中の回答（有効期限つき）の保存先
+ONBOARDING_DB_PATH = "onboarding.db"
+# ランキングの記録の保存先
+LEADERBOARD_DB_PATH = "leaderboard.db"
 
+# ストレージバックエンド: "sqlite"（DB_PATHの単一ファイル）、"sharded"（SHARD_DIRにSTORAGE_SHARDS個）、"memory"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")
+STORAGE_SHARDS = int(os.environ.get("STORAGE_SHARDS", "4"))
+SHARD_DIR = "shards"
 
-def get_connection():
-    """データベース接続を取得"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# 書き込みの耐久性: "sync" は保存のたびにコミット、"batched" はwrite-behindキューでまとめてコミット
+# durable=True を指定した保存（ダンジョン決算など）は常に即時コミットする
+WRITE_DURABILITY = os.environ.get("WRITE_DURABILITY", "batched")
 
+# イベントをこの数だけ追記するごとにゲーム状態のスナップショットを保存する
+# （読み込みはスナップショット＋それ以降のイベントの再生になる）
+SNAPSHOT_INTERVAL = 20
 
-def init_db():
-    """データベーステーブルを初期化"""
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    # usersテーブル
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT UNIQUE NOT NULL,
-            data TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-
-    # game_statesテーブル
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS game_states (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT NOT NULL,
-            data TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-
-    # インデックスを作成
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_session_id ON users(session_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_game_states_session_id ON game_states(session_id)")
-
-    conn.commit()
-    conn.close()
+# 完了した挑戦のプロフィールに表示する件数
+RECENT_RUNS_LIMIT = 10
 
+# セッションの有効期限（クッキーの期限、およびアクセスの途絶えたセッションを削除するまでの秒数）
+SESSION_MAX_AGE = 1209600  # 2週間
 
-def get_user_by_session(session_id: str) -> Optional[UserProfile]:
-    """セッションIDからユーザープロフィールを取得"""
-    conn = get_connection()
-    cursor = conn.cursor()
+backend: Optional[StorageBackend] = None
+onboarding_store: Optional[OnboardingStore] = None
+leaderboard: Optional[Leaderboard] = None
 
-    cursor.execute("SELECT data FROM users WHERE session_id = ?", (session_id,))
-    row = cursor.fetchone()
-    conn.close()
+# このプロセスで最後に読み書きしたゲーム状態の (run_id, version)
+_state_versions: Dict[str, Tuple[str, int]] = {}
+# このプロセスでアクセスのあったセッション（メンテナンス時にまとめて最終アクセス時刻を更新）
+_seen_sessions: Set[str] = set()
+# 保存済みのスナップショットにrun_idがない（イベントログ以前の）セッション。次のイベントでスナップショットを保存する
+_legacy_snapshots: Set[str] = set()
 
-    if row:
-        try:
-            data = json.loads(row["data"])
-            return UserProfile(**data)
-        except Exception as e:
-            print(f"Error parsing user profile: {e}")
-            return None
-    return None
 
+class StaleStateError(Exception):
+    """読み込んだ後に他のリクエストがゲーム状態を更新した"""
 
-def save_user(session_id: str, profile: UserProfile):
-    """ユーザープロフィールを保存"""
-    conn = get_connection()
-    cursor = conn.cursor()
 
-    data_json = profile.model_dump_json()
+def create_backend() -> StorageBackend:
+    """設定に応じたストレージバックエンドを作成"""
+    if STORAGE_BACKEND == "sharded":
+        return ShardedSQLiteBackend(SHARD_DIR, STORAGE_SHARDS)
+    if STORAGE_BACKEND == "memory":
+        return MemoryBackend()
+    return SQLiteBackend(DB_PATH)
 
-    cursor.execute("""
-        INSERT INTO users (session_id, data, updated_at)
-        VALUES (?, ?, CURRENT_TIMESTAMP)
-        ON CONFLICT(session_id) DO UPDATE SET
-            data = ?,
-            updated_at = CURRENT_TIMESTAMP
-    """, (session_id, data_json, data_json))
 
-    conn.commit()
-    conn.close()
+def init_db():
+    """ストレージバックエンドを作成し、テーブルを初期化"""
+    global backend, onboarding_store, leaderboard
+    backend = create_backend()
+    backend.init()
+    onboarding_store = OnboardingStore(":memory:" if STORAGE_BACKEND == "memory" else ONBOARDING_DB_PATH)
+    onboarding_store.init()
+    leaderboard = Leaderboard(":memory:" if STORAGE_BACKEND == "memory" else LEADERBOARD_DB_PATH)
+    leaderboard.init()
 
 
-def get_game_state(session_id: str) -> Optional[GameState]:
-    """セッションIDからゲーム状態を取得"""
-    conn = get_connection()
-    cursor = conn.cursor()
+def write_batch(users: Dict[str, str], game_states: Dict[str, str],
+                events: Optional[Dict[str, List[str]]] = None) -> List[str]:
+    """ユーザー・ゲーム状態・イベントのJSONをまとめて書き込み、古い版として捨てたsession_idを返す"""
+    rejected = backend.write_batch(users, game_states, events)
+    for session_id in rejected:
+        # 他のプロセスが書いた版を次の読み込みで取り直す
+        _state_versions.pop(session_id, None)
+    return rejected
 
-    cursor.execute("SELECT data FROM game_states WHERE session_id = ? ORDER BY updated_at DESC LIMIT 1", (session_id,))
-    row = cursor.fetchone()
-    conn.close()
 
-    if row:
+write_queue = WriteBehindQueue(write_batch)
+
+
+def flush_writes():
+    """未書き込みの更新をすべてコミット"""
+    write_queue.flush()
+
+
+def rebalance_step() -> int:
+    """シャード再分散を少し進め、確認したセッション数を返す（シャーディングしていなければ何もしない）"""
+    if isinstance(backend, ShardedSQLiteBackend) and backend.rebalancing():
+        return backend.rebalance_step()
+    return 0
+
+
+def scan_users() -> Iterator[Tuple[str, UserProfile]]:
+    """全シャードのユーザーを列挙（管理・分析用）"""
+    flush_writes()
+    for session_id, data_json in backend.scan_users():
         try:
-            data = json.loads(row["data"])
-            return GameState(**data)
+            yield session_id, codec.decode_user(data_json)
         except Exception as e:
-            print(f"Error parsing game state: {e}")
-            return None
-    return None
+            print(f"Error parsing user profile: {e}")
 
 
-def save_game_state(session_id: str, state: GameState):
-    """ゲーム状態を保存"""
-    conn = get_connection()
-    cursor = conn.cursor()
+def storage_stats() -> Dict:
+    """ストレージの件数などの統計"""
+    flush_writes()
+    return backend.stats()
 
-    data_json = state.model_dump_json()
 
-    cursor.execute("""
-        INSERT INTO game_states (session_id, data, updated_at)
-        VALUES (?, ?, CURRENT_TIMESTAMP)
-    """, (session_id, data_json))
+def aggregate_users(field: Optional[str] = None, group_by: Optional[str] = None,
+                    filters: List[Tuple[str, str, Any]] = ()) -> Dict[Any, Dict[str, Any]]:
+    """プロフィールの生成列（storage.USER_COLUMNS）で絞り込んでグループごとに集計
 
-    conn.commit()
-    conn.close()
+    例: aggregate_users("gold", "player_class", [("level", ">=", 10)])
+    {グループの値: {"count", "sum", "min", "max", "avg"}} を返す。
+    """
+    flush_writes()
+    results = backend.aggregate_users(field, group_by, list(filters))
+    for entry in results.values():
+        entry["avg"] = entry["sum"] / entry["count"] if entry["sum"] is not None and entry["count"] else None
+    return results
 
 
-def delete_game_state(session_id: str):
-    """ゲーム状態を削除"""
-    conn = get_connection()
-    cursor = conn.cursor()
+def count_sessions_by_dungeon() -> Dict[str, int]:
+    """ダンジョンごとのプレイ中のセッション数"""
+    flush_writes()
+    return backend.count_sessions_by_dungeon()
+
+
+def touch_session(session_id: str):
+    """セッションへのアクセスを記録（期限切れで削除されないようにする）"""
+    _seen_sessions.add(session_id)
+
+
+def touch_seen_sessions():
+    """記録したアクセスをまとめてストレージに反映"""
+    if _seen_sessions:
+        session_ids = list(_seen_sessions)
+        _seen_sessions.clear()
+        backend.touch_users(session_ids)
 
-    cursor.execute("DELETE FROM game_states WHERE session_id = ?", (session_id,))
 
-    conn.commit()
-    conn.close()
+def forget_sessions(session_ids: List[str]):
+    """削除されたセッションのプロセス内の情報を捨てる"""
+    for session_id in session_ids:
+        _state_versions.pop(session_id, None)
+        _seen_sessions.discard(session_id)
+        _legacy_snapshots.discard(session_id)
 
 
-def save_diagnostic_scores(session_id: str, scores: dict, current_question: int):
-    """診断スコアを一時保存（オンボーディング中のみ）"""
-    conn = get_connection()
-    cursor = conn.cursor()
+def delete_session(session_id: str):
+    """セッションのユーザー・ゲーム状態・挑戦の履歴・診断の回答・ランキングの記録をすべて削除"""
+    # 未書き込みの更新が後から書き込まれないよう先に破棄する
+    write_queue.discard_user(session_id)
+    write_queue.discard_game_state(session_id)
+    write_queue.discard_events(session_id)
+    forget_sessions([session_id])
+    backend.delete_session(session_id)
+    onboarding_store.delete(session_id)
+    leaderboard.remove(session_id)
 
-    data = json.dumps({"scores": scores, "current_question": current_question})
 
-    # game_statesテーブルを一時的に使用（dungeon_idに"onboarding"を設定）
-    cursor.execute("""
-        INSERT INTO game_states (session_id, data, updated_at)
-        VALUES (?, ?, CURRENT_TIMESTAMP)
-    """, (session_id, data))
+def get_user_by_session(session_id: str) -> Optional[UserProfile]:
+    """セッションIDからユーザープロフィールを取得"""
+    data_json = write_queue.get_user(session_id)
+    if data_json is None:
+        data_json = backend.get_user(session_id)
+
+    if data_json:
+        try:
+            return codec.decode_user(data_json)
+        except Exception as e:
+            print(f"Error parsing user profile: {e}")
+            return None
+    return None
 
-    conn.commit()
-    conn.close()
 
+def save_user(session_id: str, profile: UserProfile, durable: bool = False):
+    """ユーザープロフィールを保存（durable=Trueなら即時コミット）"""
+    write_queue.put_user(session_id, codec.encode_user(profile))
+    if durable or WRITE_DURABILITY == "sync":
+        write_queue.flush()
 
-def get_diagnostic_scores(session_id: str) -> tuple:
-    """診断スコアを取得"""
-    conn = get_connection()
-    cursor = conn.cursor()
 
-    cursor.execute("SELECT data FROM game_states WHERE session_id = ? ORDER BY updated_at DESC LIMIT 1", (session_id,))
-    row = cursor.fetchone()
-    conn.close()
+def get_game_state(session_id: str) -> Optional[GameState]:
+    """セッションIDからゲーム状態を取得（最新のスナップショットに、それ以降のイベントを再生する）"""
+    data_json = write_queue.get_game_state(session_id)
+    if data_json is None:
+        data_json = backend.get_game_state(session_id)
 
-    if row:
+    if data_json:
         try:
-            data = json.loads(row["data"])
-            if "scores" in data:
-                return data.get("scores", {"hero": 0, "rogue": 0, "sage": 0}), data.get("current_question", 0)
-        except:
-            pass
-    return {"hero": 0, "rogue": 0, "sage": 0}, 0
+            data = codec.loads(data_json)
+            state = codec.game_state_from_dict(data)
+        except Exception as e:
+            print(f"Error parsing game state: {e}")
+            return None
+        if "run_id" not in data:
+            _legacy_snapshots.add(session_id)
+        replay_events(state, backend.get_events(session_id, state.run_id, state.version)
+                      + write_queue.get_events(session_id))
+        _state_versions[session_id] = (state.run_id, state.version)
+        return state
+    return None
 
 
-def clear_diagnostic_scores(session_id: str):
-    """診断スコアを削除"""
-    # オンボーディング完了時に呼び出す
-    delete_game_state(session_id)
+def replay_events(state: GameState, event_jsons: List[str]):
+    """スナップショットより後の、seqが途切れずに続くイベントだけを適用する"""
+    events = {}
+    for event_json in event_jsons:
+        event = codec.loads(event_json)
+        if event.get("run_id") == state.run_id and event["seq"] > state.version:
+            events[event["seq"]] = event
+    while state.version + 1 in events:
+        apply_event(state, events[state.version + 1])
+        state.version += 1
+
+
+def check_version(session_id: str, state: GameState, expected_version: Optional[int]):
+    """保存済みの版がexpected_versionと異なれば（読み込み後に他のリクエストが更新していれば）StaleStateError"""
+    if expected_version is None:
+        return
+    if session_id not in _state_versions:
+        get_game_state(session_id)
+    known = _state_versions.get(session_id)
+    if known and known[0] == state.run_id and known[1] != expected_version:
+        raise StaleStateError(f"Game state for {session_id} is at version {known[1]}, expected {expected_version}")
+
+
+def commit_if_durable(session_id: str, durable: bool):
+    """durable指定か同期モードなら即時コミットし、他のプロセスに先を越されていればStaleStateError"""
+    if durable or WRITE_DURABILITY == "sync":
+        write_queue.flush()
+        if session_id in write_queue.last_rejected:
+            raise StaleStateError(f"Game state for {session_id} was updated by another worker")
+
+
+async def commit_state(session_id: str):
+    """キューに入れたゲーム状態・イベントのコミットを待ち、他のプロセスに先を越されていればStaleStateError
+
+    バッチモードでも、版つきの書き込みは応答を返す前にこれで結果を確かめる
+    （同時に来た他のリクエストの書き込みとまとめてコミットされる）。
+    """
+    if not await write_queue.commit(session_id):
+        raise StaleStateError(f"Game state for {session_id} was updated by another worker")
+
+
+def save_game_state(session_id: str, state: GameState, durable: bool = False,
+                    expected_version: Optional[int] = None):
+    """ゲーム状態のスナップショットを保存（通常はwrite-behindキュー経由でまとめてコミット）
+
+    保存のたびにversionを1増やす。expected_versionを指定すると、保存済みの版が
+    それと異なる場合（読み込み後に他のリクエストが更新した場合）にStaleStateErrorを送出する。
+    プレイ中の操作は状態全体ではなく append_event でイベントだけを追記する。
+    """
+    check_version(session_id, state, expected_version)
+    state.version += 1
+    write_queue.put_game_state(session_id, codec.encode_game_state(state))
+    _state_versions[session_id] = (state.run_id, state.version)
+    _legacy_snapshots.discard(session_id)
+    commit_if_durable(session_id, durable)
+
+
+def append_event(session_id: str, state: GameState, event: Dict[str, Any], durable: bool = False,
+                 expected_version: Optional[int] = None):
+    """適用済みのイベント（models.apply_event）を追記する
+
+    イベントのseqは適用後のversionになる。SNAPSHOT_INTERVAL個ごとに状態全体のスナップショットも保存する。
+    expected_version と durable の扱いは save_game_state と同じ。バッチモードでは、呼び出し側が
+    commit_state() でコミットの結果を待つ。
+    """
+    check_version(session_id, state, expected_version)
+    state.version += 1
+    event["run_id"], event["seq"] = state.run_id, state.version
+    write_queue.put_event(session_id, codec.dumps(event))
+    if state.version % SNAPSHOT_INTERVAL == 0 or session_id in _legacy_snapshots:
+        write_queue.put_game_state(session_id, codec.encode_game_state(state))
+        _legacy_snapshots.discard(session_id)
+    _state_versions[session_id] = (state.run_id, state.version)
+    commit_if_durable(session_id, durable)
 
+
+def delete_game_state(session_id: str):
+    """ゲーム状態（スナップショット）を削除（イベントは完了した挑戦の記録として残す）"""
+    # 未書き込みの状態が後から書き込まれないよう先に破棄する
+    write_queue.discard_game_state(session_id)
+    _state_versions.pop(session_id, None)
+    _legacy_snapshots.discard(session_id)
+    backend.delete_game_states(session_id)
+
+
+def legacy_run_id(session_id: str) -> str:
+    """以前の通算を引き継ぐ挑戦のID（セッションごとに決まるが、セッションIDを含まない）"""
+    return f"{LEGACY_RUN_PREFIX}{uuid.uuid5(uuid.NAMESPACE_URL, f'session:{session_id}').hex}"
+
+
+def record_run(session_id: str, profile: UserProfile, state: GameState, profit_loss: float,
+               profit_loss_percent: float, xp_earned: int, gold_earned: int) -> Dict[str, Any]:
+    """完了したダンジョン挑戦を、与えたXP・ゴールドとともに記録し、全挑戦の通算（取引数・売り・勝ち・損益）を返す
+
+    run_idごとに一度だけ記録されるので、結果画面の再送で二重に数えることはない。
+    売り・勝ちは売買の記録が残っている挑戦だけの正確な数（引き継いだ以前の通算は含まない）。
+    """
+    flush_writes()
+    if backend.run_stats(session_id)["runs"] == 0 and profile.total_trades > 0:
+        # 記録がない以前のプレイヤーの通算を1件の挑戦として引き継ぐ
+        # 残っているのは取引数と勝率だけなので、売り・勝ちは数えずに引き継いだ行として印をつける
+        backend.record_run(session_id, {
+            "run_id": legacy_run_id(session_id), "dungeon_id": "legacy", "trades": profile.total_trades,
+            "sells": 0, "wins": 0, "profit_loss": 0.0, "profit_loss_percent": 0.0, "carried_over": 1,
+            "xp_earned": None, "gold_earned": None,
+        })
+    sells = [t for t in state.trade_history if t["action"] == "sell"]
+    backend.record_run(session_id, {
+        "run_id": state.run_id,
+        "dungeon_id": state.dungeon_id,
+        "trades": len(state.trade_history),
+        "sells": len(sells),
+        "wins": len([t for t in sells if t.get("profit", 0) > 0]),
+        "profit_loss": profit_loss,
+        "profit_loss_percent": profit_loss_percent,
+        "carried_over": 0,
+        "xp_earned": xp_earned,
+        "gold_earned": gold_earned,
+    })
+    return backend.run_stats(session_id)
+
+
+def recent_runs(session_id: str, limit: int = RECENT_RUNS_LIMIT) -> List[Dict[str, Any]]:
+    """完了したダンジョン挑戦を新しい順に取得"""
+    return backend.list_runs(session_id, limit)
+
+
+def get_onboarding_answers(session_id: str) -> str:
+    """診断の回答を取得（未回答の質問は "-"）"""
+    return onboarding_store.get(session_id)
+
+
+def save_onboarding_answer(session_id: str, question_id: int, option_index: int) -> Optional[str]:
+    """診断の回答を記録し、記録後の回答を返す（範囲外の回答ならNone）"""
+    answers = set_answer(onboarding_store.get(session_id), question_id, option_index)
+    if answers is not None:
+        onboarding_store.put(session_id, answers)
+    return answers
+
+
+def clear_onboarding(session_id: str):
+    """診断の回答を削除（オンボーディング完了時に呼び出す）"""
+    onboarding_store.delete(session_id)
+
+
+def expire_onboarding() -> int:
+    """途中で離脱した診断を削除"""
+    return onboarding_store.expire()
+
+
+def record_result(session_id: str, profile: UserProfile, dungeon_id: str,
+                  profit_loss_percent: float, profit_loss: float) -> Dict[str, Optional[int]]:
+    """ダンジョンの決算をランキングに記録し、ダンジョンと総合の順位を返す"""
+    return leaderboard.record(session_id, profile.player_class, profile.level, dungeon_id,
+                              profit_loss_percent, profit_loss)
+
+
+def remove_from_leaderboard(session_ids: List[str]):
+    """削除したセッション（期限切れなど）の記録をランキングから削除"""
+    if session_ids:
+        leaderboard.remove(*session_ids)
+
+
+def leaderboard_board(scope: str, player_class: Optional[str] = None) -> Board:
+    """ランキングを取得（他のプロセスの決算も反映する）"""
+    leaderboard.sync()
+    return leaderboard.board(scope, player_class)
@@ -0,0 +1,413 @@
+"""完了した挑戦・トレード・プロフィールのParquet書き出し（オフライン分析用）
+
+出力先のディレクトリに、ダンジョンと日付でパーティション分けしたParquetを追加していく:
+    runs/dungeon=<ダンジョンID>/date=<完了日>/part-*.parquet     完了した挑戦（runs テーブル）
+    trades/dungeon=<ダンジョンID>/date=<完了日>/part-*.parquet   完了した挑戦のトレード（イベントログから）
+    profiles/date=<更新日>/part-*.parquet                       その日に更新・アクセスのあったプロフィール
+    _watermark.json                                            どこまで書き出したか
+
+- 行は (完了・更新時刻, ID) の順に BATCH_SIZE 件ずつ読み、1バッチ分だけをメモリに持って書き出す
+  （シャーディング時は各シャードを同じ順に読みながらマージする）
+- 書き出すのは前回の書き出しの終わりから、今の EXPORT_LAG 秒前までに完了・更新した行。
+  バッチを書き出すたびに _watermark.json を進めるので、途中で止まっても続きから再開できる
+  （同じ行の範囲は同じファイル名になるので、やり直しても重複しない）
+- セッションIDはクッキーの値そのものなので、書き出すのはそのハッシュ（player_id）だけ。
+  挑戦のIDもuuid以外（以前の通算の引き継ぎ "legacy-<セッションID>" など）は戻せない値に置き換える
+- 生成ダンジョンはIDが区間ごとに違うので、まとめて dungeon=generated に入れる
+
+pyarrow が必要（requirements.txt に含まれている）。読み込みは pyarrow.dataset.dataset(<出力先>/runs, partitioning="hive") など。
+
+使い方:
+    python export.py <出力先> [batch_size]    前回の続きから書き出す
+    python export.py bench [runs]            一時DBで書き出しの速度と最大メモリを測る
+"""
+import hashlib
+import heapq
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import codec
+import database
+from generator import GENERATED_PREFIX
+from storage import LEGACY_RUN_PREFIX, ShardedSQLiteBackend, SQLiteBackend, StorageBackend
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # 書き出しのときだけ必要
+    pa = pq = None
+
+# 1回に読み込み・書き出す行数（メモリに持つのはおよそこの行数分のみ）
+BATCH_SIZE = 5000
+# 書き込み中のトランザクションの行を読み飛ばさないよう、この秒数より前に完了・更新した行だけを書き出す
+EXPORT_LAG = 5
+WATERMARK_FILE = "_watermark.json"
+GENERATED_PARTITION = "generated"
+# イベントを run_id で引くときのIN句の大きさ
+RUN_ID_CHUNK = 500
+# そのまま書き出してよい挑戦ID（models.GameState.run_id の uuid4().hex）
+_UUID_HEX = re.compile(r"^[0-9a-f]{32}$")
+
+RUNS_QUERY = """
+    SELECT r.finished_at, r.run_id, r.session_id, u.player_class, r.dungeon_id, r.trades, r.sells, r.wins,
+           r.profit_loss, r.profit_loss_percent, r.carried_over
+    FROM runs r LEFT JOIN users u ON u.session_id = r.session_id
+    WHERE r.finished_at >= ? AND (r.finished_at > ? OR r.run_id > ?) AND r.finished_at < ?
+    ORDER BY r.finished_at, r.run_id LIMIT ?
+"""
+PROFILES_QUERY = """
+    SELECT updated_at, session_id, data FROM users
+    WHERE updated_at >= ? AND (updated_at > ? OR session_id > ?) AND updated_at < ?
+    ORDER BY updated_at, session_id LIMIT ?
+"""
+
+
+def player_id(session_id: str) -> str:
+    """書き出し用のプレイヤーID（セッションIDからは戻せない）"""
+    return hashlib.sha256(session_id.encode()).hexdigest()[:16]
+
+
+def export_run_id(run_id: str, session_id: str) -> str:
+    """書き出し用の挑戦ID（GameStateが振るuuid以外は、セッションIDを含みうるので戻せない値にする）"""
+    if _UUID_HEX.match(run_id):
+        return run_id
+    if run_id.startswith(LEGACY_RUN_PREFIX):
+        # 以前の通算の引き継ぎはプレイヤーごとに1件
+        return f"{LEGACY_RUN_PREFIX}{player_id(session_id)}"
+    return hashlib.sha256(run_id.encode()).hexdigest()[:32]
+
+
+def dungeon_partition(dungeon_id: str) -> str:
+    if dungeon_id.startswith(GENERATED_PREFIX):
+        return GENERATED_PARTITION
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", dungeon_id)
+
+
+def _schemas() -> Dict[str, "pa.Schema"]:
+    return {
+        "runs": pa.schema([
+            ("run_id", pa.string()), ("player_id", pa.string()), ("player_class", pa.string()),
+            ("dungeon_id", pa.string()), ("trades", pa.int64()), ("sells", pa.int64()), ("wins", pa.int64()),
+            ("profit_loss", pa.float64()), ("profit_loss_percent", pa.float64()),
+            ("carried_over", pa.bool_()), ("finished_at", pa.timestamp("s")),
+        ]),
+        "trades": pa.schema([
+            ("run_id", pa.string()), ("player_id", pa.string()), ("player_class", pa.string()),
+            ("dungeon_id", pa.string()), ("seq", pa.int64()), ("day", pa.int64()), ("action", pa.string()),
+            ("asset", pa.int64()), ("symbol", pa.string()), ("price", pa.float64()), ("shares", pa.int64()),
+            ("profit", pa.float64()), ("finished_at", pa.timestamp("s")),
+        ]),
+        "profiles": pa.schema([
+            ("player_id", pa.string()), ("player_class", pa.string()), ("level", pa.int64()),
+            ("xp", pa.int64()), ("gold", pa.int64()), ("total_profit", pa.float64()),
+            ("total_trades", pa.int64()), ("win_rate", pa.float64()),
+            ("completed_dungeons", pa.list_(pa.string())), ("equipped_indicators", pa.list_(pa.string())),
+            ("updated_at", pa.timestamp("s")),
+        ]),
+    }
+
+
+def sqlite_backends(backend: StorageBackend) -> List[SQLiteBackend]:
+    """書き出し元のSQLiteファイル（シャーディング時は全シャード）"""
+    if isinstance(backend, ShardedSQLiteBackend):
+        # 再分散の途中なら、まだ移動していない行が残っている以前のシャードも読む
+        if backend.previous_ring:
+            for index in range(backend.previous_ring.n_shards):
+                backend._shard(index)
+        return [backend.shards[index] for index in sorted(backend.shards)]
+    if isinstance(backend, SQLiteBackend):
+        return [backend]
+    raise ValueError(f"Export needs SQLite storage (got {type(backend).__name__})")
+
+
+def _scan(source: SQLiteBackend, query: str, low: Sequence[str], high: str,
+          batch_size: int) -> Iterator[sqlite3.Row]:
+    """1ファイルの行をキー順に batch_size 件ずつ読む（ページごとに接続し直し、長い読み取りを持たない）"""
+    last_ts, last_id = low
+    while True:
+        conn = source.connect()
+        rows = conn.execute(query, (last_ts, last_ts, last_id, high, batch_size)).fetchall()
+        conn.close()
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        last_ts, last_id = rows[-1][0], rows[-1][1]
+
+
+def scan_batches(sources: List[SQLiteBackend], query: str, low: Sequence[str], high: str,
+                 batch_size: int) -> Iterator[List[Tuple[int, sqlite3.Row]]]:
+    """全ファイルの行をキー順にマージし、(ファイルの番号, 行) を batch_size 件ずつ返す
+
+    再分散の途中で同じ行が2つのシャードにあれば1つだけ返す。
+    """
+    def numbered(index: int, source: SQLiteBackend):
+        for row in _scan(source, query, low, high, batch_size):
+            yield index, row
+
+    streams = [numbered(index, source) for index, source in enumerate(sources)]
+    batch: List[Tuple[int, sqlite3.Row]] = []
+    previous_key = None
+    for index, row in heapq.merge(*streams, key=lambda item: (item[1][0], item[1][1])):
+        key = (row[0], row[1])
+        if key == previous_key:
+            continue
+        previous_key = key
+        batch.append((index, row))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _timestamp(value: str) -> datetime:
+    return datetime.fromisoformat(value)
+
+
+def run_rows(batch: List[Tuple[int, sqlite3.Row]]) -> List[Dict[str, Any]]:
+    # 以前の通算を引き継いだ行は売り・勝ちが分からないので空にする
+    return [{
+        "run_id": export_run_id(row["run_id"], row["session_id"]),
+        "player_id": player_id(row["session_id"]),
+        "player_class": row["player_class"],
+        "dungeon_id": row["dungeon_id"],
+        "trades": row["trades"],
+        "sells": None if row["carried_over"] else row["sells"],
+        "wins": None if row["carried_over"] else row["wins"],
+        "profit_loss": row["profit_loss"],
+        "profit_loss_percent": row["profit_loss_percent"],
+        "carried_over": bool(row["carried_over"]),
+        "finished_at": _timestamp(row["finished_at"]),
+    } for _, row in batch]
+
+
+def trade_rows(sources: List[SQLiteBackend], batch: List[Tuple[int, sqlite3.Row]],
+               runs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """バッチの挑戦のトレードをイベントログから読む（挑戦と同じシャードにある）
+
+    runs は run_rows(batch) の結果（batch と同じ順）。
+    """
+    run_ids: Dict[int, List[str]] = {}
+    for index, row in batch:
+        run_ids.setdefault(index, []).append(row["run_id"])
+    # DBの run_id -> 書き出す挑戦の行
+    by_run = {row["run_id"]: run for (_, row), run in zip(batch, runs)}
+
+    trades = []
+    for index, ids in run_ids.items():
+        conn = sources[index].connect()
+        for start in range(0, len(ids), RUN_ID_CHUNK):
+            chunk = ids[start:start + RUN_ID_CHUNK]
+            for event_row in conn.execute(f"""
+                SELECT run_id, seq, data FROM game_events WHERE run_id IN ({", ".join("?" for _ in chunk)})
+                ORDER BY run_id, seq
+            """, chunk):
+                event = codec.loads(event_row["data"])
+                if event.get("type") != "trade":
+                    continue
+                run = by_run[event_row["run_id"]]
+                trades.append({
+                    "run_id": run["run_id"],
+                    "player_id": run["player_id"],
+                    "player_class": run["player_class"],
+                    "dungeon_id": run["dungeon_id"],
+                    "seq": event_row["seq"],
+                    "day": event["day"],
+                    "action": event["action"],
+                    "asset": event.get("asset"),
+                    "symbol": event.get("symbol"),
+                    "price": event["price"],
+                    "shares": event["shares"],
+                    "profit": event.get("profit"),
+                    "finished_at": run["finished_at"],
+                })
+        conn.close()
+    return trades
+
+
+def profile_rows(batch: List[Tuple[int, sqlite3.Row]]) -> List[Dict[str, Any]]:
+    rows = []
+    for _, row in batch:
+        try:
+            profile = codec.decode_user(row["data"])
+        except Exception as e:
+            print(f"Error parsing user profile: {e}")
+            continue
+        rows.append({
+            "player_id": player_id(row["session_id"]),
+            "player_class": profile.player_class,
+            "level": profile.level,
+            "xp": profile.xp,
+            "gold": profile.gold,
+            "total_profit": profile.total_profit,
+            "total_trades": profile.total_trades,
+            "win_rate": profile.win_rate,
+            "completed_dungeons": profile.completed_dungeons,
+            "equipped_indicators": [ind["id"] for ind in profile.indicators if ind.get("equipped")],
+            "updated_at": _timestamp(row["updated_at"]),
+        })
+    return rows
+
+
+def write_partitions(out_dir: str, table: str, rows: List[Dict[str, Any]], time_field: str,
+                     part_name: str, by_dungeon: bool = True) -> int:
+    """行をパーティションごとに1ファイルずつ書き出し、書いたファイル数を返す"""
+    # パーティション名はダンジョンIDごと、パスは (ダンジョン, 日付) ごとに一度だけ作る
+    names: Dict[str, str] = {}
+    partitions: Dict[Tuple[Optional[str], Any], List[Dict[str, Any]]] = {}
+    for row in rows:
+        dungeon = None
+        if by_dungeon:
+            dungeon = names.get(row["dungeon_id"])
+            if dungeon is None:
+                dungeon = names[row["dungeon_id"]] = dungeon_partition(row["dungeon_id"])
+        partitions.setdefault((dungeon, row[time_field].date()), []).append(row)
+
+    schema = _schemas()[table]
+    for (dungeon, date), part in partitions.items():
+        path = f"date={date:%Y-%m-%d}"
+        if dungeon is not None:
+            path = os.path.join(f"dungeon={dungeon}", path)
+        directory = os.path.join(out_dir, table, path)
+        os.makedirs(directory, exist_ok=True)
+        file_path = os.path.join(directory, part_name)
+        tmp_path = f"{file_path}.tmp"
+        pq.write_table(pa.Table.from_pylist(part, schema=schema), tmp_path, compression="zstd")
+        os.replace(tmp_path, file_path)
+    return len(partitions)
+
+
+def _part_name(batch: List[Tuple[int, sqlite3.Row]]) -> str:
+    """バッチの行の範囲から決まるファイル名（同じ範囲を書き直すと上書きになる）"""
+    first, last = batch[0][1], batch[-1][1]
+    digest = hashlib.sha1(f"{first[0]}|{first[1]}|{last[0]}|{last[1]}".encode()).hexdigest()[:12]
+    return f"part-{re.sub(r'[^0-9]', '', first[0])}-{digest}.parquet"
+
+
+def load_watermark(out_dir: str) -> Dict[str, List[str]]:
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return codec.loads(f.read())
+
+
+def save_watermark(out_dir: str, watermark: Dict[str, List[str]]):
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(codec.dumps(watermark))
+    os.replace(tmp_path, path)
+
+
+def export(out_dir: str, backend: Optional[StorageBackend] = None, batch_size: int = BATCH_SIZE,
+           now: Optional[float] = None) -> Dict[str, int]:
+    """前回の続きから書き出し、テーブルごとの行数とファイル数を返す"""
+    if pq is None:
+        raise RuntimeError("pyarrow is required for Parquet export (pip install -r requirements.txt)")
+    if backend is None:
+        backend = database.create_backend()
+        backend.init()
+    sources = sqlite_backends(backend)
+    os.makedirs(out_dir, exist_ok=True)
+    watermark = load_watermark(out_dir)
+    # storage の時刻は CURRENT_TIMESTAMP（UTC）
+    high = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime((now or time.time()) - EXPORT_LAG))
+    counts = {"runs": 0, "trades": 0, "profiles": 0, "files": 0}
+
+    for table, query in (("runs", RUNS_QUERY), ("profiles", PROFILES_QUERY)):
+        for batch in scan_batches(sources, query, watermark.get(table, ("", "")), high, batch_size):
+            part_name = _part_name(batch)
+            if table == "runs":
+                runs = run_rows(batch)
+                trades = trade_rows(sources, batch, runs)
+                counts["files"] += write_partitions(out_dir, "runs", runs, "finished_at", part_name)
+                counts["files"] += write_partitions(out_dir, "trades", trades, "finished_at", part_name)
+                counts["runs"] += len(runs)
+                counts["trades"] += len(trades)
+            else:
+                profiles = profile_rows(batch)
+                counts["files"] += write_partitions(out_dir, "profiles", profiles, "updated_at", part_name,
+                                                    by_dungeon=False)
+                counts["profiles"] += len(profiles)
+            last = batch[-1][1]
+            watermark[table] = [last[0], last[1]]
+            save_watermark(out_dir, watermark)
+        # 次回は high ちょうどの行から（IDは空文字より大きいので全部含まれる）
+        watermark[table] = [high, ""]
+        save_watermark(out_dir, watermark)
+    return counts
+
+
+def bench(n_runs: int = 20000, trades_per_run: int = 10):
+    """一時DBに挑戦とトレードを作り、バッチの大きさごとに書き出しの時間と最大メモリを測る"""
+    import shutil
+    import tracemalloc
+    import uuid
+
+    from models import INITIAL_INDICATORS, UserProfile
+
+    directory = tempfile.mkdtemp()
+    source = SQLiteBackend(os.path.join(directory, "bench.db"))
+    source.init()
+    conn = source.connect()
+    dungeons = ["tutorial-1", "forest-1", "castle-1", "gen-7203_t-20200302-120"]
+    classes = ["hero", "rogue", "wizard", "knight"]
+    with conn:
+        for i in range(n_runs // 4):
+            session_id = str(uuid.uuid4())
+            profile = UserProfile(player_class=classes[i % 4], level=5 + i % 20, indicators=INITIAL_INDICATORS)
+            conn.execute("INSERT INTO users (session_id, data, updated_at) VALUES (?, ?, ?)",
+                         (session_id, codec.encode_user(profile), f"2026-10-{1 + i % 28:02d} 12:00:00"))
+            for j in range(4):
+                run_id = str(uuid.uuid4())
+                conn.execute("""
+                    INSERT INTO runs (run_id, session_id, dungeon_id, trades, sells, wins, profit_loss,
+                                      profit_loss_percent, finished_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (run_id, session_id, dungeons[(i + j) % 4], trades_per_run, trades_per_run // 2, 1,
+                      123.0, 1.2, f"2026-10-{1 + (i + j) % 28:02d} {j:02d}:00:00"))
+                conn.executemany("INSERT INTO game_events (session_id, run_id, seq, data) VALUES (?, ?, ?, ?)", [
+                    (session_id, run_id, seq, codec.dumps({
+                        "type": "trade", "seq": seq, "day": seq * 3, "action": "buy" if seq % 2 else "sell",
+                        "price": 1000.0 + seq, "shares": 10, **({} if seq % 2 else {"profit": 5.0})}))
+                    for seq in range(1, trades_per_run + 1)
+                ])
+    conn.close()
+
+    print(f"{n_runs:,} runs, {n_runs * trades_per_run:,} trades, {n_runs // 4:,} profiles")
+    for batch_size in (1000, 5000, 20000):
+        out_dir = tempfile.mkdtemp()
+        tracemalloc.start()
+        started = time.perf_counter()
+        counts = export(out_dir, source, batch_size, now=time.mktime((2026, 11, 1, 0, 0, 0, 0, 0, 0)))
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        again = export(out_dir, source, batch_size, now=time.mktime((2026, 11, 1, 0, 0, 0, 0, 0, 0)))
+        print(f"  batch {batch_size:>6,}: {elapsed:6.2f} s, peak {peak / 1e6:6.1f} MB (Python heap), "
+              f"{counts['files']:,} files, rerun exported {again['runs'] + again['profiles']} rows")
+        shutil.rmtree(out_dir)
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    try:
+        if sys.argv[1] == "bench":
+            bench(int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
+        else:
+            counts = export(sys.argv[1], batch_size=int(sys.argv[2]) if len(sys.argv) > 2 else BATCH_SIZE)
+            print(f"exported {counts['runs']:,} runs, {counts['trades']:,} trades, "
+                  f"{counts['profiles']:,} profiles ({counts['files']:,} files)")
+    except (RuntimeError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
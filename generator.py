@@ -0,0 +1,388 @@
+"""ランダム生成ダンジョン（時空の裂け目）
+
+固定の DUNGEONS を遊び尽くしたプレイヤー向けに、ローカルに保存した数十年分の日足から
+(銘柄, 開始日, 日数) の区間をランダムに選んでダンジョンにする。
+
+- 日足は銘柄ごとに HISTORY_DIR/<slug>.npz に保存する（yfinanceの全期間、またはCSVから取り込み）
+- 区間の長さ（WINDOW_LENGTHS）ごとに、すべての開始日の年率ボラティリティと最大下落率を
+  まとめて計算し、値の順に並べた索引（HISTORY_DIR/index.npz）にしておく
+- 難易度の指定は「索引の何%〜何%の区間」になるので、条件に合う区間を探して試行錯誤することはなく、
+  並べた順序からランダムに1つ選ぶだけ
+
+ダンジョンIDは "gen-<slug>-<開始日>-<日数>"（年率ボラティリティで選んだ区間は末尾に "-volatility"）で、
+IDだけからダンジョンを復元できる（DBに保存しない）。難易度・推奨レベル・報酬は、区間を選んだときと
+同じ指標の順位から決める。
+生成ダンジョンの結果はランキング・クリア記録・評価基準の対象外。
+
+使い方:
+    python generator.py import <symbol>...           yfinanceから全期間の日足を取り込んで索引を作り直す
+    python generator.py import-csv <symbol> <csv>    CSV（Date,Open,High,Low,Close,Volume）から取り込む
+    python generator.py index                        索引を作り直す
+    python generator.py sample [difficulty] [days]   区間を選んで表示
+    python generator.py bench [count]                生成してプレイ開始できるまでの時間を計測
+"""
+import os
+import re
+import sys
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+from models import DUNGEONS, compute_indicators, dataframe_to_records
+
+HISTORY_DIR = "history"
+INDEX_FILE = "index.npz"
+GENERATED_PREFIX = "gen-"
+
+# 生成する区間の長さ（営業日）
+WINDOW_LENGTHS = (60, 120, 250)
+DEFAULT_WINDOW_LENGTH = 120
+# 区間の前に指標の計算用に読み込む本数（sma_75 が初日から表示されるように）
+WARMUP_BARS = 75
+TRADING_DAYS_PER_YEAR = 252
+# 開始資金で1株も買えない区間は生成しない（GameState.cash の初期値）
+STARTING_CASH = 10000.0
+
+# 難易度を決める指標と、難易度ごとの索引上の位置（下位から何割〜何割）
+DIFFICULTY_METRICS = ("drawdown", "volatility")
+DIFFICULTY_BANDS = {
+    "easy": (0.0, 0.4),
+    "normal": (0.4, 0.75),
+    "hard": (0.75, 0.95),
+    "legendary": (0.95, 1.0),
+}
+# 難易度ごとの推奨レベルと報酬（固定ダンジョンより控えめにする）
+GENERATED_LEVELS = {"easy": 1, "normal": 3, "hard": 10, "legendary": 15}
+GENERATED_REWARDS = {
+    "easy": (100, 500),
+    "normal": (200, 1000),
+    "hard": (1000, 5000),
+    "legendary": (2500, 25000),
+}
+
+# 末尾の指標を省略したIDは最大下落率（以前のIDも最大下落率で難易度を決めていた）
+DEFAULT_METRIC = "drawdown"
+_ID_PATTERN = re.compile(
+    rf"^{GENERATED_PREFIX}([a-z0-9_]+)-(\d{{8}})-(\d+)(?:-({'|'.join(DIFFICULTY_METRICS)}))?$")
+
+
+def symbol_slug(symbol: str) -> str:
+    """銘柄コードをファイル名とダンジョンIDに使える形にする（"^N225" -> "n225", "7203.T" -> "7203_t"）"""
+    return re.sub(r"[^a-z0-9]+", "_", symbol.lower()).strip("_")
+
+
+def _history_path(slug: str) -> str:
+    return os.path.join(HISTORY_DIR, f"{slug}.npz")
+
+
+def import_history(symbol: str, df: pd.DataFrame) -> int:
+    """OHLCVのDataFrameを銘柄の日足として保存し、保存した本数を返す"""
+    df = df.dropna(subset=["Open", "High", "Low", "Close"])
+    if df.empty:
+        return 0
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    dates = pd.DatetimeIndex(df.index).tz_localize(None).values.astype("datetime64[D]")
+    path = _history_path(symbol_slug(symbol))
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, symbol=np.array(symbol), dates=dates,
+             **{column.lower(): df[column].to_numpy(dtype=np.float64)
+                for column in ("Open", "High", "Low", "Close", "Volume")})
+    os.replace(tmp_path, path)
+    load_history.cache_clear()
+    _generated_dungeon.cache_clear()
+    return len(df)
+
+
+def fetch_history(symbol: str) -> int:
+    """yfinanceから全期間の日足を取得して保存"""
+    try:
+        return import_history(symbol, yf.Ticker(symbol).history(period="max"))
+    except Exception as e:
+        print(f"Error fetching history for {symbol}: {e}")
+        return 0
+
+
+@lru_cache(maxsize=32)
+def load_history(slug: str) -> Optional[Dict[str, np.ndarray]]:
+    """保存済みの日足を読み込む（なければNone）"""
+    path = _history_path(slug)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def history_slugs() -> List[str]:
+    if not os.path.isdir(HISTORY_DIR):
+        return []
+    return sorted(name[:-len(".npz")] for name in os.listdir(HISTORY_DIR)
+                  if name.endswith(".npz") and name != INDEX_FILE)
+
+
+def window_stats(close: np.ndarray, length: int) -> Tuple[np.ndarray, np.ndarray]:
+    """長さlengthのすべての区間（開始位置順）の年率ボラティリティと最大下落率"""
+    returns = np.diff(np.log(close))
+    # 区間内の length-1 個の日次リターンの分散を累積和から求める
+    sums = np.concatenate(([0.0], np.cumsum(returns)))
+    squares = np.concatenate(([0.0], np.cumsum(returns ** 2)))
+    n = length - 1
+    mean = (sums[n:] - sums[:-n]) / n
+    variance = np.maximum((squares[n:] - squares[:-n]) / n - mean ** 2, 0.0)
+    volatility = np.sqrt(variance * TRADING_DAYS_PER_YEAR)
+
+    windows = np.lib.stride_tricks.sliding_window_view(close, length)
+    peaks = np.maximum.accumulate(windows, axis=1)
+    drawdown = (1 - windows / peaks).max(axis=1)
+    return volatility, drawdown
+
+
+def build_index() -> Dict[str, int]:
+    """保存済みの全銘柄から、区間の長さごとの索引を作って保存し、長さごとの区間数を返す"""
+    slugs = history_slugs()
+    arrays: Dict[str, np.ndarray] = {"slugs": np.array(slugs)}
+    counts = {}
+    for length in WINDOW_LENGTHS:
+        symbols, starts, volatilities, drawdowns = [], [], [], []
+        for symbol_index, slug in enumerate(slugs):
+            close = load_history(slug)["close"]
+            if len(close) < WARMUP_BARS + length:
+                continue
+            volatility, drawdown = window_stats(close, length)
+            start = np.arange(WARMUP_BARS, len(close) - length + 1)
+            # 初日に1株も買えない区間は遊べない
+            start = start[close[start] <= STARTING_CASH]
+            symbols.append(np.full(len(start), symbol_index, dtype=np.int16))
+            starts.append(start.astype(np.int32))
+            volatilities.append(volatility[start].astype(np.float32))
+            drawdowns.append(drawdown[start].astype(np.float32))
+
+        prefix = f"w{length}"
+        arrays[f"{prefix}_symbol"] = np.concatenate(symbols) if symbols else np.zeros(0, np.int16)
+        arrays[f"{prefix}_start"] = np.concatenate(starts) if starts else np.zeros(0, np.int32)
+        for metric, values in (("volatility", volatilities), ("drawdown", drawdowns)):
+            values = np.concatenate(values) if values else np.zeros(0, np.float32)
+            order = np.argsort(values, kind="stable").astype(np.int32)
+            arrays[f"{prefix}_by_{metric}"] = order
+            arrays[f"{prefix}_sorted_{metric}"] = values[order]
+        counts[length] = len(arrays[f"{prefix}_start"])
+
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    path = os.path.join(HISTORY_DIR, INDEX_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+    load_index.cache_clear()
+    return counts
+
+
+@lru_cache(maxsize=1)
+def load_index() -> Optional[Dict[str, np.ndarray]]:
+    """区間の索引を読み込む（まだ作られていなければNone）"""
+    path = os.path.join(HISTORY_DIR, INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def available() -> bool:
+    """生成できる区間があるかどうか"""
+    index = load_index()
+    return index is not None and any(len(index[f"w{length}_start"]) for length in WINDOW_LENGTHS)
+
+
+def _band_ranks(difficulty: Optional[str], count: int) -> Tuple[int, int]:
+    """難易度の範囲に入る順位 [first, last)（指定がなければ全体）"""
+    low, high = DIFFICULTY_BANDS.get(difficulty, (0.0, 1.0))
+    first = min(int(low * count), count - 1)
+    return first, max(int(high * count), first + 1)
+
+
+def sample_window(length: int = DEFAULT_WINDOW_LENGTH, difficulty: Optional[str] = None,
+                  metric: str = DEFAULT_METRIC, rng: Optional[np.random.Generator] = None) -> Optional[Tuple[str, int]]:
+    """区間をランダムに選び (slug, 開始位置) を返す（該当する区間がなければNone）
+
+    difficulty を指定すると、metric の値の順に並べた索引の DIFFICULTY_BANDS の範囲から選ぶ。
+    """
+    index = load_index()
+    if index is None or length not in WINDOW_LENGTHS or metric not in DIFFICULTY_METRICS:
+        return None
+    prefix = f"w{length}"
+    order = index[f"{prefix}_by_{metric}"]
+    if len(order) == 0:
+        return None
+    first, last = _band_ranks(difficulty, len(order))
+    rng = rng or np.random.default_rng()
+    position = order[rng.integers(first, last)]
+    slug = str(index["slugs"][index[f"{prefix}_symbol"][position]])
+    return slug, int(index[f"{prefix}_start"][position])
+
+
+def _window_rank(slug: str, start: int, length: int, metric: str) -> Optional[int]:
+    """区間が索引の中で metric の値の順に何番目か（索引になければNone）"""
+    index = load_index()
+    if index is None:
+        return None
+    prefix = f"w{length}"
+    symbol = np.flatnonzero(index["slugs"] == slug)
+    if len(symbol) == 0:
+        return None
+    position = np.flatnonzero((index[f"{prefix}_symbol"] == symbol[0]) & (index[f"{prefix}_start"] == start))
+    if len(position) == 0:
+        return None
+    return int(np.flatnonzero(index[f"{prefix}_by_{metric}"] == position[0])[0])
+
+
+def classify(length: int, metric: str, value: float, rank: Optional[int] = None) -> str:
+    """区間が索引の中でどの難易度の範囲にあるか
+
+    rank には sample_window が選ぶのと同じ索引の順位を渡す。値から順位を求め直すと、
+    同じ値の区間や float32 への丸めで隣の範囲に入ることがあるので、値は索引にない区間にだけ使う。
+    """
+    index = load_index()
+    sorted_values = index[f"w{length}_sorted_{metric}"] if index else np.zeros(0)
+    if len(sorted_values) == 0:
+        return "normal"
+    if rank is None:
+        rank = int(np.searchsorted(sorted_values, np.float32(value), side="left"))
+    for difficulty in DIFFICULTY_BANDS:
+        if rank < _band_ranks(difficulty, len(sorted_values))[1]:
+            return difficulty
+    return "legendary"
+
+
+def dungeon_id_for(slug: str, start: int, length: int, metric: str = DEFAULT_METRIC) -> str:
+    dates = load_history(slug)["dates"]
+    suffix = "" if metric == DEFAULT_METRIC else f"-{metric}"
+    return f"{GENERATED_PREFIX}{slug}-{pd.Timestamp(dates[start]):%Y%m%d}-{length}{suffix}"
+
+
+def is_generated(dungeon: Dict) -> bool:
+    return dungeon.get("generated", False)
+
+
+def find_dungeon(dungeon_id: str) -> Optional[Dict]:
+    """固定ダンジョンまたは生成ダンジョンをIDから取得"""
+    dungeon = next((d for d in DUNGEONS if d["id"] == dungeon_id), None)
+    if dungeon is None and dungeon_id.startswith(GENERATED_PREFIX):
+        dungeon = _generated_dungeon(dungeon_id)
+    return dungeon
+
+
+def _parse_id(dungeon_id: str) -> Optional[Tuple[str, int, int, str]]:
+    """生成ダンジョンのIDを (slug, 開始位置, 日数, 難易度の指標) にする（該当する区間がなければNone）"""
+    match = _ID_PATTERN.match(dungeon_id)
+    if not match:
+        return None
+    slug, start_date, length = match.group(1), match.group(2), int(match.group(3))
+    metric = match.group(4) or DEFAULT_METRIC
+    history = load_history(slug)
+    if history is None or length not in WINDOW_LENGTHS:
+        return None
+    dates = history["dates"]
+    start = int(np.searchsorted(dates, np.datetime64(pd.Timestamp(start_date).date(), "D")))
+    if start >= len(dates) or dates[start] != np.datetime64(pd.Timestamp(start_date).date(), "D"):
+        return None
+    if start < WARMUP_BARS or start + length > len(dates) or history["close"][start] > STARTING_CASH:
+        return None
+    return slug, start, length, metric
+
+
+@lru_cache(maxsize=256)
+def _generated_dungeon(dungeon_id: str) -> Optional[Dict]:
+    parsed = _parse_id(dungeon_id)
+    if parsed is None:
+        return None
+    slug, start, length, metric = parsed
+    history = load_history(slug)
+    close = history["close"][start:start + length]
+    volatility, drawdown = (values[0] for values in window_stats(close, length))
+    # 区間を選んだ指標の索引の順位で分類する（別の指標や値から求め直した順位では、選んだ難易度と表示・報酬・推奨レベルが食い違う）
+    difficulty = classify(length, metric, volatility if metric == "volatility" else drawdown,
+                          _window_rank(slug, start, length, metric))
+    xp_reward, gold_reward = GENERATED_REWARDS[difficulty]
+    # 報酬は区間の長さに比例させる
+    scale = length / DEFAULT_WINDOW_LENGTH
+    first, last = pd.Timestamp(history["dates"][start]), pd.Timestamp(history["dates"][start + length - 1])
+    symbol = str(history["symbol"])
+    return {
+        "id": dungeon_id,
+        "name": f"時空の裂け目（{symbol} {first.year}年{first.month}月）",
+        "stock_symbol": symbol,
+        "start_date": f"{first:%Y-%m-%d}",
+        "end_date": f"{last:%Y-%m-%d}",
+        "resolution": "1d",
+        "difficulty": difficulty,
+        "recommended_level": GENERATED_LEVELS[difficulty],
+        "xp_reward": int(xp_reward * scale),
+        "gold_reward": int(gold_reward * scale),
+        "description": f"{symbol}の{first:%Y/%m/%d}から{length}営業日。"
+                       f"最大下落率{drawdown:.0%}、年率ボラティリティ{volatility:.0%}の時空に迷い込んだ。",
+        "generated": True,
+    }
+
+
+@lru_cache(maxsize=64)
+def _stock_records(dungeon_id: str) -> Tuple[Dict, ...]:
+    slug, start, length, _ = _parse_id(dungeon_id)
+    history = load_history(slug)
+    # 指標は区間の前の WARMUP_BARS 本から計算して、区間の初日から表示できるようにする
+    window = slice(start - WARMUP_BARS, start + length)
+    df = pd.DataFrame({column.capitalize(): history[column][window]
+                       for column in ("open", "high", "low", "close", "volume")},
+                      index=pd.DatetimeIndex(history["dates"][window]))
+    return tuple(dataframe_to_records(compute_indicators(df))[WARMUP_BARS:])
+
+
+def load_stock_data(dungeon: Dict) -> List[Dict]:
+    """生成ダンジョンの日足（指標つき）を取得"""
+    # 共有しているキャッシュをセッションごとに書き換えないようコピーを返す
+    return [dict(bar) for bar in _stock_records(dungeon["id"])]
+
+
+def generate(length: int = DEFAULT_WINDOW_LENGTH, difficulty: Optional[str] = None,
+             metric: str = DEFAULT_METRIC) -> Optional[Dict]:
+    """区間をランダムに選んでダンジョンを作る（生成できる区間がなければNone）"""
+    window = sample_window(length, difficulty, metric)
+    if window is None:
+        return None
+    return find_dungeon(dungeon_id_for(window[0], window[1], length, metric))
+
+
+if __name__ == "__main__":
+    command, args = (sys.argv[1], sys.argv[2:]) if len(sys.argv) > 1 else ("", [])
+    if command == "import" and args:
+        for symbol in args:
+            print(f"{symbol}: {fetch_history(symbol):,} bars")
+        print(f"windows: {build_index()}")
+    elif command == "import-csv" and len(args) == 2:
+        df = pd.read_csv(args[1], index_col=0, parse_dates=True)
+        print(f"{args[0]}: {import_history(args[0], df):,} bars")
+        print(f"windows: {build_index()}")
+    elif command == "index":
+        print(f"windows: {build_index()}")
+    elif command == "sample":
+        dungeon = generate(int(args[1]) if len(args) > 1 else DEFAULT_WINDOW_LENGTH, args[0] if args else None)
+        print(dungeon or "no history imported (python generator.py import <symbol>)")
+    elif command == "bench":
+        count = int(args[0]) if args else 200
+        difficulties = list(DIFFICULTY_BANDS)
+        timings = []
+        for i in range(count):
+            started = time.perf_counter()
+            dungeon = generate(WINDOW_LENGTHS[i % len(WINDOW_LENGTHS)], difficulties[i % len(difficulties)])
+            if dungeon is None:
+                print("no history imported (python generator.py import <symbol>)")
+                sys.exit(1)
+            load_stock_data(dungeon)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        print(f"generate + load {count} dungeons: median {timings[len(timings) // 2]:.1f} ms, "
+              f"p95 {timings[int(len(timings) * 0.95)]:.1f} ms, max {timings[-1]:.1f} ms")
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,229 @@
+"""逐次計算できるテクニカル指標
+
+fetch_stock_data はpandasの rolling / ewm で全期間を一括計算するが、未来の足が
+決まっていないダンジョン（自動生成など）ではそれができない。ここでは新しい足が
+届くたびにO(1)で更新できる指標の状態オブジェクトを提供する。
+
+各状態はpydanticモデルなので、そのままゲーム状態に埋め込んで保存できる。
+計算式は models.compute_indicators と同じ（SMA・RSIは単純移動平均、
+MACDは adjust=False のEMA、ボリンジャーバンドは標本標準偏差）。
+"""
+import math
+from typing import List, Dict, Optional, Any
+
+from pydantic import BaseModel, Field
+
+
+class RollingStats(BaseModel):
+    """固定長ウィンドウの平均と分散（リングバッファ＋Welford法）"""
+    size: int
+    values: List[float] = []
+    pos: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+
+    def push(self, x: float):
+        """値を追加（ウィンドウが満杯なら最古の値を置き換える）"""
+        if len(self.values) < self.size:
+            self.values.append(x)
+            delta = x - self.mean
+            self.mean += delta / len(self.values)
+            self.m2 += delta * (x - self.mean)
+            return
+
+        old = self.values[self.pos]
+        self.values[self.pos] = x
+        self.pos = (self.pos + 1) % self.size
+
+        if self.pos == 0:
+            # 一周ごとに厳密値で置き直し、丸め誤差の蓄積を防ぐ（償却O(1)）
+            self.mean = math.fsum(self.values) / self.size
+            self.m2 = math.fsum((v - self.mean) ** 2 for v in self.values)
+            return
+
+        old_mean = self.mean
+        self.mean += (x - old) / self.size
+        self.m2 += (x - old) * (x - self.mean + old - old_mean)
+
+    def full(self) -> bool:
+        return len(self.values) == self.size
+
+    def average(self) -> Optional[float]:
+        return self.mean if self.full() else None
+
+    def std(self) -> Optional[float]:
+        """標本標準偏差（pandasの rolling().std() と同じ ddof=1）"""
+        if not self.full() or self.size < 2:
+            return None
+        return math.sqrt(max(self.m2, 0.0) / (self.size - 1))
+
+
+class EMA(BaseModel):
+    """指数移動平均（pandasの ewm(span, adjust=False) と同じ）"""
+    span: int
+    value: Optional[float] = None
+
+    def update(self, x: float) -> float:
+        if self.value is None:
+            self.value = x
+        else:
+            alpha = 2 / (self.span + 1)
+            self.value = (1 - alpha) * self.value + alpha * x
+        return self.value
+
+
+class SMA(BaseModel):
+    """単純移動平均"""
+    window: int
+    stats: Optional[RollingStats] = None
+
+    def update(self, close: float) -> Optional[float]:
+        if self.stats is None:
+            self.stats = RollingStats(size=self.window)
+        self.stats.push(close)
+        return self.stats.average()
+
+
+class RSI(BaseModel):
+    """相対力指数（上昇幅・下落幅の単純移動平均による計算）"""
+    period: int = 14
+    prev_close: Optional[float] = None
+    gains: Optional[RollingStats] = None
+    losses: Optional[RollingStats] = None
+
+    def update(self, close: float) -> Optional[float]:
+        if self.gains is None:
+            self.gains = RollingStats(size=self.period)
+            self.losses = RollingStats(size=self.period)
+
+        # 最初の足の差分は0として扱う（pandasの where(delta > 0, 0) と同じ）
+        delta = 0.0 if self.prev_close is None else close - self.prev_close
+        self.prev_close = close
+        self.gains.push(delta if delta > 0 else 0.0)
+        self.losses.push(-delta if delta < 0 else 0.0)
+
+        gain = self.gains.average()
+        loss = self.losses.average()
+        if gain is None or loss is None:
+            return None
+        # 非負の値の平均なので、丸め誤差で負にならないようにする
+        gain, loss = max(gain, 0.0), max(loss, 0.0)
+        if loss == 0:
+            # 0/0はNaN、x/0は無限大（RSI=100）
+            return None if gain == 0 else 100.0
+        return 100 - (100 / (1 + gain / loss))
+
+
+class MACD(BaseModel):
+    """MACD (12, 26, 9)"""
+    fast: EMA = Field(default_factory=lambda: EMA(span=12))
+    slow: EMA = Field(default_factory=lambda: EMA(span=26))
+    signal: EMA = Field(default_factory=lambda: EMA(span=9))
+
+    def update(self, close: float) -> Dict[str, float]:
+        macd = self.fast.update(close) - self.slow.update(close)
+        signal = self.signal.update(macd)
+        return {"macd": macd, "macd_signal": signal, "macd_hist": macd - signal}
+
+
+class Bollinger(BaseModel):
+    """ボリンジャーバンド (20, 2σ)"""
+    window: int = 20
+    k: float = 2.0
+    stats: Optional[RollingStats] = None
+
+    def update(self, close: float) -> Dict[str, Optional[float]]:
+        if self.stats is None:
+            self.stats = RollingStats(size=self.window)
+        self.stats.push(close)
+        middle = self.stats.average()
+        std = self.stats.std()
+        if middle is None or std is None:
+            return {"bb_upper": None, "bb_middle": None, "bb_lower": None}
+        return {
+            "bb_upper": middle + std * self.k,
+            "bb_middle": middle,
+            "bb_lower": middle - std * self.k,
+        }
+
+
+class IndicatorState(BaseModel):
+    """stock_dataの全指標をまとめて逐次計算する状態"""
+    sma_25: SMA = Field(default_factory=lambda: SMA(window=25))
+    sma_75: SMA = Field(default_factory=lambda: SMA(window=75))
+    rsi_14: RSI = Field(default_factory=lambda: RSI(period=14))
+    macd: MACD = Field(default_factory=MACD)
+    bollinger: Bollinger = Field(default_factory=lambda: Bollinger(window=20, k=2.0))
+
+    def update(self, close: float) -> Dict[str, Optional[float]]:
+        """終値をひとつ追加し、丸める前の指標値を返す"""
+        values = {
+            "sma_25": self.sma_25.update(close),
+            "sma_75": self.sma_75.update(close),
+            "rsi_14": self.rsi_14.update(close),
+        }
+        values.update(self.macd.update(close))
+        values.update(self.bollinger.update(close))
+        return values
+
+    def enrich(self, bar: Dict[str, Any]) -> Dict[str, Any]:
+        """OHLCVの足に指標を付け、stock_data形式（小数2桁）にして返す"""
+        values = self.update(bar["close"])
+        enriched = dict(bar)
+        for key, value in values.items():
+            enriched[key] = None if value is None else round(value, 2)
+        return enriched
+
+
+def verify_against_batch(stock_data: List[Dict], tolerance: float = 1e-6) -> List[str]:
+    """逐次計算の結果がpandasの一括計算（compute_indicators）と一致するか検証
+
+    stock_dataのOHLCVからDataFrameを作り直して一括計算し、同じ終値列を
+    IndicatorStateに流した結果と丸める前の値で比較する。不一致の説明を返す。
+    """
+    import pandas as pd
+    from models import compute_indicators
+
+    df = pd.DataFrame({
+        "Open": [d["open"] for d in stock_data],
+        "High": [d["high"] for d in stock_data],
+        "Low": [d["low"] for d in stock_data],
+        "Close": [d["close"] for d in stock_data],
+        "Volume": [d["volume"] for d in stock_data],
+    })
+    df = compute_indicators(df)
+
+    mismatches = []
+    state = IndicatorState()
+    for i, close in enumerate(df["Close"]):
+        values = state.update(float(close))
+        for key, value in values.items():
+            expected = df[key].iloc[i]
+            if pd.isna(expected):
+                if value is not None:
+                    mismatches.append(f"day {i} {key}: expected None, got {value}")
+            elif value is None or abs(value - expected) > tolerance * max(1.0, abs(expected)):
+                mismatches.append(f"day {i} {key}: expected {expected}, got {value}")
+    return mismatches
+
+
+if __name__ == "__main__":
+    # 全ダンジョンで逐次計算と一括計算が一致することを確認する
+    import sys
+    from models import DUNGEONS, fetch_stock_data
+
+    failed = False
+    for dungeon in DUNGEONS:
+        if dungeon.get("resolution", "1d") != "1d":
+            continue
+        stock_data = fetch_stock_data(dungeon)
+        if not stock_data:
+            print(f"{dungeon['id']}: no data (skipped)")
+            continue
+        mismatches = verify_against_batch(stock_data)
+        status = "OK" if not mismatches else f"{len(mismatches)} mismatches"
+        print(f"{dungeon['id']}: {len(stock_data)} bars {status}")
+        for line in mismatches[:10]:
+            print(f"  {line}")
+        failed = failed or bool(mismatches)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,399 @@
+"""ダンジョンのランキング
+
+決算のたびに、そのダンジョンと総合（全ダンジョン）の自己ベストを profit_loss_percent で
+記録する。記録はSQLiteに保存し、順位付けはプロセス内の順序つき索引（インデックス付き
+スキップリスト）で行う。上位K件とプレイヤーの順位はどちらもO(log n)（上位K件は+K）で、
+全体を並べ替え直すことはない。
+
+クラス別（hero / rogue / sage）のランキングは同じ記録から別の索引を作る。
+他のプロセスの決算は、記録ごとに振った通し番号（seq）より新しい行だけを読み込んで反映する。
+削除したセッション（リセット・期限切れ）は、同じ通し番号を振った削除の記録（leaderboard_removed）で
+他のプロセスの索引からも取り除く。
+"""
+import math
+import random
+import sqlite3
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# 総合ランキングのスコープ名（それ以外のスコープはダンジョンID）
+GLOBAL_SCOPE = "global"
+# 他のプロセスの決算を読み込む間隔（秒）
+LEADERBOARD_SYNC_INTERVAL = 1.0
+# 表示する上位の件数
+TOP_K = 10
+# スキップリストの最大の高さ（2^32件まで）
+MAX_HEIGHT = 32
+
+# 次の通し番号（記録と削除で共通。最大の行を削除しても番号を使い回さない）
+NEXT_SEQ = """(SELECT MAX(COALESCE((SELECT MAX(seq) FROM leaderboard), 0),
+                   COALESCE((SELECT MAX(seq) FROM leaderboard_removed), 0)) + 1)"""
+# 決算が自己ベストを更新したか（ON CONFLICT の中で使う）
+IMPROVED = "excluded.score > leaderboard.score"
+
+
+class _Infinity:
+    """どのキーよりも大きい番兵"""
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return other is self
+
+    def __gt__(self, other):
+        return other is not self
+
+    def __ge__(self, other):
+        return True
+
+
+_INFINITY = _Infinity()
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key: Any, height: int):
+        self.key = key
+        self.next: List[Optional["_Node"]] = [None] * height
+        # next[level] までに飛ばす要素数
+        self.width = [1] * height
+
+
+class RankedSet:
+    """順位を引ける順序つき集合（インデックス付きスキップリスト）
+
+    追加・削除・順位（自分より小さいキーの数）・k番目の取得がO(log n)。
+    """
+
+    def __init__(self, seed: Optional[int] = None):
+        self._random = random.Random(seed)
+        self._tail = _Node(_INFINITY, 0)
+        self._head = _Node(None, MAX_HEIGHT)
+        self._head.next = [self._tail] * MAX_HEIGHT
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _height(self) -> int:
+        # 高さhになる確率は 1/2^h
+        return min(MAX_HEIGHT, 1 - int(math.log(1.0 - self._random.random(), 2.0)))
+
+    def add(self, key: Any):
+        chain = [self._head] * MAX_HEIGHT
+        steps_at_level = [0] * MAX_HEIGHT
+        node = self._head
+        for level in reversed(range(MAX_HEIGHT)):
+            while node.next[level].key <= key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        height = self._height()
+        new = _Node(key, height)
+        steps = 0
+        for level in range(height):
+            previous = chain[level]
+            new.next[level] = previous.next[level]
+            previous.next[level] = new
+            new.width[level] = previous.width[level] - steps
+            previous.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(height, MAX_HEIGHT):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key: Any):
+        chain = [self._head] * MAX_HEIGHT
+        node = self._head
+        for level in reversed(range(MAX_HEIGHT)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        target = chain[0].next[0]
+        if target is self._tail or target.key != key:
+            raise KeyError(key)
+
+        for level in range(len(target.next)):
+            previous = chain[level]
+            previous.width[level] += target.width[level] - 1
+            previous.next[level] = target.next[level]
+        for level in range(len(target.next), MAX_HEIGHT):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key: Any) -> int:
+        """keyより小さいキーの数（0始まりの順位）"""
+        position = 0
+        node = self._head
+        for level in reversed(range(MAX_HEIGHT)):
+            while node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        return position
+
+    def __getitem__(self, index: int) -> Any:
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        node = self._head
+        remaining = index + 1
+        for level in reversed(range(MAX_HEIGHT)):
+            while node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        return node.key
+
+    def __iter__(self) -> Iterator[Any]:
+        node = self._head.next[0]
+        while node is not self._tail:
+            yield node.key
+            node = node.next[0]
+
+
+class Board:
+    """ひとつのランキング（セッションごとに自己ベスト1件）"""
+
+    def __init__(self):
+        self.ranking = RankedSet()
+        self.records: Dict[str, Dict] = {}
+        self._keys: Dict[str, Tuple] = {}
+        # 内容が変わるたびに増える（表示のキャッシュの無効化に使う）
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self.ranking)
+
+    @staticmethod
+    def _key(record: Dict) -> Tuple:
+        # スコアの高い順、同点なら先に記録した順
+        return (-record["score"], record["achieved_seq"], record["session_id"])
+
+    def upsert(self, record: Dict):
+        session_id = record["session_id"]
+        old_key = self._keys.get(session_id)
+        if old_key is not None:
+            self.ranking.remove(old_key)
+        key = self._key(record)
+        self.ranking.add(key)
+        self._keys[session_id] = key
+        self.records[session_id] = record
+        self.version += 1
+
+    def remove(self, session_id: str):
+        key = self._keys.pop(session_id, None)
+        if key is None:
+            return
+        self.ranking.remove(key)
+        del self.records[session_id]
+        self.version += 1
+
+    def top(self, k: int = TOP_K) -> List[Dict]:
+        """上位k件（順位つき）"""
+        entries = []
+        for rank, key in enumerate(self.ranking, start=1):
+            if rank > k:
+                break
+            entries.append({**self.records[key[2]], "rank": rank})
+        return entries
+
+    def rank(self, session_id: str) -> Optional[int]:
+        """1始まりの順位（記録がなければNone）"""
+        key = self._keys.get(session_id)
+        if key is None:
+            return None
+        return self.ranking.rank(key) + 1
+
+
+class Leaderboard:
+    """全ランキングの記録（SQLite）と順位の索引（メモリ）"""
+
+    def __init__(self, path: str, sync_interval: float = LEADERBOARD_SYNC_INTERVAL):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.boards: Dict[Tuple[str, Optional[str]], Board] = {}
+        self._conn: Optional[sqlite3.Connection] = None
+        self._last_seq = 0
+        self._synced_at = 0.0
+
+    def connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # 初期化はインポート時のスレッド、読み書きはイベントループのスレッドで行う
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+        return self._conn
+
+    def init(self):
+        conn = self.connect()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS leaderboard (
+                    scope TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    score REAL NOT NULL,
+                    profit_loss REAL NOT NULL,
+                    player_class TEXT NOT NULL,
+                    level INTEGER NOT NULL,
+                    dungeon_id TEXT NOT NULL,
+                    achieved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    achieved_seq INTEGER,
+                    PRIMARY KEY (scope, session_id)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS leaderboard_removed (
+                    seq INTEGER PRIMARY KEY,
+                    session_id TEXT NOT NULL
+                )
+            """)
+            # 以前のファイルには自己ベストを記録したときの通し番号がない（それまでは seq がそれだった）
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(leaderboard)")}
+            if "achieved_seq" not in columns:
+                conn.execute("ALTER TABLE leaderboard ADD COLUMN achieved_seq INTEGER")
+            conn.execute("UPDATE leaderboard SET achieved_seq = seq WHERE achieved_seq IS NULL")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_leaderboard_seq ON leaderboard(seq)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_leaderboard_score ON leaderboard(scope, score DESC)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_leaderboard_session ON leaderboard(session_id)")
+        self.sync(force=True)
+
+    def board(self, scope: str, player_class: Optional[str] = None) -> Board:
+        key = (scope, player_class)
+        if key not in self.boards:
+            self.boards[key] = Board()
+        return self.boards[key]
+
+    def _apply(self, row: sqlite3.Row):
+        record = dict(row)
+        # 全体とクラス別の2つのランキングに反映する（クラスが変わっていれば前のクラスのランキングから外す）
+        board = self.board(record["scope"])
+        previous = board.records.get(record["session_id"])
+        if previous and previous["player_class"] != record["player_class"]:
+            self.board(record["scope"], previous["player_class"]).remove(record["session_id"])
+        board.upsert(record)
+        self.board(record["scope"], record["player_class"]).upsert(record)
+        self._last_seq = max(self._last_seq, record["seq"])
+
+    def _forget(self, session_id: str):
+        for board in self.boards.values():
+            board.remove(session_id)
+
+    def sync(self, force: bool = False) -> int:
+        """前回以降に記録された行（他のプロセスの決算を含む）を索引に反映"""
+        now = time.monotonic()
+        if not force and now - self._synced_at < self.sync_interval:
+            return 0
+        self._synced_at = now
+        conn = self.connect()
+        rows = conn.execute(
+            "SELECT * FROM leaderboard WHERE seq > ? ORDER BY seq", (self._last_seq,)
+        ).fetchall()
+        removed = conn.execute(
+            "SELECT seq, session_id FROM leaderboard_removed WHERE seq > ? ORDER BY seq", (self._last_seq,)
+        ).fetchall()
+        # 記録と削除を通し番号の順に反映する（削除した後に記録し直したセッションは残る）
+        changes = sorted([(row["seq"], row, False) for row in rows] + [(row["seq"], row, True) for row in removed],
+                         key=lambda change: change[0])
+        for seq, row, is_removal in changes:
+            if is_removal:
+                self._forget(row["session_id"])
+                self._last_seq = max(self._last_seq, seq)
+            else:
+                self._apply(row)
+        return len(changes)
+
+    def record(self, session_id: str, player_class: str, level: int, dungeon_id: str,
+               score: float, profit_loss: float) -> Dict[str, Optional[int]]:
+        """決算を記録し、ダンジョンと総合での順位を返す
+
+        スコア（と損益・ダンジョン）は自己ベストを更新したときだけ書き換え、クラスとレベルは毎回最新にする
+        （比較はSQL側で行うので他のプロセスと競合しない）。
+        """
+        with self.connect() as conn:
+            for scope in (dungeon_id, GLOBAL_SCOPE):
+                conn.execute(f"""
+                    INSERT INTO leaderboard
+                        (scope, session_id, seq, score, profit_loss, player_class, level, dungeon_id, achieved_seq)
+                    VALUES (:scope, :session_id, {NEXT_SEQ}, :score, :profit_loss, :player_class, :level,
+                            :dungeon_id, {NEXT_SEQ})
+                    ON CONFLICT(scope, session_id) DO UPDATE SET
+                        seq = excluded.seq,
+                        player_class = excluded.player_class,
+                        level = excluded.level,
+                        score = CASE WHEN {IMPROVED} THEN excluded.score ELSE leaderboard.score END,
+                        profit_loss = CASE WHEN {IMPROVED} THEN excluded.profit_loss ELSE leaderboard.profit_loss END,
+                        dungeon_id = CASE WHEN {IMPROVED} THEN excluded.dungeon_id ELSE leaderboard.dungeon_id END,
+                        achieved_seq = CASE WHEN {IMPROVED} THEN excluded.seq ELSE leaderboard.achieved_seq END,
+                        achieved_at = CASE WHEN {IMPROVED} THEN CURRENT_TIMESTAMP ELSE leaderboard.achieved_at END
+                    WHERE {IMPROVED} OR excluded.player_class != leaderboard.player_class
+                        OR excluded.level != leaderboard.level
+                """, {"scope": scope, "session_id": session_id, "score": score, "profit_loss": profit_loss,
+                      "player_class": player_class, "level": level, "dungeon_id": dungeon_id})
+        self.sync(force=True)
+        return {
+            "dungeon_rank": self.board(dungeon_id).rank(session_id),
+            "dungeon_total": len(self.board(dungeon_id)),
+            "global_rank": self.board(GLOBAL_SCOPE).rank(session_id),
+            "global_total": len(self.board(GLOBAL_SCOPE)),
+        }
+
+    def remove(self, *session_ids: str):
+        """セッションの記録をすべてのランキングから削除（他のプロセスには削除の記録で伝える）"""
+        with self.connect() as conn:
+            for session_id in session_ids:
+                if conn.execute("DELETE FROM leaderboard WHERE session_id = ?", (session_id,)).rowcount:
+                    conn.execute(f"INSERT INTO leaderboard_removed (seq, session_id) VALUES ({NEXT_SEQ}, ?)",
+                                 (session_id,))
+        self.sync(force=True)
+
+    def top(self, scope: str, player_class: Optional[str] = None, k: int = TOP_K) -> List[Dict]:
+        self.sync()
+        return self.board(scope, player_class).top(k)
+
+    def rank(self, scope: str, session_id: str, player_class: Optional[str] = None) -> Optional[int]:
+        self.sync()
+        return self.board(scope, player_class).rank(session_id)
+
+
+if __name__ == "__main__":
+    # ベンチマーク: 決算の記録・上位K件・自分の順位の所要時間（件数を増やしても増えないことを確認）
+    # 使い方: python leaderboard.py [entries]
+    import os
+    import tempfile
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    classes = ["hero", "rogue", "sage"]
+    rng = random.Random(0)
+    board = Leaderboard(os.path.join(tempfile.mkdtemp(), "bench.db"))
+    board.init()
+
+    # 索引だけの性能（SQLiteへの書き込みを含まない）
+    for size in (n // 100, n // 10, n):
+        local = Board()
+        started = time.perf_counter()
+        for i in range(size):
+            local.upsert({"session_id": f"s{i}", "seq": i, "achieved_seq": i, "score": rng.gauss(0, 20)})
+        insert_us = (time.perf_counter() - started) / size * 1e6
+        started = time.perf_counter()
+        for i in range(1000):
+            local.rank(f"s{rng.randrange(size)}")
+        rank_us = (time.perf_counter() - started) / 1000 * 1e6
+        started = time.perf_counter()
+        for _ in range(1000):
+            local.top(TOP_K)
+        top_us = (time.perf_counter() - started) / 1000 * 1e6
+        # 全件を並べ替えて順位を求める場合
+        started = time.perf_counter()
+        records = list(local.records.values())
+        sorted(records, key=lambda r: -r["score"]).index(local.records["s0"])
+        sort_us = (time.perf_counter() - started) * 1e6
+        print(f"{size:>9,} entries: upsert {insert_us:.1f} us, rank {rank_us:.1f} us, "
+              f"top{TOP_K} {top_us:.1f} us (full sort: {sort_us:,.0f} us)")
+
+    # 決算の記録（SQLiteへの書き込みと同期を含む）
+    started = time.perf_counter()
+    for i in range(2000):
+        board.record(f"s{i}", classes[i % 3], 1 + i % 30, f"dungeon-{i % 8}", rng.gauss(0, 20), 0.0)
+    print(f"record: {(time.perf_counter() - started) / 2000 * 1000:.2f} ms per settlement")
@@ -1,76 +1,102 @@
 from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response
 from starlette.templating import Jinja2Templates
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request as StarletteRequest
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import atexit
 import json
 import os
 import uuid
-from typing import Optional
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 from models import (
-    UserProfile, GameState, TradeAction,
+    UserProfile, GameState, TradeAction, trade_event, apply_event,
     PLAYER_CLASSES, DIAGNOSTIC_QUESTIONS, INITIAL_INDICATORS, DUNGEONS,
-    fetch_stock_data, calculate_level, get_xp_for_level,
-    DIFFICULTY_LABELS, DIFFICULTY_COLORS
+    calculate_level, get_xp_for_level, dungeon_rewards,
+    DIFFICULTY_LABELS, DIFFICULTY_COLORS, RESOLUTION_LABELS
 )
+from chart import build_chart_data
+import assets
+import bar_store
 import database
-
-app = FastAPI(title="タイムマシン・トレーダー")
+import generator
+import market_data
+import onboarding
+import portfolio
+import rating
+import replay
+import sessions
+from maintenance import MaintenanceWorker
+from leaderboard import GLOBAL_SCOPE, TOP_K
+
+async def rebalance_shards():
+    """シャード数が変わっていれば、リクエストの合間に少しずつ再分散する（イベントループを止めないようスレッドで）"""
+    while await run_in_threadpool(database.rebalance_step):
+        await asyncio.sleep(0.1)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動中はwrite-behindキューの書き込みとDBのメンテナンスを続け、終了時に残りをすべて書き込む"""
+    flusher = asyncio.create_task(database.write_queue.run())
+    rebalancer = asyncio.create_task(rebalance_shards())
+    maintainer = asyncio.create_task(maintenance_worker.run())
+    try:
+        yield
+    finally:
+        flusher.cancel()
+        rebalancer.cancel()
+        maintainer.cancel()
+        database.flush_writes()
+
+
+app = FastAPI(title="タイムマシン・トレーダー", lifespan=lifespan)
 
 # セッション管理ミドルウェア
-SESSION_MAX_AGE = 1209600  # 2週間
-
-class SessionMiddleware(BaseHTTPMiddleware):
-    """セッションIDのみをクッキーで管理するミドルウェア"""
-    async def dispatch(self, request: StarletteRequest, call_next):
-        # セッションIDを取得または生成
-        session_id = request.cookies.get("session_id")
-        if not session_id:
-            session_id = str(uuid.uuid4())
-
-        request.state.session_id = session_id
-
-        response = await call_next(request)
-
-        # セッションIDをクッキーに設定
-        response.set_cookie(
-            key="session_id",
-            value=session_id,
-            max_age=SESSION_MAX_AGE,
-            path="/",
-            httponly=False,
-            samesite="lax",
-            secure=False
-        )
-        return response
+SESSION_MAX_AGE = database.SESSION_MAX_AGE
+
+app.add_middleware(sessions.SessionMiddleware)
+# 一番外側で圧縮する（Set-Cookieなどのヘッダーはそのまま）
+app.add_middleware(assets.CompressionMiddleware)
+
+# アクセスが途絶えてSESSION_MAX_AGEを過ぎたセッションを削除し、DBを少しずつ圧縮する
+maintenance_worker = MaintenanceWorker(SESSION_MAX_AGE)
 
-app.add_middleware(SessionMiddleware)
+# 保存が競合したコマンドを再試行する回数
+MAX_COMMAND_RETRIES = 3
 
-# 静的ファイルとテンプレート
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# 生成ダンジョンが選んだ難易度にならなかったときに選び直す回数
+MAX_GENERATE_ATTEMPTS = 5
+
+# 静的ファイルとテンプレート（静的ファイルはハッシュつきURLで長期キャッシュ、テンプレートはバイトコードをキャッシュ）
+static_files = assets.FingerprintedStaticFiles(directory=assets.STATIC_DIR)
+app.mount("/static", static_files, name="static")
 templates = Jinja2Templates(directory="templates")
+templates.env.bytecode_cache = assets.bytecode_cache()
 
 # テンプレートにグローバル変数を追加
 templates.env.globals["PLAYER_CLASSES"] = PLAYER_CLASSES
 templates.env.globals["DIFFICULTY_LABELS"] = DIFFICULTY_LABELS
 templates.env.globals["DIFFICULTY_COLORS"] = DIFFICULTY_COLORS
+templates.env.globals["RESOLUTION_LABELS"] = RESOLUTION_LABELS
+templates.env.globals["static_url"] = static_files.url
 
 
 def get_user_profile(request: Request) -> Optional[UserProfile]:
-    """データベースからユーザープロフィールを取得"""
-    session_id = getattr(request.state, "session_id", None)
-    if not session_id:
+    """ユーザープロフィールを取得（リクエスト中に初めて参照したときにデータベースから読み込む）"""
+    session = getattr(request.state, "session", None)
+    if session is None:
         return None
-    return database.get_user_by_session(session_id)
+    return session.profile
 
 
-def save_user_profile(request: Request, profile: UserProfile):
+def save_user_profile(request: Request, profile: UserProfile, durable: bool = False):
     """ユーザープロフィールをデータベースに保存"""
-    session_id = getattr(request.state, "session_id", None)
-    if not session_id:
+    session = getattr(request.state, "session", None)
+    if session is None:
         return
-    database.save_user(session_id, profile)
+    database.save_user(session.id, profile, durable=durable)
+    session.set_profile(profile)
 
 
 def get_game_state(request: Request) -> Optional[GameState]:
@@ -78,15 +104,20 @@ def get_game_state(request: Request) -> Optional[GameState]:
     session_id = getattr(request.state, "session_id", None)
     if not session_id:
         return None
-    return database.get_game_state(session_id)
+    game_state = database.get_game_state(session_id)
+    if game_state:
+        # スナップショットより後の日送りを再生した分足ダンジョンは、カーソル周辺のチャンクを読み直す
+        bar_store.ensure_window(game_state)
+    return game_state
 
 
-def save_game_state(request: Request, state: GameState):
+def save_game_state(request: Request, state: GameState, durable: bool = False,
+                    expected_version: Optional[int] = None):
     """ゲーム状態をデータベースに保存"""
     session_id = getattr(request.state, "session_id", None)
     if not session_id:
         return
-    database.save_game_state(session_id, state)
+    database.save_game_state(session_id, state, durable=durable, expected_version=expected_version)
 
 
 def clear_game_state(request: Request):
@@ -97,6 +128,83 @@ def clear_game_state(request: Request):
     database.delete_game_state(session_id)
 
 
+def can_enter(profile: UserProfile, dungeon: Dict) -> bool:
+    """生成ダンジョンは、IDを直接開いた場合も区間の難易度の推奨レベルに届かなければ入れない"""
+    return not generator.is_generated(dungeon) or profile.level >= dungeon["recommended_level"]
+
+
+async def prepare_rating(dungeon: Dict, closes: Callable[[], List[float]]):
+    """結果画面の評価基準がなければ計算しておく（ダンジョンごとに一度だけ）"""
+    if rating.get_rating(dungeon["id"]) is not None:
+        return
+    try:
+        await market_data.single_flight.do(
+            f"rating:{dungeon['id']}", lambda: rating.ensure_rating(dungeon["id"], closes())
+        )
+    except Exception as e:
+        # 評価基準がなくてもプレイはできる（結果画面に表示しないだけ）
+        print(f"Error building rating for {dungeon['id']}: {e}")
+
+
+async def new_game_state(dungeon: Dict) -> Optional[GameState]:
+    """ダンジョンの初期ゲーム状態を作成（データが取得できなければNone）"""
+    try:
+        if bar_store.is_intraday(dungeon):
+            await market_data.ensure_intraday_bars(dungeon)
+            state = bar_store.new_intraday_state(dungeon)
+            if state:
+                await prepare_rating(dungeon, lambda: bar_store.load_closes(dungeon["id"]))
+            return state
+
+        if portfolio.is_portfolio(dungeon):
+            # 銘柄ごとの日足をそろえた行列はダンジョンごとに共有し、ゲーム状態には持たない
+            return portfolio.new_state(dungeon, await portfolio.load_basket(dungeon))
+
+        if generator.is_generated(dungeon):
+            # ローカルの日足から切り出すだけなので待ち合わせも評価基準の計算もしない
+            stock_data = generator.load_stock_data(dungeon)
+        else:
+            # 同じダンジョンへの同時リクエストは1回の読み込みにまとめる
+            stock_data = await market_data.load_stock_data(dungeon)
+            await prepare_rating(dungeon, lambda: [bar["close"] for bar in stock_data])
+    except (market_data.MarketDataError, TimeoutError, asyncio.TimeoutError) as e:
+        print(f"Error loading market data for {dungeon['id']}: {e}")
+        return None
+
+    return GameState(
+        dungeon_id=dungeon["id"],
+        current_day=0,
+        total_days=len(stock_data),
+        cash=10000,
+        shares=0,
+        avg_price=0,
+        stock_data=stock_data,
+        trade_history=[]
+    )
+
+
+# ランキング表示のキャッシュ: (スコープ, クラス) -> (ランキングのversion, HTML)
+_leaderboard_fragments: Dict[Tuple[str, Optional[str]], Tuple[int, str]] = {}
+
+
+def render_leaderboard(scope: str, player_class: Optional[str] = None) -> str:
+    """ランキング上位の表示（HTML断片）を返す。ランキングが変わるまでは描画し直さない"""
+    board = database.leaderboard_board(scope, player_class)
+    cached = _leaderboard_fragments.get((scope, player_class))
+    if cached and cached[0] == board.version:
+        return cached[1]
+
+    html = templates.get_template("partials/leaderboard.html").render(
+        scope=scope,
+        player_class=player_class,
+        entries=board.top(TOP_K),
+        total=len(board),
+        dungeon_names={d["id"]: d["name"] for d in DUNGEONS},
+    )
+    _leaderboard_fragments[(scope, player_class)] = (board.version, html)
+    return html
+
+
 # ルート
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
@@ -108,14 +216,17 @@ async def index(request: Request):
 
 
 @app.get("/onboarding", response_class=HTMLResponse)
-async def onboarding(request: Request):
+async def onboarding_page(request: Request):
     """オンボーディング（転生）画面"""
     session_id = getattr(request.state, "session_id", None)
     if session_id:
-        scores, current = database.get_diagnostic_scores(session_id)
+        answers = database.get_onboarding_answers(session_id)
     else:
-        scores = {"hero": 0, "rogue": 0, "sage": 0}
-        current = 0
+        answers = onboarding.empty_answers()
+
+    current = onboarding.next_question(answers)
+    if current >= len(DIAGNOSTIC_QUESTIONS):
+        return RedirectResponse(url="/onboarding/result", status_code=302)
 
     return templates.TemplateResponse("onboarding.html", {
         "request": request,
@@ -133,21 +244,12 @@ async def answer_question(request: Request, question_id: int = Form(...), option
     if not session_id:
         return RedirectResponse(url="/", status_code=302)
 
-    # 診断スコアを取得
-    scores, current = database.get_diagnostic_scores(session_id)
-
-    # スコアを加算
-    question = DIAGNOSTIC_QUESTIONS[question_id]
-    option = question["options"][option_index]
-    scores["hero"] += option["scores"]["hero"]
-    scores["rogue"] += option["scores"]["rogue"]
-    scores["sage"] += option["scores"]["sage"]
-
-    current += 1
-
-    # 診断スコアをDBに保存
-    database.save_diagnostic_scores(session_id, scores, current)
+    # 回答を記録（同じ質問への再送は上書き）
+    answers = database.save_onboarding_answer(session_id, question_id, option_index)
+    if answers is None:
+        raise HTTPException(status_code=400, detail="Invalid answer")
 
+    current = onboarding.next_question(answers)
     if current >= len(DIAGNOSTIC_QUESTIONS):
         # 診断完了 - クラス決定
         return RedirectResponse(url="/onboarding/result", status_code=302)
@@ -168,7 +270,11 @@ async def onboarding_result(request: Request):
     if not session_id:
         return RedirectResponse(url="/", status_code=302)
 
-    scores, _ = database.get_diagnostic_scores(session_id)
+    answers = database.get_onboarding_answers(session_id)
+    if not onboarding.is_complete(answers):
+        # 診断が終わっていない（期限切れを含む）
+        return RedirectResponse(url="/onboarding", status_code=302)
+    scores = onboarding.score_answers(answers)
 
     # 最高スコアのクラスを決定
     player_class = max(scores, key=scores.get)
@@ -189,8 +295,8 @@ async def onboarding_result(request: Request):
     )
     save_user_profile(request, profile)
 
-    # 診断スコアをクリア
-    database.clear_diagnostic_scores(session_id)
+    # 診断の回答を削除
+    database.clear_onboarding(session_id)
 
     return templates.TemplateResponse("result.html", {
         "request": request,
@@ -221,27 +327,190 @@ async def dungeons(request: Request):
     profile = get_user_profile(request)
     if not profile:
         return RedirectResponse(url="/", status_code=302)
+    session_id = getattr(request.state, "session_id", None)
 
     # ダンジョンリストにクリア状態を反映
     dungeons_with_status = []
     for dungeon in DUNGEONS:
+        # 分足データが未取り込みのダンジョンは表示しない
+        if bar_store.is_intraday(dungeon) and not bar_store.has_bars(dungeon):
+            continue
         d = dungeon.copy()
         d["completed"] = dungeon["id"] in profile.completed_dungeons
         d["can_enter"] = profile.level >= dungeon["recommended_level"]
+        # ダンジョンの1位と自分の順位
+        board = database.leaderboard_board(dungeon["id"])
+        top = board.top(1)
+        d["best_score"] = top[0]["score"] if top else None
+        d["my_rank"] = board.rank(session_id) if session_id else None
+        d["ranked_players"] = len(board)
         # 難易度の背景色を計算
         difficulty_color = DIFFICULTY_COLORS[dungeon["difficulty"]]
         d["difficulty_bg_color"] = f"{difficulty_color}33"
         dungeons_with_status.append(d)
 
+    global_board = database.leaderboard_board(GLOBAL_SCOPE)
+    # ランダム生成ダンジョン: レベルが推奨レベル以上の難易度だけ選べる
+    generated_difficulties = [
+        difficulty for difficulty, level in generator.GENERATED_LEVELS.items() if profile.level >= level
+    ] if generator.available() else []
     return templates.TemplateResponse("dungeons.html", {
         "request": request,
         "profile": profile.model_dump() if profile else {},
         "dungeons": dungeons_with_status,
+        "leaderboard_html": render_leaderboard(GLOBAL_SCOPE),
+        "my_global_rank": global_board.rank(session_id) if session_id else None,
+        "ranked_players": len(global_board),
+        "generated_difficulties": generated_difficulties,
+        "generated_lengths": generator.WINDOW_LENGTHS,
+        "default_generated_length": generator.DEFAULT_WINDOW_LENGTH,
         "DIFFICULTY_COLORS": DIFFICULTY_COLORS,
         "DIFFICULTY_LABELS": DIFFICULTY_LABELS
     })
 
 
+# /dungeon/{dungeon_id} より先に登録しないと "generate" がダンジョンIDとして扱われる
+@app.get("/dungeon/generate")
+async def generate_dungeon(request: Request, difficulty: Optional[str] = None,
+                           length: int = generator.DEFAULT_WINDOW_LENGTH, metric: str = generator.DEFAULT_METRIC):
+    """ローカルの長期の日足からランダムにダンジョンを生成して入る"""
+    profile = get_user_profile(request)
+    if not profile:
+        return RedirectResponse(url="/", status_code=302)
+    if difficulty is not None and difficulty not in generator.DIFFICULTY_BANDS:
+        raise HTTPException(status_code=400, detail="Unknown difficulty")
+    if length not in generator.WINDOW_LENGTHS or metric not in generator.DIFFICULTY_METRICS:
+        raise HTTPException(status_code=400, detail="Invalid dungeon parameters")
+    if difficulty is not None and profile.level < generator.GENERATED_LEVELS[difficulty]:
+        raise HTTPException(status_code=403, detail="Level too low")
+
+    # 選んだ難易度と違う区間になったら（索引を作り直した直後など）選び直す
+    for _ in range(MAX_GENERATE_ATTEMPTS):
+        dungeon = generator.generate(length, difficulty, metric)
+        if not dungeon or difficulty is None or dungeon["difficulty"] == difficulty:
+            break
+    else:
+        dungeon = None
+    if not dungeon:
+        raise HTTPException(status_code=503, detail="Generated dungeons are not available")
+    return RedirectResponse(url=f"/dungeon/{dungeon['id']}", status_code=302)
+
+
+# /dungeon/{dungeon_id} より先に登録しないと "view" がダンジョンIDとして扱われる
+@app.get("/dungeon/view", response_class=HTMLResponse)
+async def view_game_panel(request: Request, asset: int = 0, chart_width: Optional[int] = None):
+    """ゲームパネルを描画し直す（ポートフォリオダンジョンでチャートの銘柄を切り替える）"""
+    profile = get_user_profile(request)
+    game_state = get_game_state(request)
+    if not profile or not game_state:
+        return RedirectResponse(url="/", status_code=302)
+    return await render_game_panel(request, profile, game_state, chart_width, asset)
+
+
+# /dungeon/{dungeon_id} より先に登録しないと "result" がダンジョンIDとして扱われる
+@app.get("/dungeon/result", response_class=HTMLResponse)
+async def dungeon_result(request: Request):
+    """ダンジョン結果画面"""
+    profile = get_user_profile(request)
+    game_state = get_game_state(request)
+
+    if not profile or not game_state:
+        return RedirectResponse(url="/", status_code=302)
+
+    # ダンジョン情報
+    dungeon = generator.find_dungeon(game_state.dungeon_id)
+
+    # 最終的なポジションを清算
+    if portfolio.is_portfolio(dungeon):
+        final_value = portfolio.settle(game_state, await portfolio.load_basket(dungeon))
+    else:
+        final_price = game_state.stock_data[-1]["close"]
+        final_value = game_state.cash + game_state.shares * final_price
+
+    # 保存された現金・株数をそのまま信用せず、記録されたトレードを正規の相場で再実行して確かめる
+    # （食い違えば再実行した資産で決算する）
+    replayed = await replay.replay_state(dungeon, game_state)
+    if replayed and (replayed["error"] or not replay.same_value(final_value, replayed["final_value"])):
+        print(f"Replay mismatch for run {game_state.run_id}: {replayed['error'] or 'final value'} "
+              f"(stored {final_value:.2f}, replayed {replayed['final_value']:.2f})")
+        final_value = replayed["final_value"]
+
+    # 損益計算
+    starting_cash = dungeon.get("starting_cash", 10000)
+    profit_loss = final_value - starting_cash
+    profit_loss_percent = (profit_loss / starting_cash) * 100
+
+    # 最適解・ガチホ・ランダム売買との比較（基準はダンジョンに入ったときに計算済み）
+    rating_info = None
+    dungeon_rating = rating.get_rating(game_state.dungeon_id)
+    if dungeon_rating:
+        sells = len([t for t in game_state.trade_history if t["action"] == "sell"])
+        rating_info = rating.rate_result(dungeon_rating, final_value, sells)
+
+    # XPと報酬計算
+    xp_earned, gold_earned = dungeon_rewards(dungeon, profit_loss_percent)
+
+    # プロフィール更新
+    profile.xp += xp_earned
+    profile.gold += gold_earned
+    profile.total_profit += profit_loss
+
+    # 挑戦の履歴に記録し、通算の取引数と勝率を求め直す（勝率は売買の記録が残っている挑戦の売りから）
+    session_id = getattr(request.state, "session_id", None)
+    if session_id:
+        lifetime = database.record_run(session_id, profile, game_state, profit_loss, profit_loss_percent,
+                                       xp_earned, gold_earned)
+        profile.total_trades = lifetime["trades"]
+        if lifetime["sells"] > 0:
+            profile.win_rate = lifetime["wins"] / lifetime["sells"]
+
+    # レベルアップ判定
+    level_info = calculate_level(profile.xp)
+    old_level = profile.level
+    profile.level = level_info["level"]
+    profile.xp_to_next_level = level_info["xp_to_next"]
+
+    leveled_up = profile.level > old_level
+
+    # 新しいインジケーター解放
+    new_indicators = []
+    for ind in profile.indicators:
+        if not ind.get("unlocked", False) and ind["required_level"] <= profile.level:
+            ind["unlocked"] = True
+            new_indicators.append(ind)
+
+    # ダンジョンクリア記録（生成ダンジョンは毎回違うので記録しない）
+    if not generator.is_generated(dungeon) and game_state.dungeon_id not in profile.completed_dungeons:
+        profile.completed_dungeons.append(game_state.dungeon_id)
+
+    # 決算はまとめずに即時コミットする
+    save_user_profile(request, profile, durable=True)
+    clear_game_state(request)
+
+    # ランキングに記録（自己ベストを更新したときだけ順位が変わる）
+    ranks = {}
+    if session_id and not generator.is_generated(dungeon):
+        ranks = database.record_result(session_id, profile, game_state.dungeon_id,
+                                       profit_loss_percent, profit_loss)
+
+    return templates.TemplateResponse("dungeon_result.html", {
+        "request": request,
+        "profile": profile,
+        "dungeon": dungeon,
+        "final_value": final_value,
+        "profit_loss": profit_loss,
+        "profit_loss_percent": profit_loss_percent,
+        "xp_earned": xp_earned,
+        "gold_earned": gold_earned,
+        "leveled_up": leveled_up,
+        "old_level": old_level,
+        "new_indicators": new_indicators,
+        "trade_count": len(game_state.trade_history),
+        "ranks": ranks,
+        "rating": rating_info
+    })
+
+
 @app.get("/dungeon/{dungeon_id}/panel", response_class=HTMLResponse)
 async def enter_dungeon_panel(request: Request, dungeon_id: str):
     """ダンジョンパネル（HTMXでインラインロード）"""
@@ -250,24 +519,16 @@ async def enter_dungeon_panel(request: Request, dungeon_id: str):
         return HTMLResponse(content="<p>セッションが切れました。<a href='/'>トップに戻る</a></p>")
 
     # ダンジョンを探す
-    dungeon = next((d for d in DUNGEONS if d["id"] == dungeon_id), None)
+    dungeon = generator.find_dungeon(dungeon_id)
     if not dungeon:
         return HTMLResponse(content="<p>ダンジョンが見つかりません</p>")
+    if not can_enter(profile, dungeon):
+        return HTMLResponse(content="<p>レベルが足りません</p>")
 
-    # 株価データを取得
-    stock_data = fetch_stock_data(dungeon)
-
-    # ゲーム状態を初期化
-    game_state = GameState(
-        dungeon_id=dungeon_id,
-        current_day=0,
-        total_days=len(stock_data),
-        cash=10000,
-        shares=0,
-        avg_price=0,
-        stock_data=stock_data,
-        trade_history=[]
-    )
+    # 株価データを取得してゲーム状態を初期化
+    game_state = await new_game_state(dungeon)
+    if not game_state:
+        return HTMLResponse(content="<p>相場データを取得できませんでした</p>")
     save_game_state(request, game_state)
 
     # 装備中のインジケーターを取得
@@ -283,9 +544,9 @@ async def enter_dungeon_panel(request: Request, dungeon_id: str):
         "profile": profile,
         "dungeon": dungeon,
         "game_state": game_state,
-        "current_price": stock_data[0],
+        **market_context(dungeon, game_state, await dungeon_basket(dungeon)),
         "equipped_indicators": equipped_indicators,
-        "chart_data": json.dumps(stock_data[:1]),
+        "command_key": uuid.uuid4().hex,
         "DIFFICULTY_COLORS": DIFFICULTY_COLORS,
         "DIFFICULTY_LABELS": DIFFICULTY_LABELS,
         "difficulty_badge_style": difficulty_badge_style
@@ -300,24 +561,16 @@ async def enter_dungeon(request: Request, dungeon_id: str):
         return RedirectResponse(url="/", status_code=302)
 
     # ダンジョンを探す
-    dungeon = next((d for d in DUNGEONS if d["id"] == dungeon_id), None)
+    dungeon = generator.find_dungeon(dungeon_id)
     if not dungeon:
         raise HTTPException(status_code=404, detail="Dungeon not found")
+    if not can_enter(profile, dungeon):
+        raise HTTPException(status_code=403, detail="Level too low")
 
-    # 株価データを取得
-    stock_data = fetch_stock_data(dungeon)
-
-    # ゲーム状態を初期化
-    game_state = GameState(
-        dungeon_id=dungeon_id,
-        current_day=0,
-        total_days=len(stock_data),
-        cash=10000,
-        shares=0,
-        avg_price=0,
-        stock_data=stock_data,
-        trade_history=[]
-    )
+    # 株価データを取得してゲーム状態を初期化
+    game_state = await new_game_state(dungeon)
+    if not game_state:
+        raise HTTPException(status_code=503, detail="Market data not available")
     save_game_state(request, game_state)
 
     # 装備中のインジケーターを取得
@@ -332,195 +585,160 @@ async def enter_dungeon(request: Request, dungeon_id: str):
         "profile": profile,
         "dungeon": dungeon,
         "game_state": game_state,
-        "current_price": stock_data[0],
+        **market_context(dungeon, game_state, await dungeon_basket(dungeon)),
         "equipped_indicators": equipped_indicators,
-        "chart_data": json.dumps(stock_data[:1]),
+        "command_key": uuid.uuid4().hex,
         "DIFFICULTY_COLORS": DIFFICULTY_COLORS,
         "DIFFICULTY_LABELS": DIFFICULTY_LABELS,
         "difficulty_bg_color": difficulty_bg_color
     })
 
 
-@app.post("/dungeon/trade", response_class=HTMLResponse)
-async def trade(request: Request, action: str = Form(...)):
-    """トレードアクションを実行"""
-    profile = get_user_profile(request)
-    game_state = get_game_state(request)
-
-    if not profile or not game_state:
-        return RedirectResponse(url="/", status_code=302)
-
-    current_price = game_state.stock_data[game_state.current_day]["close"]
-
-    # トレードを実行
-    if action == "buy" and game_state.cash > 0:
-        # 全額で購入
-        shares_to_buy = int(game_state.cash / current_price)
-        if shares_to_buy > 0:
-            cost = shares_to_buy * current_price
-            game_state.cash -= cost
-            if game_state.shares > 0:
-                # 平均取得価格を更新
-                total_cost = game_state.avg_price * game_state.shares + cost
-                game_state.shares += shares_to_buy
-                game_state.avg_price = total_cost / game_state.shares
-            else:
-                game_state.shares = shares_to_buy
-                game_state.avg_price = current_price
-            game_state.trade_history.append({
-                "day": game_state.current_day,
-                "action": "buy",
-                "price": current_price,
-                "shares": shares_to_buy
-            })
-
-    elif action == "sell" and game_state.shares > 0:
-        # 全株売却
-        proceeds = game_state.shares * current_price
-        game_state.cash += proceeds
-        game_state.trade_history.append({
-            "day": game_state.current_day,
-            "action": "sell",
-            "price": current_price,
-            "shares": game_state.shares,
-            "profit": (current_price - game_state.avg_price) * game_state.shares
-        })
-        game_state.shares = 0
-        game_state.avg_price = 0
-
-    save_game_state(request, game_state)
+async def apply_command(request: Request, make_event: Callable[[GameState], Awaitable[Optional[Dict]]],
+                        state_version: Optional[int],
+                        idempotency_key: Optional[str]) -> Tuple[str, Optional[GameState]]:
+    """楽観的排他制御でゲーム状態にコマンドを適用し、イベントとして追記
 
+    戻り値の状態は "applied"（適用して保存）、"duplicate"（同じ冪等キーを適用済み）、
+    "stale"（フォームを描画した後に状態が進んでいる）、"missing"（ゲーム状態なし）のいずれか。
+    make_event が None を返したコマンド（約定しない売買など）は何も書き込まない。
+    フォームの版が指定されていないコマンドは、保存が競合したら読み直して再試行する。
+    追記はコミットの結果（他のプロセスに先を越されていないか）を確かめてから "applied" を返す。
+    """
+    session_id = getattr(request.state, "session_id", None)
+    for _ in range(MAX_COMMAND_RETRIES):
+        game_state = get_game_state(request)
+        if not game_state:
+            return "missing", None
+        if idempotency_key and idempotency_key in game_state.recent_commands:
+            return "duplicate", game_state
+        if state_version is not None and state_version != game_state.version:
+            return "stale", game_state
+
+        expected_version = game_state.version
+        event = await make_event(game_state)
+        if event is None:
+            return "applied", game_state
+        event["key"] = idempotency_key
+        apply_event(game_state, event)
+        # 分足ダンジョンはカーソル周辺のチャンクだけを保持する
+        bar_store.ensure_window(game_state)
+        try:
+            database.append_event(session_id, game_state, event, expected_version=expected_version)
+            await database.commit_state(session_id)
+            return "applied", game_state
+        except database.StaleStateError:
+            # 他のリクエストが先に保存した: 読み直して再試行（フォームの版があれば stale になる）
+            continue
+    return "stale", get_game_state(request)
+
+
+async def dungeon_basket(dungeon: Optional[Dict]) -> Optional[portfolio.Basket]:
+    """ポートフォリオダンジョンならBasketを取得（読み込みはスレッドで行い、イベントループを止めない）"""
+    if dungeon and portfolio.is_portfolio(dungeon):
+        return await portfolio.load_basket(dungeon)
+    return None
+
+
+def market_context(dungeon: Dict, game_state: GameState, basket: Optional[portfolio.Basket],
+                   chart_width: Optional[int] = None, asset: int = 0) -> Dict[str, Any]:
+    """ゲームパネルの相場部分（ポートフォリオダンジョンはassetで選んだ銘柄のチャートと全銘柄の保有状況）
+
+    basket はポートフォリオダンジョンのBasket（dungeon_basket で読み込んでおく）。
+    """
+    if basket is None:
+        return {
+            "panel_template": "partials/game_panel.html",
+            "current_price": game_state.current_bar(),
+            "chart_data": json.dumps(build_chart_data(game_state.stock_data, game_state.visible_day(), chart_width)),
+        }
+
+    asset = min(max(asset, 0), len(basket.symbols) - 1)
+    bars = basket.records(asset)
+    day = min(game_state.current_day, len(basket) - 1)
+    return {
+        "panel_template": "partials/portfolio_panel.html",
+        "current_price": bars[day],
+        "chart_data": json.dumps(build_chart_data(bars, day, chart_width)),
+        "selected_asset": asset,
+        "holdings": portfolio.holdings(game_state, basket),
+        "total_value": portfolio.market_value(game_state, basket),
+        "starting_cash": dungeon["starting_cash"],
+    }
+
+
+async def make_trade_event(state: GameState, action: str, asset: Optional[int]) -> Optional[Dict]:
+    """トレードのイベントを作る（ポートフォリオダンジョンはassetの銘柄を売買する）"""
+    basket = await dungeon_basket(generator.find_dungeon(state.dungeon_id))
+    if basket is not None:
+        return portfolio.trade_event(state, basket, asset or 0, action)
+    return trade_event(state, action)
+
+
+async def render_game_panel(request: Request, profile: UserProfile, game_state: GameState,
+                      chart_width: Optional[int], asset: Optional[int] = None) -> HTMLResponse:
+    """ゲームパネル（HTMX部分更新）を描画"""
     # ダンジョン情報を取得
-    dungeon = next((d for d in DUNGEONS if d["id"] == game_state.dungeon_id), None)
+    dungeon = generator.find_dungeon(game_state.dungeon_id)
     equipped_indicators = [ind for ind in profile.indicators if ind.get("equipped", False)]
+    context = market_context(dungeon, game_state, await dungeon_basket(dungeon), chart_width, asset or 0)
 
-    return templates.TemplateResponse("partials/game_panel.html", {
+    return templates.TemplateResponse(context["panel_template"], {
         "request": request,
         "profile": profile,
         "dungeon": dungeon,
         "game_state": game_state,
-        "current_price": game_state.stock_data[game_state.current_day],
+        **context,
         "equipped_indicators": equipped_indicators,
-        "chart_data": json.dumps(game_state.stock_data[:game_state.current_day + 1])
+        "command_key": uuid.uuid4().hex
     })
 
 
-@app.post("/dungeon/next-day", response_class=HTMLResponse)
-async def next_day(request: Request):
-    """次の日へ進む"""
+@app.post("/dungeon/trade", response_class=HTMLResponse)
+async def trade(request: Request, action: str = Form(...), chart_width: Optional[int] = Form(None),
+                state_version: Optional[int] = Form(None), idempotency_key: Optional[str] = Form(None),
+                asset: Optional[int] = Form(None)):
+    """トレードアクションを実行"""
     profile = get_user_profile(request)
-    game_state = get_game_state(request)
-
-    if not profile or not game_state:
+    if not profile:
         return RedirectResponse(url="/", status_code=302)
 
-    game_state.current_day += 1
-
-    # ダンジョン終了判定
-    if game_state.current_day >= game_state.total_days:
-        save_game_state(request, game_state)
-        return RedirectResponse(url="/dungeon/result", status_code=302)
-
-    save_game_state(request, game_state)
-
-    # ダンジョン情報を取得
-    dungeon = next((d for d in DUNGEONS if d["id"] == game_state.dungeon_id), None)
-    equipped_indicators = [ind for ind in profile.indicators if ind.get("equipped", False)]
+    status, game_state = await apply_command(
+        request, lambda state: make_trade_event(state, action, asset), state_version, idempotency_key
+    )
+    if status == "missing":
+        return RedirectResponse(url="/", status_code=302)
+    if status == "duplicate":
+        # 再送されたリクエストは何もしない（HTMXは204では画面を差し替えない）
+        return Response(status_code=204)
 
-    return templates.TemplateResponse("partials/game_panel.html", {
-        "request": request,
-        "profile": profile,
-        "dungeon": dungeon,
-        "game_state": game_state,
-        "current_price": game_state.stock_data[game_state.current_day],
-        "equipped_indicators": equipped_indicators,
-        "chart_data": json.dumps(game_state.stock_data[:game_state.current_day + 1])
-    })
+    # stale の場合は書き込まずに現在の状態を描画し直す
+    return await render_game_panel(request, profile, game_state, chart_width, asset)
 
 
-@app.get("/dungeon/result", response_class=HTMLResponse)
-async def dungeon_result(request: Request):
-    """ダンジョン結果画面"""
+@app.post("/dungeon/next-day", response_class=HTMLResponse)
+async def next_day(request: Request, chart_width: Optional[int] = Form(None),
+                   state_version: Optional[int] = Form(None), idempotency_key: Optional[str] = Form(None),
+                   asset: Optional[int] = Form(None)):
+    """次の日へ進む"""
     profile = get_user_profile(request)
-    game_state = get_game_state(request)
-
-    if not profile or not game_state:
+    if not profile:
         return RedirectResponse(url="/", status_code=302)
 
-    # 最終的なポジションを清算
-    final_price = game_state.stock_data[-1]["close"]
-    final_value = game_state.cash + game_state.shares * final_price
+    async def advance(state: GameState) -> Dict:
+        return {"type": "advance", "day": state.current_day}
 
-    # 損益計算
-    starting_cash = 10000
-    profit_loss = final_value - starting_cash
-    profit_loss_percent = (profit_loss / starting_cash) * 100
-
-    # ダンジョン情報
-    dungeon = next((d for d in DUNGEONS if d["id"] == game_state.dungeon_id), None)
-
-    # XPと報酬計算
-    base_xp = dungeon["xp_reward"]
-    base_gold = dungeon["gold_reward"]
-
-    # 利益に応じてボーナス
-    if profit_loss_percent > 0:
-        xp_earned = int(base_xp * (1 + profit_loss_percent / 100))
-        gold_earned = int(base_gold * (1 + profit_loss_percent / 100))
-    else:
-        xp_earned = int(base_xp * 0.5)  # 損失でも経験値は半分もらえる
-        gold_earned = 0
-
-    # プロフィール更新
-    profile.xp += xp_earned
-    profile.gold += gold_earned
-    profile.total_profit += profit_loss
-    profile.total_trades += len(game_state.trade_history)
-
-    # 勝率更新
-    winning_trades = len([t for t in game_state.trade_history if t.get("profit", 0) > 0])
-    total_sells = len([t for t in game_state.trade_history if t["action"] == "sell"])
-    if total_sells > 0:
-        new_win_rate = winning_trades / total_sells
-        # 移動平均で更新
-        profile.win_rate = (profile.win_rate + new_win_rate) / 2
-
-    # レベルアップ判定
-    level_info = calculate_level(profile.xp)
-    old_level = profile.level
-    profile.level = level_info["level"]
-    profile.xp_to_next_level = level_info["xp_to_next"]
-
-    leveled_up = profile.level > old_level
-
-    # 新しいインジケーター解放
-    new_indicators = []
-    for ind in profile.indicators:
-        if not ind.get("unlocked", False) and ind["required_level"] <= profile.level:
-            ind["unlocked"] = True
-            new_indicators.append(ind)
-
-    # ダンジョンクリア記録
-    if game_state.dungeon_id not in profile.completed_dungeons:
-        profile.completed_dungeons.append(game_state.dungeon_id)
+    status, game_state = await apply_command(request, advance, state_version, idempotency_key)
+    if status == "missing":
+        return RedirectResponse(url="/", status_code=302)
+    if status == "duplicate":
+        return Response(status_code=204)
 
-    save_user_profile(request, profile)
-    clear_game_state(request)
+    # ダンジョン終了判定
+    if game_state.current_day >= game_state.total_days:
+        return RedirectResponse(url="/dungeon/result", status_code=302)
 
-    return templates.TemplateResponse("dungeon_result.html", {
-        "request": request,
-        "profile": profile,
-        "dungeon": dungeon,
-        "final_value": final_value,
-        "profit_loss": profit_loss,
-        "profit_loss_percent": profit_loss_percent,
-        "xp_earned": xp_earned,
-        "gold_earned": gold_earned,
-        "leveled_up": leveled_up,
-        "old_level": old_level,
-        "new_indicators": new_indicators,
-        "trade_count": len(game_state.trade_history)
-    })
+    return await render_game_panel(request, profile, game_state, chart_width, asset)
 
 
 @app.get("/equipment", response_class=HTMLResponse)
@@ -569,25 +787,55 @@ async def profile_page(request: Request):
     return templates.TemplateResponse("profile.html", {
         "request": request,
         "profile": profile,
-        "class_info": class_info
+        "class_info": class_info,
+        "recent_runs": database.recent_runs(request.state.session_id),
+        "dungeon_names": {d["id"]: d["name"] for d in DUNGEONS}
     })
 
 
+@app.get("/leaderboard", response_class=HTMLResponse)
+async def leaderboard_fragment(scope: str = GLOBAL_SCOPE, player_class: Optional[str] = None):
+    """ランキング上位（HTMX部分更新、クラス別の切り替え用）"""
+    if scope != GLOBAL_SCOPE and not any(d["id"] == scope for d in DUNGEONS):
+        raise HTTPException(status_code=404, detail="Leaderboard not found")
+    if player_class not in PLAYER_CLASSES:
+        player_class = None
+    return HTMLResponse(content=render_leaderboard(scope, player_class))
+
+
+@app.get("/metrics/writes")
+async def write_metrics():
+    """write-behindキューのメトリクス（コミット数・まとめられた保存数など）"""
+    return JSONResponse(database.write_queue.stats())
+
+
+@app.get("/metrics/market-data")
+async def market_data_metrics():
+    """相場データ読み込みのメトリクス（相乗りされたリクエスト数など）"""
+    return JSONResponse(market_data.single_flight.stats())
+
+
+@app.get("/metrics/maintenance")
+async def maintenance_metrics():
+    """DBメンテナンスのメトリクス（削除したセッション数・回収した容量など）"""
+    return JSONResponse(maintenance_worker.stats())
+
+
 @app.post("/reset", response_class=HTMLResponse)
 async def reset_game(request: Request):
     """ゲームをリセット"""
     session_id = getattr(request.state, "session_id", None)
     if session_id:
-        # ゲーム状態を削除
-        database.delete_game_state(session_id)
-        # ユーザープロフィールを削除
-        # 注: usersテーブルから削除する場合は追加の関数が必要ですが、
-        # ここではゲーム状態のみ削除します
+        # ユーザープロフィール・ゲーム状態・診断の回答を削除
+        database.delete_session(session_id)
+        request.state.session.set_profile(None)
     return RedirectResponse(url="/", status_code=302)
 
 
 # データベースを初期化
 database.init_db()
+# lifespanを通らない終了でも未書き込みの更新を失わないようにする
+atexit.register(database.flush_writes)
 
 if __name__ == "__main__":
     import uvicorn
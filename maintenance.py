@@ -0,0 +1,161 @@
+"""データベースのバックグラウンドメンテナンス
+
+匿名の訪問者にもセッションIDを発行しているのに、users / game_states の行は
+削除されず、game_states は保存のたびに行が増えていく。ここでは定期的に次を行う:
+
+1. アクセスの途絶えたセッション（database.SESSION_MAX_AGE 経過）のユーザーとゲーム状態、ランキングの記録を削除
+2. 途中で離脱した診断を削除
+3. ゲーム状態を各セッションの最新の行だけに圧縮
+4. 空いたページをファイルから少しずつ切り詰め（incremental vacuum）、統計を更新（ANALYZE）
+
+どの処理も少量ずつ行い、合間にイベントループをリクエストへ譲る。1回の処理量は
+かかった時間に合わせて増減させ、イベントループを占有する時間を SLICE_BUDGET 程度に抑える。
+"""
+import asyncio
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+import database
+
+# メンテナンスを行う間隔（秒）
+MAINTENANCE_INTERVAL = 600.0
+# 1回の処理でイベントループを占有する目安（秒）
+SLICE_BUDGET = 0.02
+# 処理の合間にリクエストへ譲る時間（秒）
+SLICE_PAUSE = 0.05
+# 1回の処理量（セッション数・行数・ページ数）の初期値と範囲
+INITIAL_BATCH = 200
+MIN_BATCH = 10
+MAX_BATCH = 5000
+
+
+class MaintenanceWorker:
+    """期限切れセッションの削除・ゲーム状態の圧縮・vacuumを少しずつ行う"""
+
+    def __init__(self, max_age: float, interval: float = MAINTENANCE_INTERVAL,
+                 slice_budget: float = SLICE_BUDGET, pause: float = SLICE_PAUSE):
+        self.max_age = max_age
+        self.interval = interval
+        self.slice_budget = slice_budget
+        self.pause = pause
+        # 処理の種類ごとの1回の処理量
+        self.batches = {"expire": INITIAL_BATCH, "compact": INITIAL_BATCH, "vacuum": INITIAL_BATCH}
+        self.metrics = {
+            "cycles": 0,
+            "slices": 0,
+            "sessions_expired": 0,
+            "onboarding_expired": 0,
+            "game_states_compacted": 0,
+            "bytes_reclaimed": 0,   # ファイルから切り詰めたバイト数
+            "max_slice_ms": 0.0,
+        }
+        self.last_report: Dict = {}
+
+    def _adapt(self, task: str, elapsed: float):
+        """処理時間が目安を超えたら処理量を半分に、十分短ければ倍にする"""
+        batch = self.batches[task]
+        if elapsed > self.slice_budget:
+            batch = max(MIN_BATCH, batch // 2)
+        elif elapsed < self.slice_budget / 4:
+            batch = min(MAX_BATCH, batch * 2)
+        self.batches[task] = batch
+        self.metrics["max_slice_ms"] = max(self.metrics["max_slice_ms"], round(elapsed * 1000, 2))
+
+    async def _drain(self, task: str, step: Callable[[int], Tuple[int, int]]) -> int:
+        """step(処理量) を (処理した件数, 成果の件数) の処理した件数が0になるまで繰り返す"""
+        total = 0
+        while True:
+            started = time.perf_counter()
+            work, done = step(self.batches[task])
+            self._adapt(task, time.perf_counter() - started)
+            self.metrics["slices"] += 1
+            total += done
+            if work == 0:
+                return total
+            await asyncio.sleep(self.pause)
+
+    def _expire_step(self, target, limit: int) -> Tuple[int, int]:
+        # 削除する前に、溜まっている保存と最近のアクセスを反映させる
+        database.flush_writes()
+        database.touch_seen_sessions()
+        examined, expired = target.expire_sessions(self.max_age, limit)
+        database.forget_sessions(expired)
+        database.remove_from_leaderboard(expired)
+        return examined, len(expired)
+
+    def _vacuum_step(self, target, limit: int) -> Tuple[int, int]:
+        pages = target.vacuum_step(limit)
+        return pages, pages
+
+    async def run_cycle(self) -> Dict:
+        """全ストレージのメンテナンスを1周行い、結果を返す"""
+        started = time.perf_counter()
+        targets = database.backend.maintenance_targets()
+        size_before = sum(target.space_stats()["bytes"] for target in targets)
+
+        report = {"sessions_expired": 0, "game_states_compacted": 0,
+                  "onboarding_expired": database.expire_onboarding()}
+        for target in targets:
+            report["sessions_expired"] += await self._drain(
+                "expire", lambda limit: self._expire_step(target, limit))
+            report["game_states_compacted"] += await self._drain(
+                "compact", lambda limit: target.compact_game_states(self.max_age, limit))
+            await self._drain("vacuum", lambda limit: self._vacuum_step(target, limit))
+            target.analyze()
+            await asyncio.sleep(self.pause)
+
+        stats = [target.space_stats() for target in targets]
+        report["bytes"] = sum(s["bytes"] for s in stats)
+        report["free_bytes"] = sum(s["free_bytes"] for s in stats)
+        report["bytes_reclaimed"] = max(size_before - report["bytes"], 0)
+        report["elapsed"] = round(time.perf_counter() - started, 3)
+
+        self.metrics["cycles"] += 1
+        for key in ("sessions_expired", "onboarding_expired", "game_states_compacted", "bytes_reclaimed"):
+            self.metrics[key] += report[key]
+        self.last_report = report
+        return report
+
+    async def run(self):
+        """一定間隔でメンテナンスを続ける（アプリ起動中のバックグラウンドタスク）"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                report = await self.run_cycle()
+                if report["sessions_expired"] or report["game_states_compacted"] or report["bytes_reclaimed"]:
+                    print(f"Maintenance: {report}")
+            except Exception as e:
+                print(f"Error running database maintenance: {e}")
+
+    def stats(self) -> Dict:
+        return {**self.metrics, "batches": dict(self.batches), "last_report": self.last_report}
+
+
+if __name__ == "__main__":
+    # 使い方:
+    #   python maintenance.py run      メンテナンスを1周行い、回収した容量を表示
+    #   python maintenance.py vacuum   ファイルを作り直してincremental vacuumを有効にする（オフライン用）
+    command = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if command not in ("run", "vacuum"):
+        print("usage: python maintenance.py [run | vacuum]")
+        sys.exit(1)
+
+    database.init_db()
+    targets: List = database.backend.maintenance_targets()
+    if command == "vacuum":
+        for target in targets:
+            before = target.space_stats()["bytes"]
+            target.vacuum_full()
+            after = target.space_stats()["bytes"]
+            print(f"{getattr(target, 'path', target)}: {before:,} -> {after:,} bytes")
+        sys.exit(0)
+
+    worker = MaintenanceWorker(database.SESSION_MAX_AGE, pause=0)
+    report = asyncio.run(worker.run_cycle())
+    print(f"expired sessions: {report['sessions_expired']}, "
+          f"onboarding: {report['onboarding_expired']}, "
+          f"compacted game states: {report['game_states_compacted']}")
+    print(f"size: {report['bytes']:,} bytes (free {report['free_bytes']:,}), "
+          f"reclaimed {report['bytes_reclaimed']:,} bytes in {report['elapsed']}s, "
+          f"max slice {worker.metrics['max_slice_ms']} ms")
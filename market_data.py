@@ -0,0 +1,189 @@
+"""相場データ読み込みの重複排除（single-flight）
+
+人気ダンジョンのデータが未読み込みのとき、同時に来たリクエストがそれぞれ
+fetch_stock_data を呼ぶとyfinanceとCPUに負荷が集中する。ここでは同じキーの
+読み込みを1回にまとめ、待っている全員に同じ結果（または例外）を返す。
+
+- プロセス内: asyncio.Future を共有し、読み込み自体はスレッドプールで実行
+- プロセス間: ファイルロックで1プロセスだけが取得し、結果をディスクにキャッシュ
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from starlette.concurrency import run_in_threadpool
+
+import bar_store
+from models import fetch_stock_data
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間ロックなし
+    fcntl = None
+
+MARKET_CACHE_DIR = "market_cache"
+# 待機側がひとつの読み込みを待つ最大秒数
+LOAD_TIMEOUT = 30.0
+# 他プロセスの読み込み完了を待つ最大秒数
+LOCK_TIMEOUT = 60.0
+LOCK_POLL_INTERVAL = 0.05
+
+
+class MarketDataError(Exception):
+    """相場データを取得できなかった"""
+
+
+class SingleFlight:
+    """同じキーの同時呼び出しをひとつの実行にまとめる"""
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.metrics = {
+            "requests": 0,   # do() の呼び出し回数
+            "loads": 0,      # 実際に読み込みを実行した回数
+            "coalesced": 0,  # 実行中の読み込みに相乗りした回数
+            "errors": 0,
+            "timeouts": 0,
+        }
+
+    async def do(self, key: str, fn: Callable, *args, timeout: float = LOAD_TIMEOUT) -> Any:
+        """fn(*args) をスレッドプールで実行し、同じキーの実行中の呼び出しがあれば結果を共有"""
+        self.metrics["requests"] += 1
+        future = self._inflight.get(key)
+        if future is not None:
+            self.metrics["coalesced"] += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            # 誰も結果を受け取らなかった例外で警告が出ないようにする
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self._inflight[key] = future
+            # 読み込みは呼び出し元とは独立したタスクで行い、最初の呼び出し元が
+            # タイムアウトしても他の待機者のために完了させる
+            task = asyncio.ensure_future(self._run(key, future, fn, args))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self.metrics["timeouts"] += 1
+            raise
+
+    async def _run(self, key: str, future: asyncio.Future, fn: Callable, args: tuple):
+        self.metrics["loads"] += 1
+        try:
+            result = await run_in_threadpool(fn, *args)
+        except Exception as e:
+            self.metrics["errors"] += 1
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        """メトリクスと実行中のキー数を返す"""
+        return {**self.metrics, "inflight": len(self._inflight)}
+
+
+single_flight = SingleFlight()
+
+
+@contextmanager
+def file_lock(name: str, timeout: float = LOCK_TIMEOUT):
+    """プロセス間の排他ロック（取得できなければTimeoutError）"""
+    if fcntl is None:
+        yield
+        return
+
+    os.makedirs(MARKET_CACHE_DIR, exist_ok=True)
+    path = os.path.join(MARKET_CACHE_DIR, f"{name}.lock")
+    with open(path, "w") as f:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Timed out waiting for lock {name}")
+                time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _cache_key(dungeon: Dict) -> str:
+    """銘柄と期間からキャッシュキーを作成"""
+    raw = f"{dungeon['stock_symbol']}|{dungeon['start_date']}|{dungeon['end_date']}"
+    return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+
+def _read_cache(key: str) -> Optional[List[Dict]]:
+    path = os.path.join(MARKET_CACHE_DIR, f"{key}.json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading market cache {key}: {e}")
+        return None
+
+
+def _write_cache(key: str, data: List[Dict]):
+    os.makedirs(MARKET_CACHE_DIR, exist_ok=True)
+    path = os.path.join(MARKET_CACHE_DIR, f"{key}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def _load_daily(dungeon: Dict) -> List[Dict]:
+    """ディスクキャッシュ → 他プロセスの完了待ち → yfinance の順で日足を取得"""
+    key = _cache_key(dungeon)
+    cached = _read_cache(key)
+    if cached is not None:
+        return cached
+
+    with file_lock(key):
+        # ロック待ちの間に他プロセスが取得済みならそれを使う
+        cached = _read_cache(key)
+        if cached is not None:
+            return cached
+        data = fetch_stock_data(dungeon)
+        if not data:
+            raise MarketDataError(f"No market data for {dungeon['stock_symbol']}")
+        _write_cache(key, data)
+        return data
+
+
+def _load_intraday(dungeon: Dict) -> int:
+    """分足をストアに取り込む（他プロセスと重複しないようロックする）"""
+    with file_lock(f"bars-{dungeon['id']}"):
+        if bar_store.has_bars(dungeon):
+            return bar_store.load_manifest(dungeon["id"])["total_bars"]
+        count = bar_store.fetch_intraday_bars(dungeon)
+        if count == 0:
+            raise MarketDataError(f"No intraday data for {dungeon['stock_symbol']}")
+        return count
+
+
+async def load_stock_data(dungeon: Dict) -> List[Dict]:
+    """日足データを取得（同時リクエストは1回の読み込みにまとめる）"""
+    data = await single_flight.do(f"daily:{_cache_key(dungeon)}", _load_daily, dungeon)
+    # 共有している結果をセッションごとに書き換えないようコピーを返す
+    return [dict(d) for d in data]
+
+
+async def ensure_intraday_bars(dungeon: Dict):
+    """分足データがストアになければ取り込む（同時リクエストは1回にまとめる）"""
+    if not bar_store.has_bars(dungeon):
+        await single_flight.do(f"bars:{dungeon['id']}", _load_intraday, dungeon)
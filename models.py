@@ -1,9 +1,11 @@
-from pydantic import BaseModel
-from typing import List, Dict, Optional, Any
+from pydantic import BaseModel, Field
+from typing import List, Dict, Optional, Any, Tuple
 from datetime import datetime
 import random
+import uuid
 import yfinance as yf
 import pandas as pd
+from indicators import IndicatorState
 
 # プレイヤークラス情報
 PLAYER_CLASSES = {
@@ -160,6 +162,7 @@ DUNGEONS = [
         "stock_symbol": "7203.T",  # トヨタ自動車
         "start_date": "2023-04-01",
         "end_date": "2023-07-31",
+        "resolution": "1d",
         "difficulty": "easy",
         "recommended_level": 1,
         "xp_reward": 200,
@@ -172,6 +175,7 @@ DUNGEONS = [
         "stock_symbol": "9984.T",  # ソフトバンクグループ
         "start_date": "2021-04-01",
         "end_date": "2021-09-30",
+        "resolution": "1d",
         "difficulty": "normal",  # easyから格上げ
         "recommended_level": 3,
         "xp_reward": 400,
@@ -184,6 +188,7 @@ DUNGEONS = [
         "stock_symbol": "^N225",   # 日経平均株価
         "start_date": "2018-01-01",
         "end_date": "2018-12-31",
+        "resolution": "1d",
         "difficulty": "normal",
         "recommended_level": 5,
         "xp_reward": 800,
@@ -196,6 +201,7 @@ DUNGEONS = [
         "stock_symbol": "^N225",   # 日経平均株価
         "start_date": "2020-01-01",
         "end_date": "2020-06-30",
+        "resolution": "1d",
         "difficulty": "hard",
         "recommended_level": 10,
         "xp_reward": 2000,
@@ -208,14 +214,49 @@ DUNGEONS = [
         "stock_symbol": "^N225",   # 日経平均株価
         "start_date": "2008-01-01",
         "end_date": "2008-12-31",
+        "resolution": "1d",
         "difficulty": "legendary",
         "recommended_level": 15,
         "xp_reward": 5000,
         "gold_reward": 50000,
         "description": "【リーマン・ショック】100年に一度の金融危機。終わりの見えない下落トレンド。空売りを駆使しなければ生き残れない。",
     },
+    {
+        "id": "flash-1",
+        "name": "閃光の回廊",
+        "stock_symbol": "^N225",   # 日経平均株価
+        "start_date": "2024-08-05",
+        "end_date": "2024-08-06",
+        "resolution": "1m",  # 1分足（bar_storeから読み込む）
+        "difficulty": "hard",
+        "recommended_level": 10,
+        "xp_reward": 1500,
+        "gold_reward": 8000,
+        "description": "【令和のブラックマンデー】日経平均が1日で4,451円安と史上最大の下げ幅を記録した日。1分足で刻まれる暴落の只中を生き延びろ。",
+    },
+    {
+        "id": "portfolio-1",
+        "name": "三頭竜の巣",
+        # 複数銘柄を同じ期間で同時に売買する（portfolio.py）
+        "stock_symbols": ["7203.T", "9984.T", "^N225"],  # トヨタ自動車・ソフトバンクG・日経平均
+        "start_date": "2022-01-01",
+        "end_date": "2022-12-31",
+        "resolution": "1d",
+        "difficulty": "normal",
+        "recommended_level": 5,
+        "starting_cash": 100000,  # 日経平均を1単位買える資金
+        "xp_reward": 1000,
+        "gold_reward": 6000,
+        "description": "2022年のトヨタ・ソフトバンクG・日経平均。3つの首が別々に暴れる年に、資金をどの首に向けるかが問われる。",
+    },
 ]
 
+# 足の種類ラベル
+RESOLUTION_LABELS = {
+    "1d": "日足",
+    "1m": "1分足",
+}
+
 # 難易度ラベル
 DIFFICULTY_LABELS = {
     "easy": "初級",
@@ -246,6 +287,10 @@ class UserProfile(BaseModel):
     win_rate: float = 0.0
 
 
+# GameStateに保持する冪等キーの数
+RECENT_COMMANDS_LIMIT = 16
+
+
 class GameState(BaseModel):
     dungeon_id: str
     current_day: int = 0
@@ -253,8 +298,41 @@ class GameState(BaseModel):
     cash: float = 10000
     shares: int = 0
     avg_price: float = 0
+    # ポートフォリオダンジョンの銘柄ごとの保有株数と平均取得価格（単一銘柄では空）
+    positions: List[int] = []
+    avg_prices: List[float] = []
     stock_data: List[Dict[str, Any]] = []
+    window_start: int = 0  # stock_data[0] が全体の何本目か（分足ダンジョンのみ0以外）
     trade_history: List[Dict[str, Any]] = []
+    # 逐次計算する指標の状態（未来の足が確定していないダンジョン用）
+    indicator_state: Optional[IndicatorState] = None
+    # 楽観的排他制御: run_idはダンジョン挑戦ごと、versionは保存ごとに増える
+    run_id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    version: int = 0
+    # 適用済みコマンドの冪等キー（直近のみ保持）
+    recent_commands: List[str] = []
+
+    def remember_command(self, idempotency_key: Optional[str]):
+        """適用したコマンドの冪等キーを記録"""
+        if idempotency_key:
+            self.recent_commands = (self.recent_commands + [idempotency_key])[-RECENT_COMMANDS_LIMIT:]
+
+    def append_bar(self, bar: Dict[str, Any]) -> Dict[str, Any]:
+        """新しい足を指標付きで末尾に追加（O(1)）"""
+        if self.indicator_state is None:
+            self.indicator_state = IndicatorState()
+        enriched = self.indicator_state.enrich(bar)
+        self.stock_data.append(enriched)
+        self.total_days += 1
+        return enriched
+
+    def current_bar(self) -> Dict[str, Any]:
+        """現在のカーソル位置の足を取得"""
+        return self.stock_data[self.current_day - self.window_start]
+
+    def visible_day(self) -> int:
+        """stock_data内での現在のカーソル位置"""
+        return self.current_day - self.window_start
 
 
 class TradeAction(BaseModel):
@@ -262,6 +340,149 @@ class TradeAction(BaseModel):
     shares: int = 0
 
 
+def trade_event(game_state: GameState, action: str) -> Optional[Dict[str, Any]]:
+    """現在の足の終値でのトレードをイベントにする（買いは全額、売りは全株、約定しなければNone）"""
+    current_price = game_state.current_bar()["close"]
+
+    if action == "buy" and game_state.cash > 0:
+        # 全額で購入
+        shares_to_buy = int(game_state.cash / current_price)
+        if shares_to_buy > 0:
+            return {
+                "type": "trade",
+                "day": game_state.current_day,
+                "action": "buy",
+                "price": current_price,
+                "shares": shares_to_buy
+            }
+
+    elif action == "sell" and game_state.shares > 0:
+        # 全株売却
+        return {
+            "type": "trade",
+            "day": game_state.current_day,
+            "action": "sell",
+            "price": current_price,
+            "shares": game_state.shares,
+            "profit": (current_price - game_state.avg_price) * game_state.shares
+        }
+    return None
+
+
+# trade_history に残すイベントの項目（asset/symbol はポートフォリオダンジョンのみ）
+TRADE_FIELDS = ("day", "action", "asset", "symbol", "price", "shares", "profit")
+
+
+def apply_event(game_state: GameState, event: Dict[str, Any]):
+    """イベントをゲーム状態に適用（プレイ中も、イベントログからの復元も同じ処理）"""
+    if event["type"] == "advance":
+        game_state.current_day += 1
+
+    elif event["type"] == "trade":
+        price, shares = event["price"], event["shares"]
+        asset = event.get("asset")
+        if asset is None:
+            held, avg_price = game_state.shares, game_state.avg_price
+        else:
+            held, avg_price = game_state.positions[asset], game_state.avg_prices[asset]
+        if event["action"] == "buy":
+            game_state.cash -= shares * price
+            if held > 0:
+                # 平均取得価格を更新
+                avg_price = (avg_price * held + shares * price) / (held + shares)
+                held += shares
+            else:
+                held, avg_price = shares, price
+        else:
+            game_state.cash += shares * price
+            held, avg_price = 0, 0
+        if asset is None:
+            game_state.shares, game_state.avg_price = held, avg_price
+        else:
+            game_state.positions[asset], game_state.avg_prices[asset] = held, avg_price
+        game_state.trade_history.append({key: event[key] for key in TRADE_FIELDS if key in event})
+
+    game_state.remember_command(event.get("key"))
+
+
+def apply_trade(game_state: GameState, action: str) -> Optional[Dict[str, Any]]:
+    """現在の足の終値でトレードを実行し、約定したイベントを返す"""
+    event = trade_event(game_state, action)
+    if event:
+        apply_event(game_state, event)
+    return event
+
+
+def indicator_columns(close):
+    """終値からテクニカル指標を計算
+
+    close は1銘柄のSeriesでも、日付×銘柄のDataFrameでもよい（DataFrameなら全銘柄をまとめて計算する）。
+    """
+    columns = {}
+    # SMA (移動平均線)
+    columns['sma_25'] = close.rolling(window=25).mean()
+    columns['sma_75'] = close.rolling(window=75).mean()
+
+    # RSI (相対力指数) - 14日
+    delta = close.diff()
+    gain = (delta.where(delta > 0, 0)).rolling(window=14).mean()
+    loss = (-delta.where(delta < 0, 0)).rolling(window=14).mean()
+    rs = gain / loss
+    columns['rsi_14'] = 100 - (100 / (1 + rs))
+
+    # MACD (12, 26, 9)
+    ema_12 = close.ewm(span=12, adjust=False).mean()
+    ema_26 = close.ewm(span=26, adjust=False).mean()
+    columns['macd'] = ema_12 - ema_26
+    columns['macd_signal'] = columns['macd'].ewm(span=9, adjust=False).mean()
+    columns['macd_hist'] = columns['macd'] - columns['macd_signal']
+
+    # ボリンジャーバンド (20日, 2σ)
+    columns['bb_middle'] = close.rolling(window=20).mean()
+    bb_std = close.rolling(window=20).std()
+    columns['bb_upper'] = columns['bb_middle'] + (bb_std * 2)
+    columns['bb_lower'] = columns['bb_middle'] - (bb_std * 2)
+
+    return columns
+
+
+def compute_indicators(df: pd.DataFrame) -> pd.DataFrame:
+    """OHLCVのDataFrameにテクニカル指標の列を追加"""
+    for name, values in indicator_columns(df['Close']).items():
+        df[name] = values
+    return df
+
+
+def dataframe_to_records(df: pd.DataFrame, date_format: str = "%Y-%m-%d") -> List[Dict]:
+    """指標計算済みのDataFrameをstock_data形式の辞書リストに変換"""
+    # NaNをNoneに変換してJSONシリアライズ可能にする
+    def convert_nan(value):
+        if pd.isna(value):
+            return None
+        return round(float(value), 2) if isinstance(value, (int, float)) else value
+
+    data = []
+    for date, row in df.iterrows():
+        data.append({
+            "date": date.strftime(date_format),
+            "open": round(float(row["Open"]), 2),
+            "high": round(float(row["High"]), 2),
+            "low": round(float(row["Low"]), 2),
+            "close": round(float(row["Close"]), 2),
+            "volume": int(row["Volume"]),
+            "sma_25": convert_nan(row.get("sma_25")),
+            "sma_75": convert_nan(row.get("sma_75")),
+            "rsi_14": convert_nan(row.get("rsi_14")),
+            "macd": convert_nan(row.get("macd")),
+            "macd_signal": convert_nan(row.get("macd_signal")),
+            "macd_hist": convert_nan(row.get("macd_hist")),
+            "bb_upper": convert_nan(row.get("bb_upper")),
+            "bb_middle": convert_nan(row.get("bb_middle")),
+            "bb_lower": convert_nan(row.get("bb_lower")),
+        })
+    return data
+
+
 def fetch_stock_data(dungeon: Dict) -> List[Dict]:
     """yfinanceを使用して実在の株価データを取得し、テクニカル指標を計算"""
     try:
@@ -277,65 +498,26 @@ def fetch_stock_data(dungeon: Dict) -> List[Dict]:
         if df.empty:
             return []
 
-        # テクニカル指標を計算
-        # SMA (移動平均線)
-        df['sma_25'] = df['Close'].rolling(window=25).mean()
-        df['sma_75'] = df['Close'].rolling(window=75).mean()
-
-        # RSI (相対力指数) - 14日
-        delta = df['Close'].diff()
-        gain = (delta.where(delta > 0, 0)).rolling(window=14).mean()
-        loss = (-delta.where(delta < 0, 0)).rolling(window=14).mean()
-        rs = gain / loss
-        df['rsi_14'] = 100 - (100 / (1 + rs))
-
-        # MACD (12, 26, 9)
-        ema_12 = df['Close'].ewm(span=12, adjust=False).mean()
-        ema_26 = df['Close'].ewm(span=26, adjust=False).mean()
-        df['macd'] = ema_12 - ema_26
-        df['macd_signal'] = df['macd'].ewm(span=9, adjust=False).mean()
-        df['macd_hist'] = df['macd'] - df['macd_signal']
-
-        # ボリンジャーバンド (20日, 2σ)
-        df['bb_middle'] = df['Close'].rolling(window=20).mean()
-        bb_std = df['Close'].rolling(window=20).std()
-        df['bb_upper'] = df['bb_middle'] + (bb_std * 2)
-        df['bb_lower'] = df['bb_middle'] - (bb_std * 2)
-
-        # DataFrameを辞書リストに変換
-        data = []
-        for date, row in df.iterrows():
-            # NaNをNoneに変換してJSONシリアライズ可能にする
-            def convert_nan(value):
-                if pd.isna(value):
-                    return None
-                return round(float(value), 2) if isinstance(value, (int, float)) else value
-
-            data.append({
-                "date": date.strftime("%Y-%m-%d"),
-                "open": round(float(row["Open"]), 2),
-                "high": round(float(row["High"]), 2),
-                "low": round(float(row["Low"]), 2),
-                "close": round(float(row["Close"]), 2),
-                "volume": int(row["Volume"]),
-                "sma_25": convert_nan(row.get("sma_25")),
-                "sma_75": convert_nan(row.get("sma_75")),
-                "rsi_14": convert_nan(row.get("rsi_14")),
-                "macd": convert_nan(row.get("macd")),
-                "macd_signal": convert_nan(row.get("macd_signal")),
-                "macd_hist": convert_nan(row.get("macd_hist")),
-                "bb_upper": convert_nan(row.get("bb_upper")),
-                "bb_middle": convert_nan(row.get("bb_middle")),
-                "bb_lower": convert_nan(row.get("bb_lower")),
-            })
-
-        return data
+        # テクニカル指標を計算し、DataFrameを辞書リストに変換
+        return dataframe_to_records(compute_indicators(df))
     except Exception as e:
         # エラーが発生した場合は空リストを返す
         print(f"Error fetching stock data for {dungeon.get('stock_symbol', 'unknown')}: {e}")
         return []
 
 
+def dungeon_rewards(dungeon: Dict, profit_loss_percent: float) -> Tuple[int, int]:
+    """ダンジョン結果の (XP, ゴールド)"""
+    base_xp = dungeon["xp_reward"]
+    base_gold = dungeon["gold_reward"]
+
+    # 利益に応じてボーナス
+    if profit_loss_percent > 0:
+        return int(base_xp * (1 + profit_loss_percent / 100)), int(base_gold * (1 + profit_loss_percent / 100))
+    # 損失でも経験値は半分もらえる
+    return int(base_xp * 0.5), 0
+
+
 def get_xp_for_level(level: int) -> int:
     """レベルアップに必要なXPを計算"""
     return int(100 * (1.5 ** (level - 1)))
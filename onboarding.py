@@ -0,0 +1,154 @@
+"""オンボーディング（初期診断）の回答ストア
+
+以前は回答のたびに game_states に行を追加し、最新の行に "scores" があるかで
+診断中かどうかを判定していた。ここでは専用のテーブルにセッションごとに1行だけ、
+回答した選択肢番号を並べた短い文字列（未回答は "-"）と有効期限を保存する。
+
+スコアは保存せず、DIAGNOSTIC_QUESTIONS から事前に作った重み行列で回答から求める。
+同じ質問への再送は上書きになるので、二重送信でスコアが二重に加算されることはない。
+途中で離脱したセッションは有効期限を過ぎると読み込まれなくなり、バックグラウンドのメンテナンス（maintenance.py）で削除される。
+"""
+import sqlite3
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from models import DIAGNOSTIC_QUESTIONS, PLAYER_CLASSES
+
+# 最後の回答からこの秒数が過ぎた診断は破棄する
+ONBOARDING_TTL = 3600.0
+UNANSWERED = "-"
+
+# 重み行列の列の順序
+CLASS_IDS: Tuple[str, ...] = tuple(PLAYER_CLASSES)
+
+
+def build_answer_weights(questions: List[Dict]) -> List[List[Tuple[int, ...]]]:
+    """質問×選択肢ごとのクラス別加点を CLASS_IDS の順のタプルにした行列を作成"""
+    weights = []
+    for question in questions:
+        # 回答は選択肢番号1文字で保存する
+        assert len(question["options"]) <= 10, "too many options to encode in one digit"
+        weights.append([
+            tuple(option["scores"].get(class_id, 0) for class_id in CLASS_IDS)
+            for option in question["options"]
+        ])
+    return weights
+
+
+ANSWER_WEIGHTS = build_answer_weights(DIAGNOSTIC_QUESTIONS)
+
+
+def empty_answers() -> str:
+    """まだ何も回答していない状態"""
+    return UNANSWERED * len(ANSWER_WEIGHTS)
+
+
+def set_answer(answers: str, question_id: int, option_index: int) -> Optional[str]:
+    """回答を記録した新しい文字列を返す（範囲外の質問・選択肢ならNone）"""
+    if not 0 <= question_id < len(ANSWER_WEIGHTS):
+        return None
+    if not 0 <= option_index < len(ANSWER_WEIGHTS[question_id]):
+        return None
+    return answers[:question_id] + str(option_index) + answers[question_id + 1:]
+
+
+def next_question(answers: str) -> int:
+    """最初の未回答の質問番号（すべて回答済みなら質問数）"""
+    index = answers.find(UNANSWERED)
+    return len(answers) if index < 0 else index
+
+
+def is_complete(answers: str) -> bool:
+    return UNANSWERED not in answers
+
+
+def score_answers(answers: str) -> Dict[str, int]:
+    """回答から重み行列でクラスごとのスコアを計算"""
+    totals = [0] * len(CLASS_IDS)
+    for question_id, answer in enumerate(answers):
+        if answer == UNANSWERED:
+            continue
+        for i, weight in enumerate(ANSWER_WEIGHTS[question_id][int(answer)]):
+            totals[i] += weight
+    return dict(zip(CLASS_IDS, totals))
+
+
+class OnboardingStore:
+    """診断中のセッションの回答（有効期限つき）
+
+    診断中のセッションはごく少数なので、接続はひとつを使い回す。
+    path に ":memory:" を指定するとプロセス内だけで保持する。
+    """
+
+    def __init__(self, path: str, ttl: float = ONBOARDING_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # 初期化はインポート時のスレッド、読み書きはイベントループのスレッドで行う
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        return self._conn
+
+    def init(self):
+        conn = self.connect()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS onboarding (
+                    session_id TEXT PRIMARY KEY,
+                    answers TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_onboarding_expires_at ON onboarding(expires_at)")
+
+    def get(self, session_id: str, now: Optional[float] = None) -> str:
+        """回答を取得（なければ、期限切れや質問数が変わっていれば未回答）"""
+        now = time.time() if now is None else now
+        row = self.connect().execute(
+            "SELECT answers FROM onboarding WHERE session_id = ? AND expires_at > ?", (session_id, now)
+        ).fetchone()
+        if not row or len(row[0]) != len(ANSWER_WEIGHTS):
+            return empty_answers()
+        return row[0]
+
+    def put(self, session_id: str, answers: str, now: Optional[float] = None):
+        """回答を保存し、有効期限を延ばす"""
+        now = time.time() if now is None else now
+        with self.connect() as conn:
+            conn.execute("""
+                INSERT INTO onboarding (session_id, answers, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(session_id) DO UPDATE SET
+                    answers = excluded.answers,
+                    expires_at = excluded.expires_at
+            """, (session_id, answers, now + self.ttl))
+
+    def delete(self, session_id: str):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM onboarding WHERE session_id = ?", (session_id,))
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """期限切れの回答を削除し、削除した件数を返す"""
+        now = time.time() if now is None else now
+        with self.connect() as conn:
+            return conn.execute("DELETE FROM onboarding WHERE expires_at <= ?", (now,)).rowcount
+
+    def count(self) -> int:
+        return self.connect().execute("SELECT COUNT(*) FROM onboarding").fetchone()[0]
+
+
+if __name__ == "__main__":
+    # 重み行列と、期限切れの診断の削除
+    # 使い方: python onboarding.py [db_path]
+    import database
+
+    print("class order:", ", ".join(CLASS_IDS))
+    for question, row in zip(DIAGNOSTIC_QUESTIONS, ANSWER_WEIGHTS):
+        print(f"Q{question['id']}: {row}")
+
+    store = OnboardingStore(sys.argv[1] if len(sys.argv) > 1 else database.ONBOARDING_DB_PATH)
+    store.init()
+    expired = store.expire()
+    print(f"expired {expired} abandoned sessions, {store.count()} in progress")
@@ -0,0 +1,254 @@
+"""複数銘柄のポートフォリオダンジョン
+
+DUNGEONS のうち "stock_symbols" を持つダンジョンでは、同じ期間の複数銘柄を同時に売買する。
+
+- 銘柄ごとの日足は単一銘柄ダンジョンと同じ読み込み（market_data のディスクキャッシュと
+  single-flight）で取得し、全銘柄の取引日の和集合で日付をそろえた2次元配列（行が日付、列が銘柄）にする
+- 祝日や上場市場の違いで足がない日は直前の終値で埋め（始値・高値・安値も終値、出来高0）、
+  その日はその銘柄を売買できない（tradable が False）。全銘柄の足がそろう最初の日から最後の日までを使う
+- テクニカル指標は日付×銘柄のDataFrameに対して全銘柄まとめて計算する（models.indicator_columns）
+- 評価額・決算は保有株数のベクトルと当日の終値の行の内積で求める
+
+相場の行列はゲーム状態に保存せず、ダンジョンごとにプロセス内で1つだけ持つ（Basket）。
+ゲーム状態には銘柄ごとの保有株数と平均取得価格（GameState.positions / avg_prices）だけを保存するので、
+1クリックあたりの読み込み・保存の量は銘柄数が増えても単一銘柄ダンジョンとほぼ変わらない。
+
+使い方:
+    python portfolio.py bench [days]    銘柄数ごとの1クリックあたりの処理時間を単一銘柄と比較
+"""
+import json
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+import market_data
+from models import GameState, apply_event, dataframe_to_records, indicator_columns
+
+# 行列として持つ列（OHLCVとテクニカル指標）
+PRICE_FIELDS = ("open", "high", "low", "close", "volume")
+
+# プロセス内のキャッシュ: ダンジョンID -> Basket
+_baskets: Dict[str, "Basket"] = {}
+
+
+def is_portfolio(dungeon: Dict) -> bool:
+    """複数銘柄のポートフォリオダンジョンかどうか"""
+    return "stock_symbols" in dungeon
+
+
+class Basket:
+    """日付をそろえた複数銘柄の相場（各列は 日数×銘柄数 の配列）"""
+
+    def __init__(self, symbols: List[str], dates: List[str], columns: Dict[str, np.ndarray],
+                 tradable: np.ndarray):
+        self.symbols = symbols
+        self.dates = dates
+        self.columns = columns
+        self.tradable = tradable
+        self.close = columns["close"]
+        # 銘柄ごとのチャート用の足（初めて表示するときに作る）
+        self._records: Dict[int, List[Dict]] = {}
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def records(self, asset: int) -> List[Dict]:
+        """1銘柄分の足（stock_data形式、チャート表示用）"""
+        if asset not in self._records:
+            df = pd.DataFrame({name.capitalize(): self.columns[name][:, asset] for name in PRICE_FIELDS},
+                              index=pd.DatetimeIndex(self.dates))
+            for name, values in self.columns.items():
+                if name not in PRICE_FIELDS:
+                    df[name] = values[:, asset]
+            self._records[asset] = dataframe_to_records(df)
+        return self._records[asset]
+
+
+def align(symbols: List[str], frames: List[pd.DataFrame]) -> Basket:
+    """銘柄ごとのOHLCVのDataFrameを日付をそろえたBasketにする"""
+    closes = pd.concat([frame["close"] for frame in frames], axis=1, keys=range(len(symbols)), sort=True)
+    # 全銘柄の足がそろう期間に限る（上場前・データ終了後の空白は埋めない）
+    first = max(frame.index[0] for frame in frames)
+    last = min(frame.index[-1] for frame in frames)
+    closes = closes.sort_index().loc[first:last]
+    tradable = closes.notna().to_numpy()
+    close = closes.ffill()
+
+    columns: Dict[str, np.ndarray] = {"close": close.to_numpy(dtype=np.float64)}
+    for name in ("open", "high", "low"):
+        values = pd.concat([frame[name] for frame in frames], axis=1, keys=range(len(symbols)), sort=True)
+        # 休場日は値動きなし（前日の終値のまま）
+        columns[name] = values.reindex(close.index).where(tradable, close).to_numpy(dtype=np.float64)
+    volume = pd.concat([frame["volume"] for frame in frames], axis=1, keys=range(len(symbols)), sort=True)
+    columns["volume"] = volume.reindex(close.index).fillna(0).to_numpy(dtype=np.float64)
+    for name, values in indicator_columns(close).items():
+        columns[name] = values.to_numpy(dtype=np.float64)
+
+    dates = [f"{date:%Y-%m-%d}" for date in close.index]
+    return Basket(list(symbols), dates, columns, tradable)
+
+
+def _frame(records: List[Dict]) -> pd.DataFrame:
+    """stock_data形式の足をOHLCVのDataFrameにする"""
+    df = pd.DataFrame.from_records(records, columns=["date", *PRICE_FIELDS])
+    return df.set_index(pd.DatetimeIndex(df.pop("date")))
+
+
+def get_basket(dungeon: Dict) -> Basket:
+    """ダンジョンのBasketを取得（プロセス内になければ銘柄ごとの日足から作る）"""
+    basket = _baskets.get(dungeon["id"])
+    if basket is None:
+        frames = []
+        for symbol in dungeon["stock_symbols"]:
+            # 単一銘柄ダンジョンと同じ銘柄・期間ならディスクキャッシュを共有する
+            part = {"stock_symbol": symbol, "start_date": dungeon["start_date"], "end_date": dungeon["end_date"]}
+            frames.append(_frame(market_data._load_daily(part)))
+        basket = _baskets[dungeon["id"]] = align(dungeon["stock_symbols"], frames)
+    return basket
+
+
+async def load_basket(dungeon: Dict) -> Basket:
+    """Basketを取得（同時リクエストは1回の読み込みにまとめる）"""
+    basket = _baskets.get(dungeon["id"])
+    if basket is None:
+        basket = await market_data.single_flight.do(f"basket:{dungeon['id']}", get_basket, dungeon)
+    return basket
+
+
+def new_state(dungeon: Dict, basket: Basket) -> GameState:
+    """ポートフォリオダンジョンの初期ゲーム状態（相場の行列は持たない）"""
+    return GameState(
+        dungeon_id=dungeon["id"],
+        current_day=0,
+        total_days=len(basket),
+        cash=dungeon["starting_cash"],
+        positions=[0] * len(basket.symbols),
+        avg_prices=[0.0] * len(basket.symbols),
+        trade_history=[]
+    )
+
+
+def market_value(game_state: GameState, basket: Basket, day: Optional[int] = None) -> float:
+    """現金＋保有株の時価（dayを省略すると現在の足、ダンジョン終了後は最終日）"""
+    if day is None:
+        day = min(game_state.current_day, len(basket) - 1)
+    return game_state.cash + float(np.dot(game_state.positions, basket.close[day]))
+
+
+def settle(game_state: GameState, basket: Basket) -> float:
+    """最終日の終値で全銘柄を清算した資産"""
+    return market_value(game_state, basket, len(basket) - 1)
+
+
+def holdings(game_state: GameState, basket: Basket) -> List[Dict[str, Any]]:
+    """現在の足での銘柄ごとの価格・保有状況（表示用）"""
+    day = min(game_state.current_day, len(basket) - 1)
+    close = basket.close[day]
+    previous = basket.close[max(day - 1, 0)]
+    positions = np.asarray(game_state.positions)
+    values = positions * close
+    unrealized = np.where(positions > 0, (close - np.asarray(game_state.avg_prices)) * positions, 0.0)
+    change = (close - previous) / previous * 100
+    return [
+        {
+            "asset": asset,
+            "symbol": symbol,
+            "close": float(close[asset]),
+            "change_pct": float(change[asset]),
+            "tradable": bool(basket.tradable[day, asset]),
+            "shares": game_state.positions[asset],
+            "avg_price": game_state.avg_prices[asset],
+            "value": float(values[asset]),
+            "unrealized": float(unrealized[asset]),
+        }
+        for asset, symbol in enumerate(basket.symbols)
+    ]
+
+
+def trade_event(game_state: GameState, basket: Basket, asset: int, action: str) -> Optional[Dict[str, Any]]:
+    """1銘柄の現在の足の終値でのトレードをイベントにする（買いは現金の全額、売りはその銘柄の全株）
+
+    休場日の銘柄や、範囲外の銘柄は約定しない（None）。
+    """
+    day = game_state.current_day
+    if not 0 <= asset < len(basket.symbols) or day >= len(basket) or not basket.tradable[day, asset]:
+        return None
+    price = float(basket.close[day, asset])
+    event = {"type": "trade", "day": day, "action": action, "asset": asset,
+             "symbol": basket.symbols[asset], "price": price}
+
+    if action == "buy":
+        shares_to_buy = int(game_state.cash / price)
+        if shares_to_buy > 0:
+            return {**event, "shares": shares_to_buy}
+
+    elif action == "sell":
+        held = game_state.positions[asset]
+        if held > 0:
+            return {**event, "shares": held, "profit": (price - game_state.avg_prices[asset]) * held}
+    return None
+
+
+def _synthetic_basket(n_assets: int, days: int, seed: int = 0) -> Basket:
+    """ベンチマーク用: 銘柄ごとに休場日が少しずつ違うランダムウォーク"""
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range("2022-01-03", periods=days)
+    frames = []
+    for _ in range(n_assets):
+        close = 1000 * np.exp(np.cumsum(rng.normal(0, 0.02, days)))
+        frame = pd.DataFrame({"open": close, "high": close * 1.01, "low": close * 0.99,
+                              "close": close, "volume": 1e6}, index=index)
+        frames.append(frame.drop(index[1:][rng.random(days - 1) < 0.03]))
+    return align([f"SYM{i}" for i in range(n_assets)], frames)
+
+
+def bench(days: int = 250, clicks: int = 2000):
+    """1クリック（状態の読み込み→買い・売り→評価額→保存）の時間を銘柄数ごとに比べる"""
+    from models import trade_event as single_trade_event
+
+    def run(state: GameState, click) -> float:
+        state_json = state.model_dump_json()
+        started = time.perf_counter()
+        for i in range(clicks):
+            state = GameState(**json.loads(state_json))
+            state.current_day = i % state.total_days
+            click(state, i)
+            state.model_dump_json()
+        return (time.perf_counter() - started) / clicks * 1e6
+
+    single = _synthetic_basket(1, days)
+    single_state = GameState(dungeon_id="single", total_days=len(single), stock_data=single.records(0))
+
+    def single_click(state: GameState, i: int):
+        for action in ("buy", "sell"):
+            event = single_trade_event(state, action)
+            if event:
+                apply_event(state, event)
+        state.cash + state.shares * state.current_bar()["close"]
+
+    print(f"days: {days}, clicks: {clicks}")
+    print(f"single asset (stock_data in state): {run(single_state, single_click):,.0f} us/click, "
+          f"state {len(single_state.model_dump_json()):,} bytes")
+    for n_assets in (1, 3, 10, 30):
+        basket = _synthetic_basket(n_assets, days)
+        state = new_state({"id": f"bench-{n_assets}", "starting_cash": 100000}, basket)
+
+        def click(state: GameState, i: int):
+            for action in ("buy", "sell"):
+                event = trade_event(state, basket, i % n_assets, action)
+                if event:
+                    apply_event(state, event)
+            market_value(state, basket)
+
+        print(f"{n_assets:>3} assets (shared matrix):          {run(state, click):,.0f} us/click, "
+              f"state {len(state.model_dump_json()):,} bytes")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "bench":
+        print(__doc__)
+        sys.exit(1)
+    bench(int(sys.argv[2]) if len(sys.argv) > 2 else 250)
@@ -0,0 +1,245 @@
+"""ダンジョン結果の評価（後知恵の最適解・ガチホ・ランダム売買との比較）
+
+結果画面の損益は開始資金10,000円との比較しかなく、相場に対してどれだけ上手く
+立ち回れたかが分からない。ここではダンジョンごとに次の基準を一度だけ計算しておく:
+
+- 最適解: 全額買い・全株売り（models.trade_event）のルールで、未来の値動きを知っていれば
+  到達できた最終資産。売買回数無制限と、売り（決済）k回までのそれぞれ
+- ガチホ: 初日に全額で買って最後まで持ち続けた場合の最終資産
+- ランダム売買: 毎日一定の確率で買い・売りを押すプレイヤーを大量に模擬した最終資産の分布
+
+株数は切り捨てなので、最適解の状態は「ノーポジションの現金」と「株数ごとの残り現金の最大」で持つ。
+ノーポジションの現金は多いほど良い（同じ売買で損をしない）ため、各日の最大だけを残せば正確に求まる。
+保有中の状態は株数ごとに1つ（より少ない株数かつ少ない残り現金の状態は捨てる）なので、
+計算量は売買無制限でO(n·S)、k回まででO(n·k·S)になる（Sは同時に残る株数の種類で、通常は数個）。
+
+結果は RATING_DIR にダンジョンごとのJSONとして保存し、結果画面では読み込むだけにする。
+
+使い方:
+    python rating.py [dungeon_id...]    日足ダンジョンの基準を計算して保存し、表示する
+"""
+import bisect
+import json
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+RATING_DIR = "ratings"
+# ゲームの開始資金（GameState.cash の初期値）
+STARTING_CASH = 10000.0
+# 売買回数を制限した最適解を求める最大の回数
+MAX_RATED_TRADES = 10
+# ランダム売買の模擬人数と、1日に買い（売り）を押す確率
+RANDOM_PATHS = 10000
+RANDOM_CLICK_PROB = 0.1
+RANDOM_SEED = 0
+# 保存する分布の分位点（0〜100%を1%刻み）
+QUANTILES = np.linspace(0, 100, 101)
+
+# プロセス内のキャッシュ: ダンジョンID -> 基準
+_ratings: Dict[str, Dict] = {}
+
+
+def _add_holding(holdings: Dict[int, float], shares: int, cash: float):
+    """保有状態（株数 -> 残り現金の最大）に追加"""
+    if shares > 0 and cash > holdings.get(shares, -1.0):
+        holdings[shares] = cash
+
+
+def _prune(holdings: Dict[int, float]) -> Dict[int, float]:
+    """株数も残り現金も他の状態以下の状態を捨てる"""
+    kept: Dict[int, float] = {}
+    best_cash = -1.0
+    for shares in sorted(holdings, reverse=True):
+        if holdings[shares] > best_cash:
+            kept[shares] = holdings[shares]
+            best_cash = holdings[shares]
+    return kept
+
+
+def _buy(holdings: Dict[int, float], cash: float, price: float):
+    """ノーポジションの現金で全額買った状態を追加"""
+    shares = int(cash / price)
+    _add_holding(holdings, shares, cash - shares * price)
+
+
+def optimal_final(closes: Sequence[float], cash: float = STARTING_CASH) -> float:
+    """売買回数無制限の最適な最終資産
+
+    同じ足での売りと買いは、保有中に残り現金で買い増すのと同じ状態になるので、買い増しも含まれる。
+    """
+    flat = cash
+    holdings: Dict[int, float] = {}
+    for price in closes:
+        flat = max([flat] + [rest + shares * price for shares, rest in holdings.items()])
+        _buy(holdings, flat, price)
+        holdings = _prune(holdings)
+    # 最後まで持っていれば最終日の終値で評価される
+    return max([flat] + [rest + shares * closes[-1] for shares, rest in holdings.items()])
+
+
+def optimal_finals_by_trades(closes: Sequence[float], max_trades: int = MAX_RATED_TRADES,
+                             cash: float = STARTING_CASH) -> List[float]:
+    """売り（決済）をk回まで（k = 0..max_trades）に制限した最適な最終資産
+
+    flat[t] は t回売った後のノーポジションの現金、holdings[t] は t+1回目の買いの保有状態。
+    保有中の買い増しは売りの回数を使わない。
+    """
+    flat = [cash] + [-1.0] * max_trades
+    holdings: List[Dict[int, float]] = [{} for _ in range(max_trades)]
+    for price in closes:
+        for t in range(max_trades, 0, -1):
+            for shares, rest in holdings[t - 1].items():
+                flat[t] = max(flat[t], rest + shares * price)
+        for t in range(max_trades):
+            current = holdings[t]
+            for shares, rest in list(current.items()):
+                if rest >= price:
+                    # 残り現金での買い増し
+                    extra = int(rest / price)
+                    _add_holding(current, shares + extra, rest - extra * price)
+            if flat[t] >= 0:
+                _buy(current, flat[t], price)
+            holdings[t] = _prune(current)
+
+    finals = []
+    for t in range(max_trades + 1):
+        final = flat[t]
+        if t < max_trades:
+            # 最後の買いを持ったまま終えた場合（売りの回数は増えない）
+            final = max([final] + [rest + shares * closes[-1] for shares, rest in holdings[t].items()])
+        finals.append(max(final, finals[-1]) if finals else final)
+    return finals
+
+
+def buy_and_hold_final(closes: Sequence[float], cash: float = STARTING_CASH) -> float:
+    """初日に全額で買って最後まで持ち続けた最終資産"""
+    shares = int(cash / closes[0])
+    return cash - shares * closes[0] + shares * closes[-1]
+
+
+def random_finals(closes: Sequence[float], cash: float = STARTING_CASH, paths: int = RANDOM_PATHS,
+                  click_prob: float = RANDOM_CLICK_PROB, seed: int = RANDOM_SEED) -> np.ndarray:
+    """毎日 click_prob の確率で買い、同じ確率で売りを押すプレイヤーをpaths人ぶん同時に模擬した最終資産"""
+    rng = np.random.default_rng(seed)
+    wallet = np.full(paths, float(cash))
+    shares = np.zeros(paths, dtype=np.int64)
+    for price in closes:
+        clicks = rng.random(paths)
+        buying = (clicks < click_prob) & (shares == 0)
+        bought = np.floor(wallet[buying] / price).astype(np.int64)
+        shares[buying] = bought
+        wallet[buying] -= bought * price
+        selling = (clicks >= 1 - click_prob) & (shares > 0)
+        wallet[selling] += shares[selling] * price
+        shares[selling] = 0
+    return wallet + shares * closes[-1]
+
+
+def build_rating(closes: Sequence[float], cash: float = STARTING_CASH) -> Dict:
+    """終値の列からダンジョンの評価基準を計算"""
+    closes = [float(price) for price in closes]
+    return {
+        "days": len(closes),
+        "last_close": closes[-1],
+        "cash": cash,
+        "optimal": optimal_final(closes, cash),
+        "optimal_by_trades": optimal_finals_by_trades(closes, MAX_RATED_TRADES, cash),
+        "buy_and_hold": buy_and_hold_final(closes, cash),
+        "random_paths": RANDOM_PATHS,
+        "random_quantiles": np.percentile(random_finals(closes, cash), QUANTILES).tolist(),
+    }
+
+
+def _rating_path(dungeon_id: str) -> str:
+    return os.path.join(RATING_DIR, f"{dungeon_id}.json")
+
+
+def get_rating(dungeon_id: str) -> Optional[Dict]:
+    """保存済みの評価基準を取得（まだ計算されていなければNone）"""
+    if dungeon_id in _ratings:
+        return _ratings[dungeon_id]
+    path = _rating_path(dungeon_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            _ratings[dungeon_id] = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading rating for {dungeon_id}: {e}")
+        return None
+    return _ratings[dungeon_id]
+
+
+def ensure_rating(dungeon_id: str, closes: Sequence[float]) -> Dict:
+    """評価基準がないか、相場データが変わっていれば計算して保存"""
+    rating = get_rating(dungeon_id)
+    if rating and rating["days"] == len(closes) and rating["last_close"] == float(closes[-1]):
+        return rating
+
+    rating = build_rating(closes)
+    os.makedirs(RATING_DIR, exist_ok=True)
+    path = _rating_path(dungeon_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(rating, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+    _ratings[dungeon_id] = rating
+    return rating
+
+
+def _percentile(quantiles: List[float], value: float) -> float:
+    """分位点の列で value が下から何%の位置か（同じ値が続く場合はその中央）"""
+    low = bisect.bisect_left(quantiles, value)
+    high = bisect.bisect_right(quantiles, value)
+    return min(100.0, (low + high) / 2 * 100 / (len(quantiles) - 1))
+
+
+def rate_result(rating: Dict, final_value: float, sells: int) -> Dict:
+    """プレイヤーの最終資産を基準と比べる
+
+    efficiency は最適解で得られた利益のうち実際に得た割合（利益が出せない相場ではNone）。
+    """
+    cash = rating["cash"]
+    by_trades = rating["optimal_by_trades"]
+    same_trades = by_trades[min(sells, len(by_trades) - 1)]
+
+    def efficiency(best: float) -> Optional[float]:
+        if best <= cash:
+            return None
+        return max(0.0, min(1.0, (final_value - cash) / (best - cash)))
+
+    return {
+        "optimal_percent": (rating["optimal"] - cash) / cash * 100,
+        "efficiency": efficiency(rating["optimal"]),
+        "same_trades_percent": (same_trades - cash) / cash * 100,
+        "same_trades_efficiency": efficiency(same_trades),
+        "buy_and_hold_percent": (rating["buy_and_hold"] - cash) / cash * 100,
+        "beat_buy_and_hold": final_value > rating["buy_and_hold"],
+        "random_percentile": _percentile(rating["random_quantiles"], final_value),
+        "random_median_percent": (rating["random_quantiles"][50] - cash) / cash * 100,
+    }
+
+
+if __name__ == "__main__":
+    import market_data
+    from models import DUNGEONS
+
+    # ポートフォリオダンジョン（複数銘柄）は対象外
+    ids = sys.argv[1:] or [d["id"] for d in DUNGEONS
+                           if d.get("resolution", "1d") == "1d" and "stock_symbols" not in d]
+    for dungeon in DUNGEONS:
+        if dungeon["id"] not in ids:
+            continue
+        closes = [bar["close"] for bar in market_data._load_daily(dungeon)]
+        started = time.perf_counter()
+        rating = ensure_rating(dungeon["id"], closes)
+        elapsed = (time.perf_counter() - started) * 1000
+        cash = rating["cash"]
+        print(f"{dungeon['id']:>12}  days={rating['days']}  optimal={rating['optimal'] / cash - 1:+.1%}  "
+              f"1 trade={rating['optimal_by_trades'][1] / cash - 1:+.1%}  "
+              f"buy&hold={rating['buy_and_hold'] / cash - 1:+.1%}  "
+              f"random median={rating['random_quantiles'][50] / cash - 1:+.1%}  ({elapsed:,.0f} ms)")
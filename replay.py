@@ -0,0 +1,360 @@
+"""完了した挑戦のトレードの再実行による検証
+
+記録されたトレード（ゲーム状態の trade_history、またはイベントログのトレード）を、ダンジョンの正規の相場
+（日足のディスクキャッシュ・分足ストア・生成ダンジョンの日足・ポートフォリオの行列）に対して
+models.trade_event / apply_event と同じ規則で最初から実行し直し、最終的な資産を求め直す。
+トレードごとに次を確かめ、最初に破っていたトレードを返す:
+- day: 日が前のトレードより前に戻らず、期間内である（ポートフォリオでは銘柄も範囲内）
+- closed: その日にその銘柄を売買できる（ポートフォリオの休場日でない）
+- price: 価格がその日の終値と一致する
+- shares: 買いはその時点の現金で買える最大の株数（int(現金 / 価格)、1株以上）、売りはその時点の保有株数
+- profit: 売りの損益が (価格 - 平均取得価格) × 株数 と一致する
+規則を破ったトレードとそれ以降は約定しなかったものとして、それまでのトレードだけで資産を求める。
+
+同じダンジョンの挑戦はまとめて、トレードの順番ごとに全挑戦を配列で同時に進める（挑戦ごとのループがない）。
+
+使い方:
+    python replay.py audit [limit]    完了した挑戦を検証し、記録された資産・XP・ゴールドが再実行と違うものを表示
+    python replay.py bench [runs]     1秒あたりに検証できる挑戦数（1件ずつ apply_event で再実行する場合と比較）
+"""
+import sys
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import bar_store
+import codec
+import generator
+import market_data
+import portfolio
+from models import dungeon_rewards
+
+# 規則違反の理由（コード -> 名前、0 は違反なし）
+REASONS = (None, "day", "closed", "price", "shares", "profit")
+DAY, CLOSED, PRICE, SHARES, PROFIT = range(1, len(REASONS))
+
+# 記録された資産と再実行した資産の許容差（円）
+VALUE_TOLERANCE = 0.01
+# 記録された損益と再計算した損益の許容差（円）
+PROFIT_TOLERANCE = 1e-6
+
+# 監査で一度に読む挑戦の数と、イベントを run_id で引くときのIN句の大きさ
+AUDIT_BATCH = 2000
+RUN_ID_CHUNK = 500
+
+# プロセス内のキャッシュ: ダンジョンID -> Series
+_series: Dict[str, "Series"] = {}
+
+
+class Series:
+    """ダンジョンの正規の終値（日数×銘柄数）と、その日に売買できるか"""
+
+    def __init__(self, closes: np.ndarray, tradable: Optional[np.ndarray] = None):
+        self.closes = closes
+        self.tradable = np.ones(closes.shape, dtype=bool) if tradable is None else tradable
+
+    def __len__(self) -> int:
+        return len(self.closes)
+
+
+def load_series(dungeon: Dict) -> Series:
+    """ダンジョンの正規の終値（ゲーム開始時と同じ読み込み。相場のキャッシュは書き換わらない）
+
+    相場の取得やファイルロックの待ちで止まることがあるので、リクエストの中では fetch_series を使う。
+    """
+    series = _series.get(dungeon["id"])
+    if series is None:
+        if portfolio.is_portfolio(dungeon):
+            basket = portfolio.get_basket(dungeon)
+            series = Series(basket.close, basket.tradable)
+        else:
+            if bar_store.is_intraday(dungeon):
+                closes = bar_store.load_closes(dungeon["id"])
+            elif generator.is_generated(dungeon):
+                closes = [bar["close"] for bar in generator._stock_records(dungeon["id"])]
+            else:
+                closes = [bar["close"] for bar in market_data._load_daily(dungeon)]
+            series = Series(np.asarray(closes, dtype=np.float64).reshape(-1, 1))
+        _series[dungeon["id"]] = series
+    return series
+
+
+async def fetch_series(dungeon: Dict) -> Series:
+    """ダンジョンの正規の終値を取得（読み込みはスレッドで行い、同時リクエストは1回の読み込みにまとめる）"""
+    series = _series.get(dungeon["id"])
+    if series is None:
+        series = await market_data.single_flight.do(f"series:{dungeon['id']}", load_series, dungeon)
+    return series
+
+
+def _pack(histories: Sequence[Sequence[Dict[str, Any]]]) -> Dict[str, np.ndarray]:
+    """トレードの履歴を 挑戦数×最大トレード数 の配列にする（余りはcountsで区別する）"""
+    counts = np.array([len(history) for history in histories], dtype=np.int64)
+    width = int(counts.max()) if len(counts) else 0
+    flat = [trade for history in histories for trade in history]
+    rows = np.repeat(np.arange(len(histories)), counts)
+    cols = np.arange(len(flat)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    def column(values, dtype, fill=0):
+        packed = np.full((len(histories), width), fill, dtype=dtype)
+        packed[rows, cols] = np.asarray(values, dtype=dtype)
+        return packed
+
+    return {
+        "counts": counts,
+        "day": column([trade["day"] for trade in flat], np.int64),
+        # 単一銘柄ダンジョンのトレードに asset はない（銘柄0）
+        "asset": column([trade.get("asset") or 0 for trade in flat], np.int64),
+        "buy": column([trade["action"] == "buy" for trade in flat], bool, False),
+        "price": column([trade["price"] for trade in flat], np.float64),
+        "shares": column([trade["shares"] for trade in flat], np.int64),
+        "profit": column([trade.get("profit", np.nan) for trade in flat], np.float64, np.nan),
+    }
+
+
+def replay(series: Series, starting_cash: float,
+           histories: Sequence[Sequence[Dict[str, Any]]]) -> Dict[str, np.ndarray]:
+    """同じダンジョンの挑戦のトレードをまとめて再実行する
+
+    挑戦ごとの最終的な資産（final_value）、最初に規則を破ったトレードの番号（error_trade、なければ-1）と
+    その理由のコード（reason、REASONS の添字）を返す。
+    """
+    trades = _pack(histories)
+    n_runs, width = trades["day"].shape
+    n_days, n_assets = series.closes.shape
+
+    cash = np.full(n_runs, float(starting_cash))
+    held = np.zeros((n_runs, n_assets), dtype=np.int64)
+    avg_price = np.zeros((n_runs, n_assets))
+    last_day = np.zeros(n_runs, dtype=np.int64)
+    error_trade = np.full(n_runs, -1, dtype=np.int64)
+    reason = np.zeros(n_runs, dtype=np.int8)
+
+    for k in range(width):
+        runs = np.nonzero((k < trades["counts"]) & (error_trade < 0))[0]
+        if len(runs) == 0:
+            break
+        day, asset = trades["day"][runs, k], trades["asset"][runs, k]
+        buy, shares = trades["buy"][runs, k], trades["shares"][runs, k]
+        failed = np.zeros(len(runs), dtype=np.int8)
+
+        def flag(mask: np.ndarray, code: int):
+            failed[(failed == 0) & mask] = code
+
+        flag((day < last_day[runs]) | (day >= n_days) | (day < 0) | (asset < 0) | (asset >= n_assets), DAY)
+        day, asset = np.clip(day, 0, n_days - 1), np.clip(asset, 0, n_assets - 1)
+        close = series.closes[day, asset]
+        flag(~series.tradable[day, asset], CLOSED)
+        flag(trades["price"][runs, k] != close, PRICE)
+        run_cash, run_held, run_avg = cash[runs], held[runs, asset], avg_price[runs, asset]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            affordable = np.floor(run_cash / close)
+        flag(buy & ((shares != affordable) | (shares <= 0)), SHARES)
+        flag(~buy & ((shares != run_held) | (run_held <= 0)), SHARES)
+        profit = trades["profit"][runs, k]
+        flag(~buy & ~(np.abs(profit - (close - run_avg) * shares) <= PROFIT_TOLERANCE), PROFIT)
+
+        error_trade[runs[failed > 0]] = k
+        reason[runs[failed > 0]] = failed[failed > 0]
+
+        # 規則どおりのトレードだけを apply_event と同じ計算で反映する
+        ok = failed == 0
+        runs, asset, buy, shares, close = runs[ok], asset[ok], buy[ok], shares[ok], close[ok]
+        run_held, run_avg, cost = run_held[ok], run_avg[ok], shares * close
+        cash[runs] = np.where(buy, cash[runs] - cost, cash[runs] + cost)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            averaged = np.where(run_held > 0, (run_avg * run_held + cost) / (run_held + shares), close)
+        held[runs, asset] = np.where(buy, run_held + shares, 0)
+        avg_price[runs, asset] = np.where(buy, averaged, 0.0)
+        last_day[runs] = day[ok]
+
+    final_value = cash + (held * series.closes[-1]).sum(axis=1)
+    return {"final_value": final_value, "error_trade": error_trade, "reason": reason}
+
+
+async def replay_state(dungeon: Dict, game_state) -> Optional[Dict[str, Any]]:
+    """1つのゲーム状態のトレードを再実行する（相場が読み込めなければNone）"""
+    try:
+        series = await fetch_series(dungeon)
+    except Exception as e:
+        print(f"Error loading series for replay of {dungeon['id']}: {e}")
+        return None
+    result = replay(series, dungeon.get("starting_cash", 10000), [game_state.trade_history])
+    error_trade = int(result["error_trade"][0])
+    return {
+        "final_value": float(result["final_value"][0]),
+        "error": None if error_trade < 0 else f"trade {error_trade}: {REASONS[result['reason'][0]]}",
+    }
+
+
+def same_value(recorded: float, replayed: float) -> bool:
+    return abs(recorded - replayed) <= VALUE_TOLERANCE
+
+
+def _run_trades(source, run_ids: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """挑戦ごとのトレードをイベントログから読む"""
+    trades: Dict[str, List[Dict[str, Any]]] = {run_id: [] for run_id in run_ids}
+    conn = source.connect()
+    for start in range(0, len(run_ids), RUN_ID_CHUNK):
+        chunk = run_ids[start:start + RUN_ID_CHUNK]
+        for event_row in conn.execute(f"""
+            SELECT run_id, data FROM game_events WHERE run_id IN ({", ".join("?" for _ in chunk)})
+            ORDER BY run_id, seq
+        """, chunk):
+            event = codec.loads(event_row["data"])
+            if event.get("type") == "trade":
+                trades[event_row["run_id"]].append(event)
+    conn.close()
+    return trades
+
+
+def audit_runs(dungeon: Dict, runs: List[Dict[str, Any]],
+               histories: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """同じダンジョンの挑戦を再実行し、記録と食い違うものを返す
+
+    XP・ゴールドは決算で記録した値と、再実行した損益率から求めた値を比べる（記録がない挑戦は比べない）。
+    """
+    starting_cash = dungeon.get("starting_cash", 10000)
+    result = replay(load_series(dungeon), starting_cash, histories)
+    findings = []
+    for i, run in enumerate(runs):
+        recorded_value = starting_cash + run["profit_loss"]
+        replayed_value = float(result["final_value"][i])
+        recorded_award = (run["xp_earned"], run["gold_earned"])
+        replayed_award = dungeon_rewards(dungeon, (replayed_value - starting_cash) / starting_cash * 100)
+        problems = []
+        if result["error_trade"][i] >= 0:
+            problems.append(f"trade {result['error_trade'][i]}: {REASONS[result['reason'][i]]}")
+        if not same_value(recorded_value, replayed_value):
+            problems.append("final value")
+        if None not in recorded_award and recorded_award != replayed_award:
+            problems.append("xp/gold")
+        if problems:
+            findings.append({**run, "problems": problems, "recorded_value": recorded_value,
+                             "replayed_value": replayed_value, "recorded_award": recorded_award,
+                             "replayed_award": replayed_award})
+    return findings
+
+
+def audit(backend=None, limit: Optional[int] = None, batch_size: int = AUDIT_BATCH) -> Dict[str, Any]:
+    """完了した挑戦を検証し、食い違いを表示して件数を返す
+
+    イベントログ以前の挑戦（トレードのイベントが記録の取引数とそろわないもの）と、
+    相場を読み込めないダンジョンの挑戦は検証できないので数えるだけにする。
+    """
+    import database
+    from export import player_id, sqlite_backends
+
+    if backend is None:
+        backend = database.create_backend()
+        backend.init()
+    counts = {"checked": 0, "flagged": 0, "skipped": 0}
+    started = time.perf_counter()
+    for source in sqlite_backends(backend):
+        last_rowid = 0
+        while limit is None or counts["checked"] + counts["skipped"] < limit:
+            conn = source.connect()
+            rows = [dict(row) for row in conn.execute("""
+                SELECT rowid, run_id, session_id, dungeon_id, trades, profit_loss, profit_loss_percent,
+                       xp_earned, gold_earned
+                FROM runs WHERE rowid > ? ORDER BY rowid LIMIT ?
+            """, (last_rowid, batch_size))]
+            conn.close()
+            if not rows:
+                break
+            last_rowid = rows[-1]["rowid"]
+            trades = _run_trades(source, [row["run_id"] for row in rows])
+
+            by_dungeon: Dict[str, List[Dict[str, Any]]] = {}
+            for row in rows:
+                if len(trades[row["run_id"]]) != row["trades"]:
+                    counts["skipped"] += 1
+                else:
+                    by_dungeon.setdefault(row["dungeon_id"], []).append(row)
+            for dungeon_id, runs in by_dungeon.items():
+                dungeon = generator.find_dungeon(dungeon_id)
+                try:
+                    if dungeon is None:
+                        raise ValueError("unknown dungeon")
+                    findings = audit_runs(dungeon, runs, [trades[run["run_id"]] for run in runs])
+                except Exception as e:
+                    print(f"Error replaying {dungeon_id}: {e}")
+                    counts["skipped"] += len(runs)
+                    continue
+                counts["checked"] += len(runs)
+                counts["flagged"] += len(findings)
+                for finding in findings:
+                    print(f"{finding['run_id']}  player={player_id(finding['session_id'])}  {dungeon_id:>12}  "
+                          f"{', '.join(finding['problems'])}  value {finding['recorded_value']:,.2f} -> "
+                          f"{finding['replayed_value']:,.2f}  xp/gold {finding['recorded_award']} -> "
+                          f"{finding['replayed_award']}")
+    counts["seconds"] = time.perf_counter() - started
+    return counts
+
+
+def _synthetic_runs(series: Series, n_runs: int, seed: int = 0) -> Tuple[List[List[Dict]], List[float]]:
+    """ベンチマーク用: ランダムに売買した挑戦のトレードと最終的な資産（models.apply_trade で作る）"""
+    from models import GameState, apply_trade
+
+    rng = np.random.default_rng(seed)
+    bars = [{"close": float(close)} for close in series.closes[:, 0]]
+    histories, finals = [], []
+    for _ in range(n_runs):
+        state = GameState(dungeon_id="bench", total_days=len(bars), stock_data=bars)
+        for day in np.sort(rng.choice(len(bars), size=20, replace=False)):
+            state.current_day = int(day)
+            apply_trade(state, "sell" if state.shares else "buy")
+        histories.append(state.trade_history)
+        finals.append(state.cash + state.shares * bars[-1]["close"])
+    return histories, finals
+
+
+def bench(n_runs: int = 5000):
+    """ベクトル化した再実行と、1件ずつ apply_event で再実行する場合の速度を比べる"""
+    from models import GameState, apply_event
+
+    rng = np.random.default_rng(1)
+    closes = 1000 * np.exp(np.cumsum(rng.normal(0, 0.02, 250)))
+    series = Series(closes.reshape(-1, 1))
+    histories, finals = _synthetic_runs(series, n_runs)
+    # 1%の挑戦の約定価格を書き換える
+    tampered = set(rng.choice(n_runs, size=n_runs // 100, replace=False).tolist())
+    for i in tampered:
+        histories[i] = [dict(trade) for trade in histories[i]]
+        histories[i][0]["price"] *= 0.9
+
+    started = time.perf_counter()
+    result = replay(series, 10000, histories)
+    vectorized = time.perf_counter() - started
+    flagged = set(np.nonzero(result["error_trade"] >= 0)[0].tolist())
+    clean = [i for i in range(n_runs) if i not in tampered]
+    assert flagged == tampered
+    assert np.allclose(result["final_value"][clean], np.asarray(finals)[clean], rtol=0, atol=1e-9)
+
+    started = time.perf_counter()
+    for history in histories[:1000]:
+        state = GameState(dungeon_id="bench", total_days=len(closes))
+        for trade in history:
+            apply_event(state, {"type": "trade", **trade})
+        state.cash + state.shares * closes[-1]
+    per_run = (time.perf_counter() - started) / min(n_runs, 1000)
+
+    trades = sum(len(history) for history in histories)
+    print(f"{n_runs:,} runs, {trades:,} trades, {len(tampered)} tampered (all flagged, clean runs match)")
+    print(f"  vectorized replay: {n_runs / vectorized:>10,.0f} runs/s")
+    print(f"  apply_event loop:  {1 / per_run:>10,.0f} runs/s (no checks)")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "audit":
+        counts = audit(limit=int(sys.argv[2]) if len(sys.argv) > 2 else None)
+        print(f"checked {counts['checked']:,} runs, flagged {counts['flagged']:,}, skipped {counts['skipped']:,} "
+              f"({counts['checked'] / max(counts['seconds'], 1e-9):,.0f} runs/s)")
+        sys.exit(1 if counts["flagged"] else 0)
+    elif command == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 5000)
+    else:
+        print(__doc__)
+        sys.exit(1)
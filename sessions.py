@@ -0,0 +1,196 @@
+"""セッション管理（ASGIミドルウェア）
+
+クッキー session_id の値は "<セッションID>.<発行時刻(UNIX秒)>"。
+- Set-Cookie を返すのは、新しいセッションと、発行から SESSION_REFRESH_AFTER を過ぎて期限が近づいたクッキーだけ
+  （発行時刻のない以前の形式のクッキーは、次の応答で同じセッションIDのまま発行し直す）
+- /static/ 以下のリクエストはセッションを扱わない（クッキーも返さない）
+- request.state.session_id と request.state.session（Session）を設定する。プロフィールは
+  リクエスト中に初めて参照したときに1回だけ読み込む
+
+使い方:
+    python sessions.py bench [requests]    1リクエストあたりのミドルウェアの処理時間を以前の実装と比較
+"""
+import asyncio
+import sys
+import time
+import uuid
+from typing import Optional, Tuple
+
+from starlette.datastructures import MutableHeaders
+from starlette.requests import cookie_parser
+
+import database
+from models import UserProfile
+
+COOKIE_NAME = "session_id"
+SESSION_MAX_AGE = database.SESSION_MAX_AGE
+# 発行からこれだけ経ったクッキーは期限を延ばすため発行し直す（残りが半分を切ったら）
+SESSION_REFRESH_AFTER = SESSION_MAX_AGE // 2
+# セッションを扱わないパス
+EXCLUDED_PREFIXES = ("/static/",)
+
+
+class Session:
+    """1リクエストの間のセッション（プロフィールは初めて参照したときに読み込む）"""
+
+    __slots__ = ("id", "is_new", "_profile", "_loaded")
+
+    def __init__(self, session_id: str, is_new: bool = False):
+        self.id = session_id
+        self.is_new = is_new
+        self._profile: Optional[UserProfile] = None
+        # 新しいセッションにはプロフィールがないので読みに行かない
+        self._loaded = is_new
+
+    @property
+    def profile(self) -> Optional[UserProfile]:
+        if not self._loaded:
+            self._profile = database.get_user_by_session(self.id)
+            self._loaded = True
+        return self._profile
+
+    def set_profile(self, profile: Optional[UserProfile]):
+        """保存・削除したプロフィールでリクエスト中のキャッシュを置き換える"""
+        self._profile = profile
+        self._loaded = True
+
+
+def parse_cookie(value: Optional[str]) -> Tuple[Optional[str], Optional[int]]:
+    """クッキーの値から (セッションID, 発行時刻) を取り出す（発行時刻がない・不正ならNone）"""
+    if not value:
+        return None, None
+    session_id, _, issued = value.partition(".")
+    try:
+        return session_id, int(issued)
+    except ValueError:
+        return session_id, None
+
+
+def _request_cookie(scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            return cookie_parser(value.decode("latin-1")).get(COOKIE_NAME)
+    return None
+
+
+class SessionMiddleware:
+    """セッションIDをクッキーで管理するASGIミドルウェア"""
+
+    def __init__(self, app, max_age: int = SESSION_MAX_AGE, refresh_after: int = SESSION_REFRESH_AFTER,
+                 excluded_prefixes: Tuple[str, ...] = EXCLUDED_PREFIXES):
+        self.app = app
+        self.max_age = max_age
+        self.refresh_after = refresh_after
+        self.excluded_prefixes = excluded_prefixes
+
+    def set_cookie_header(self, session_id: str, issued: int) -> bytes:
+        return (f"{COOKIE_NAME}={session_id}.{issued}; Max-Age={self.max_age}; Path=/; SameSite=lax"
+                .encode("latin-1"))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.excluded_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        now = int(time.time())
+        session_id, issued = parse_cookie(_request_cookie(scope))
+        is_new = not session_id
+        if is_new:
+            session_id = str(uuid.uuid4())
+        else:
+            # 期限切れのセッションとして削除されないよう、アクセスを記録する
+            database.touch_session(session_id)
+
+        state = scope.setdefault("state", {})
+        state["session_id"] = session_id
+        state["session"] = Session(session_id, is_new)
+
+        if not is_new and issued is not None and 0 <= now - issued < self.refresh_after:
+            await self.app(scope, receive, send)
+            return
+
+        cookie = self.set_cookie_header(session_id, now)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).raw.append((b"set-cookie", cookie))
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+
+def bench(requests: int = 20000):
+    """何もしないアプリの前に置いたときの1リクエストあたりの時間（以前のBaseHTTPMiddleware版と比較）"""
+    from starlette.applications import Starlette
+    from starlette.middleware import Middleware
+    from starlette.middleware.base import BaseHTTPMiddleware
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route
+
+    class LegacySessionMiddleware(BaseHTTPMiddleware):
+        """以前の実装（毎回クッキーを設定する）"""
+        async def dispatch(self, request, call_next):
+            session_id = request.cookies.get(COOKIE_NAME) or str(uuid.uuid4())
+            if COOKIE_NAME in request.cookies:
+                database.touch_session(session_id)
+            request.state.session_id = session_id
+            response = await call_next(request)
+            response.set_cookie(key=COOKIE_NAME, value=session_id, max_age=SESSION_MAX_AGE, path="/",
+                                httponly=False, samesite="lax", secure=False)
+            return response
+
+    async def endpoint(request):
+        return PlainTextResponse("ok")
+
+    def make_app(middleware):
+        return Starlette(routes=[Route("/home", endpoint), Route("/static/css/style.css", endpoint)],
+                         middleware=middleware)
+
+    session_id = str(uuid.uuid4())
+    fresh_cookie = f"{COOKIE_NAME}={session_id}.{int(time.time())}".encode()
+    legacy_cookie = f"{COOKIE_NAME}={session_id}".encode()
+
+    async def run(app, path: str, cookie: Optional[bytes]) -> Tuple[float, int]:
+        headers = [(b"host", b"localhost")] + ([(b"cookie", cookie)] if cookie else [])
+        set_cookies = 0
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            nonlocal set_cookies
+            if message["type"] == "http.response.start":
+                set_cookies += sum(1 for name, _ in message["headers"] if name == b"set-cookie")
+
+        started = time.perf_counter()
+        for _ in range(requests):
+            scope = {"type": "http", "method": "GET", "path": path, "raw_path": path.encode(),
+                     "query_string": b"", "headers": list(headers), "scheme": "http", "http_version": "1.1",
+                     "server": ("localhost", 80), "client": ("127.0.0.1", 1234), "root_path": ""}
+            await app(scope, receive, send)
+        return (time.perf_counter() - started) / requests * 1e6, set_cookies
+
+    async def main():
+        bare = make_app([])
+        legacy = make_app([Middleware(LegacySessionMiddleware)])
+        current = make_app([Middleware(SessionMiddleware)])
+        baseline, _ = await run(bare, "/home", fresh_cookie)
+        print(f"{requests:,} requests, no middleware: {baseline:.1f} us/request")
+        for label, app, path, cookie in (
+            ("BaseHTTPMiddleware (before), page", legacy, "/home", legacy_cookie),
+            ("BaseHTTPMiddleware (before), static", legacy, "/static/css/style.css", legacy_cookie),
+            ("ASGI (after), page", current, "/home", fresh_cookie),
+            ("ASGI (after), static", current, "/static/css/style.css", fresh_cookie),
+            ("ASGI (after), new session", current, "/home", None),
+        ):
+            elapsed, set_cookies = await run(app, path, cookie)
+            print(f"  {label:<38} {elapsed - baseline:+6.1f} us/request, Set-Cookie on {set_cookies:,} responses")
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "bench":
+        print(__doc__)
+        sys.exit(1)
+    bench(int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
@@ -0,0 +1,1080 @@
+"""ストレージバックエンド
+
+database.py の関数はこのインターフェースを通してデータを読み書きする。
+
+- SQLiteBackend: 単一のSQLiteファイル（従来の game.db）
+- ShardedSQLiteBackend: session_idのコンシステントハッシュでN個のSQLiteファイルに分散。
+  書き込みロックがファイルごとになるため、同時プレイヤー数に応じてスケールする
+- MemoryBackend: テスト用の純粋なインメモリ実装
+"""
+import bisect
+import hashlib
+import json
+import operator
+import os
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# JSONから取り出してインデックスを張る生成列（VIRTUAL なので値は保存されず、インデックスだけが持つ）
+USER_COLUMNS = {
+    "player_class": "TEXT",
+    "level": "INTEGER",
+    "xp": "INTEGER",
+    "gold": "INTEGER",
+    "total_profit": "REAL",
+}
+GAME_STATE_COLUMNS = {
+    "dungeon_id": "TEXT",
+}
+GENERATED_INDEXES = {
+    "idx_users_level": "users(level)",
+    "idx_users_total_profit": "users(total_profit)",
+    # クラス別の集計をインデックスだけで行う（カバリングインデックス）
+    "idx_users_class_stats": "users(player_class, level, xp, gold, total_profit)",
+    "idx_game_states_dungeon_id": "game_states(dungeon_id, session_id)",
+}
+# aggregate_users の絞り込みで使える演算子
+FILTER_OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+# runs テーブルに保存するダンジョン挑戦の集計
+RUN_FIELDS = ("run_id", "dungeon_id", "trades", "sells", "wins", "profit_loss", "profit_loss_percent",
+              "carried_over", "xp_earned", "gold_earned")
+# 以前の通算を引き継いだ挑戦のIDの接頭辞
+LEGACY_RUN_PREFIX = "legacy-"
+# 後から runs に追加した列（既存のファイルには init() で追加する）と、追加したときに既存の行を直すSQL
+# carried_over: 記録がなかった以前のプレイヤーの通算を引き継いだ行（取引数だけが正確で、売り・勝ちは0）
+# xp_earned / gold_earned: 決算で与えたXPとゴールド（列を追加する前の挑戦と引き継いだ行はNULL）
+RUN_COLUMNS = {
+    "carried_over": ("INTEGER NOT NULL DEFAULT 0",
+                     "UPDATE runs SET carried_over = 1, sells = 0, wins = 0 WHERE dungeon_id = 'legacy'"),
+    "xp_earned": ("INTEGER", None),
+    "gold_earned": ("INTEGER", None),
+}
+
+# 1シャードあたりのハッシュリング上の仮想ノード数
+VIRTUAL_NODES = 64
+# 1ステップで移動するセッション数（オンライン再分散）
+REBALANCE_BATCH = 200
+
+
+class StorageBackend(ABC):
+    """users / game_states の保存先"""
+
+    @abstractmethod
+    def init(self):
+        """テーブルなどを初期化"""
+
+    @abstractmethod
+    def get_user(self, session_id: str) -> Optional[str]:
+        """ユーザーのJSONを取得"""
+
+    @abstractmethod
+    def get_game_state(self, session_id: str) -> Optional[str]:
+        """最新のゲーム状態のJSONを取得"""
+
+    @abstractmethod
+    def write_batch(self, users: Dict[str, str], game_states: Dict[str, str],
+                    events: Optional[Dict[str, List[str]]] = None) -> List[str]:
+        """ユーザーをupsertし、イベントとゲーム状態（スナップショット）を追記する（ひとつのトランザクション）
+
+        events は session_id ごとのイベントのJSON（seq順）。イベントはスナップショットより先に書き込む。
+        同じrun_idで同じか新しいversion（seq）のスナップショットやイベントが既に保存されていれば、
+        そのセッションのイベントとスナップショットは書き込まない（古い読み込みからの上書きを防ぐ）。
+        書き込まなかったsession_idを返す。
+        """
+
+    @abstractmethod
+    def get_events(self, session_id: str, run_id: str, after_seq: int) -> List[str]:
+        """run_idのイベントのうちseqがafter_seqより大きいもののJSONをseq順に取得"""
+
+    @abstractmethod
+    def record_run(self, session_id: str, run: Dict[str, Any]):
+        """完了したダンジョン挑戦の集計を保存（同じrun_idは一度だけ）"""
+
+    @abstractmethod
+    def list_runs(self, session_id: str, limit: int) -> List[Dict[str, Any]]:
+        """完了したダンジョン挑戦を新しい順に最大limit件取得"""
+
+    def run_stats(self, session_id: str) -> Dict[str, Any]:
+        """完了したダンジョン挑戦の通算（既定の実装は全件読み込み）"""
+        totals = {"runs": 0, "trades": 0, "sells": 0, "wins": 0, "profit_loss": 0.0}
+        for run in self.list_runs(session_id, sys.maxsize):
+            totals["runs"] += 1
+            for key in ("trades", "sells", "wins", "profit_loss"):
+                totals[key] += run[key]
+        return totals
+
+    @abstractmethod
+    def delete_game_states(self, session_id: str):
+        """セッションのゲーム状態をすべて削除"""
+
+    @abstractmethod
+    def delete_session(self, session_id: str):
+        """セッションのユーザー・ゲーム状態・イベント・挑戦の履歴をすべて削除"""
+
+    @abstractmethod
+    def scan_users(self) -> Iterator[Tuple[str, str]]:
+        """全ユーザーを (session_id, JSON) で列挙"""
+
+    @abstractmethod
+    def scan_game_states(self) -> Iterator[Tuple[str, str]]:
+        """全ゲーム状態の行を (session_id, JSON) で列挙"""
+
+    def stats(self) -> Dict:
+        """件数などの統計"""
+        return {
+            "users": sum(1 for _ in self.scan_users()),
+            "game_states": sum(1 for _ in self.scan_game_states()),
+        }
+
+    def aggregate_users(self, field: Optional[str] = None, group_by: Optional[str] = None,
+                        filters: List[Tuple[str, str, Any]] = ()) -> Dict[Any, Dict[str, Any]]:
+        """ユーザーを絞り込んでグループごとに集計
+
+        filters は (列, 演算子, 値) のリスト、列は USER_COLUMNS のいずれか。
+        {グループの値: {"count", "sum", "min", "max"}} を返す（fieldを指定しなければsum以降はNone）。
+        既定の実装は全件走査（テスト用）。
+        """
+        validate_user_query(field, group_by, filters)
+        results: Dict[Any, Dict[str, Any]] = {}
+        for _, data_json in self.scan_users():
+            data = json.loads(data_json)
+            if all(data.get(column) is not None and FILTER_OPERATORS[op](data[column], value)
+                   for column, op, value in filters):
+                key = data.get(group_by) if group_by else None
+                value = data.get(field) if field else None
+                accumulate(results, key, 1, value, value, value)
+        return results
+
+    def count_sessions_by_dungeon(self) -> Dict[str, int]:
+        """ダンジョンごとのゲーム状態があるセッション数（既定の実装は全件走査）"""
+        sessions: Dict[str, set] = {}
+        for session_id, data_json in self.scan_game_states():
+            dungeon_id = json.loads(data_json).get("dungeon_id")
+            if dungeon_id is not None:
+                sessions.setdefault(dungeon_id, set()).add(session_id)
+        return {dungeon_id: len(ids) for dungeon_id, ids in sessions.items()}
+
+    # 以下はバックグラウンドメンテナンス用（maintenance.py）。既定では何もしない
+
+    def maintenance_targets(self) -> List["StorageBackend"]:
+        """メンテナンスを個別に行う単位（シャーディングならシャードごと）"""
+        return [self]
+
+    def touch_users(self, session_ids: List[str]):
+        """アクセスのあったユーザーの最終更新時刻を現在にする（期限切れ判定用）"""
+
+    def expire_sessions(self, max_age: float, limit: int) -> Tuple[int, List[str]]:
+        """最終更新からmax_age秒を過ぎたセッションを古い順に最大limit件調べて削除
+
+        (調べた件数, 削除したsession_id) を返す。調べた件数が0なら期限切れはもうない。
+        """
+        return 0, []
+
+    def compact_game_states(self, max_age: float, limit: int) -> Tuple[int, int]:
+        """ゲーム状態を前回の続きから最大limit行調べ、最新でない行を削除
+
+        max_age秒より古く、ユーザーのいないセッションの行（以前の診断の一時データなど）も削除する。
+        (調べた行数, 削除した行数) を返す。調べた行数が0なら一周した。
+        """
+        return 0, 0
+
+    def vacuum_step(self, pages: int) -> int:
+        """空きページを最大pages個ファイルから切り詰め、切り詰めたページ数を返す"""
+        return 0
+
+    def analyze(self):
+        """クエリプランナーの統計を必要な分だけ更新"""
+
+    def vacuum_full(self):
+        """ファイル全体を作り直す（オフライン用）"""
+
+    def space_stats(self) -> Dict[str, int]:
+        """ファイルサイズと空きページのバイト数"""
+        return {"bytes": 0, "free_bytes": 0}
+
+
+def validate_user_query(field: Optional[str], group_by: Optional[str], filters: List[Tuple[str, str, Any]]):
+    """集計の列と演算子が許可されたものか確認（SQLに埋め込むため）"""
+    for column in [field, group_by] + [f[0] for f in filters]:
+        if column is not None and column not in USER_COLUMNS:
+            raise ValueError(f"Unknown profile column: {column}")
+    for _, op, _ in filters:
+        if op not in FILTER_OPERATORS:
+            raise ValueError(f"Unknown operator: {op}")
+
+
+def accumulate(results: Dict[Any, Dict[str, Any]], key: Any, count: int,
+               total: Optional[float], low: Optional[float], high: Optional[float]):
+    """集計結果にひとつのグループ（または部分集計）を足し込む（NULLは無視する）"""
+    entry = results.setdefault(key, {"count": 0, "sum": None, "min": None, "max": None})
+    entry["count"] += count
+    if total is not None:
+        entry["sum"] = total if entry["sum"] is None else entry["sum"] + total
+    if low is not None:
+        entry["min"] = low if entry["min"] is None else min(entry["min"], low)
+    if high is not None:
+        entry["max"] = high if entry["max"] is None else max(entry["max"], high)
+
+
+class SQLiteBackend(StorageBackend):
+    """単一のSQLiteファイル"""
+
+    def __init__(self, path: str):
+        self.path = path
+        # compact_game_statesが次に調べる行のid
+        self._compact_cursor = 0
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def init(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        # 新しいファイルは削除で空いたページを少しずつ切り詰められるようにする
+        # （既存のファイルでは効果がないので python maintenance.py vacuum で作り直す）
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+        # usersテーブル
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT UNIQUE NOT NULL,
+                data TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # game_statesテーブル
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS game_states (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # game_eventsテーブル: トレードと日送りの追記専用ログ（seqはそのイベントを適用した後のversion）
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS game_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                run_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (run_id, seq)
+            )
+        """)
+
+        # runsテーブル: 完了したダンジョン挑戦の集計（通算成績の元データ）
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                dungeon_id TEXT NOT NULL,
+                trades INTEGER NOT NULL,
+                sells INTEGER NOT NULL,
+                wins INTEGER NOT NULL,
+                profit_loss REAL NOT NULL,
+                profit_loss_percent REAL NOT NULL,
+                finished_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # インデックスを作成
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_session_id ON users(session_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_game_states_session_id ON game_states(session_id)")
+        # 期限切れセッションを古い順に探す
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_updated_at ON users(updated_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_game_events_session_id ON game_events(session_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_runs_session_id ON runs(session_id, finished_at)")
+        # Parquetへの書き出しで前回の続きから完了順に読む
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_runs_finished_at ON runs(finished_at, run_id)")
+        conn.commit()
+
+        self.add_generated_columns(conn)
+        self.add_run_columns(conn)
+        conn.close()
+
+    def add_generated_columns(self, conn: sqlite3.Connection):
+        """JSONの生成列とそのインデックスがなければ追加（既存のファイルのオンラインマイグレーション）
+
+        VIRTUAL列の追加はスキーマの変更だけで行を書き換えない。インデックスの作成は
+        一度だけ全行を読むが、その間も読み込みは止まらない。
+        """
+        for table, columns in (("users", USER_COLUMNS), ("game_states", GAME_STATE_COLUMNS)):
+            existing = {row["name"] for row in conn.execute(f"PRAGMA table_xinfo({table})")}
+            for name, sql_type in columns.items():
+                if name in existing:
+                    continue
+                with conn:
+                    conn.execute(f"""
+                        ALTER TABLE {table} ADD COLUMN {name} {sql_type}
+                        GENERATED ALWAYS AS (json_extract(data, '$.{name}')) VIRTUAL
+                    """)
+        for name, target in GENERATED_INDEXES.items():
+            with conn:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+
+    def add_run_columns(self, conn: sqlite3.Connection):
+        """runs に後から追加した列がなければ追加し、既存の行を直す"""
+        existing = {row["name"] for row in conn.execute("PRAGMA table_info(runs)")}
+        for name, (sql_type, backfill) in RUN_COLUMNS.items():
+            if name in existing:
+                continue
+            with conn:
+                conn.execute(f"ALTER TABLE runs ADD COLUMN {name} {sql_type}")
+                if backfill:
+                    conn.execute(backfill)
+
+    def stats(self) -> Dict:
+        conn = self.connect()
+        users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        game_states = conn.execute("SELECT COUNT(*) FROM game_states").fetchone()[0]
+        game_events = conn.execute("SELECT COUNT(*) FROM game_events").fetchone()[0]
+        runs = conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+        conn.close()
+        return {"users": users, "game_states": game_states, "game_events": game_events, "runs": runs}
+
+    def aggregate_users(self, field: Optional[str] = None, group_by: Optional[str] = None,
+                        filters: List[Tuple[str, str, Any]] = ()) -> Dict[Any, Dict[str, Any]]:
+        validate_user_query(field, group_by, filters)
+        # 列名と演算子は検証済み、値はプレースホルダで渡す
+        where = " AND ".join(f"{column} {op} ?" for column, op, _ in filters) or "1"
+        key = group_by or "NULL"
+        values = f"SUM({field}), MIN({field}), MAX({field})" if field else "NULL, NULL, NULL"
+        conn = self.connect()
+        rows = conn.execute(
+            f"SELECT {key}, COUNT(*), {values} FROM users WHERE {where} GROUP BY {key}",
+            [value for _, _, value in filters]
+        ).fetchall()
+        conn.close()
+
+        results: Dict[Any, Dict[str, Any]] = {}
+        for row in rows:
+            accumulate(results, *tuple(row))
+        return results
+
+    def count_sessions_by_dungeon(self) -> Dict[str, int]:
+        conn = self.connect()
+        rows = conn.execute("""
+            SELECT dungeon_id, COUNT(DISTINCT session_id) FROM game_states
+            WHERE dungeon_id IS NOT NULL GROUP BY dungeon_id
+        """).fetchall()
+        conn.close()
+        return {row[0]: row[1] for row in rows}
+
+    def get_user(self, session_id: str) -> Optional[str]:
+        conn = self.connect()
+        row = conn.execute("SELECT data FROM users WHERE session_id = ?", (session_id,)).fetchone()
+        conn.close()
+        return row["data"] if row else None
+
+    def get_game_state(self, session_id: str) -> Optional[str]:
+        conn = self.connect()
+        # updated_atは秒単位なので、同じ秒の保存は挿入順（id）で新しいものを選ぶ
+        row = conn.execute(
+            "SELECT data FROM game_states WHERE session_id = ? ORDER BY id DESC LIMIT 1", (session_id,)
+        ).fetchone()
+        conn.close()
+        return row["data"] if row else None
+
+    def write_batch(self, users: Dict[str, str], game_states: Dict[str, str],
+                    events: Optional[Dict[str, List[str]]] = None) -> List[str]:
+        rejected = []
+        conn = self.connect()
+        with conn:
+            if events:
+                # イベントの版の確認から追記までを他のプロセスの書き込みと混ぜない
+                conn.execute("BEGIN IMMEDIATE")
+                for session_id, session_events in events.items():
+                    if not self._append_events(conn, session_id, session_events):
+                        rejected.append(session_id)
+            conn.executemany("""
+                INSERT INTO users (session_id, data, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(session_id) DO UPDATE SET
+                    data = excluded.data,
+                    updated_at = CURRENT_TIMESTAMP
+            """, list(users.items()))
+            for session_id, data in game_states.items():
+                if session_id in rejected:
+                    continue
+                # 最新の行が同じrun_idで同じか新しいversionなら書き込まない（compare-and-swap）
+                cursor = conn.execute("""
+                    INSERT INTO game_states (session_id, data, updated_at)
+                    SELECT :session_id, :data, CURRENT_TIMESTAMP
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM (
+                            SELECT data FROM game_states WHERE session_id = :session_id
+                            ORDER BY id DESC LIMIT 1
+                        ) AS latest
+                        WHERE json_extract(latest.data, '$.run_id') = json_extract(:data, '$.run_id')
+                          AND json_extract(latest.data, '$.version') >= json_extract(:data, '$.version')
+                    )
+                """, {"session_id": session_id, "data": data})
+                if cursor.rowcount == 0:
+                    rejected.append(session_id)
+        conn.close()
+        return rejected
+
+    def _append_events(self, conn: sqlite3.Connection, session_id: str, events: List[str]) -> bool:
+        """イベントを追記（既に同じか新しい版があるrunのイベントが来たらFalse）"""
+        heads: Dict[str, int] = {}
+        for data in events:
+            event = json.loads(data)
+            run_id, seq = event["run_id"], event["seq"]
+            if run_id not in heads:
+                heads[run_id] = conn.execute("""
+                    SELECT MAX(
+                        COALESCE((SELECT MAX(seq) FROM game_events WHERE run_id = :run_id), 0),
+                        COALESCE((
+                            SELECT json_extract(latest.data, '$.version') FROM (
+                                SELECT data FROM game_states WHERE session_id = :session_id
+                                ORDER BY id DESC LIMIT 1
+                            ) AS latest
+                            WHERE json_extract(latest.data, '$.run_id') = :run_id
+                        ), 0)
+                    )
+                """, {"session_id": session_id, "run_id": run_id}).fetchone()[0]
+            if seq <= heads[run_id]:
+                return False
+            conn.execute(
+                "INSERT INTO game_events (session_id, run_id, seq, data) VALUES (?, ?, ?, ?)",
+                (session_id, run_id, seq, data)
+            )
+            heads[run_id] = seq
+        return True
+
+    def get_events(self, session_id: str, run_id: str, after_seq: int) -> List[str]:
+        conn = self.connect()
+        rows = conn.execute(
+            "SELECT data FROM game_events WHERE run_id = ? AND seq > ? ORDER BY seq", (run_id, after_seq)
+        ).fetchall()
+        conn.close()
+        return [row["data"] for row in rows]
+
+    def record_run(self, session_id: str, run: Dict[str, Any]):
+        conn = self.connect()
+        with conn:
+            conn.execute(f"""
+                INSERT OR IGNORE INTO runs (session_id, {", ".join(RUN_FIELDS)})
+                VALUES (?, {", ".join("?" for _ in RUN_FIELDS)})
+            """, (session_id, *(run[key] for key in RUN_FIELDS)))
+        conn.close()
+
+    def list_runs(self, session_id: str, limit: int) -> List[Dict[str, Any]]:
+        conn = self.connect()
+        rows = conn.execute(f"""
+            SELECT {", ".join(RUN_FIELDS)}, finished_at FROM runs WHERE session_id = ?
+            ORDER BY finished_at DESC, rowid DESC LIMIT ?
+        """, (session_id, limit)).fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
+
+    def run_stats(self, session_id: str) -> Dict[str, Any]:
+        conn = self.connect()
+        row = conn.execute("""
+            SELECT COUNT(*) AS runs, COALESCE(SUM(trades), 0) AS trades, COALESCE(SUM(sells), 0) AS sells,
+                   COALESCE(SUM(wins), 0) AS wins, COALESCE(SUM(profit_loss), 0.0) AS profit_loss
+            FROM runs WHERE session_id = ?
+        """, (session_id,)).fetchone()
+        conn.close()
+        return dict(row)
+
+    def delete_game_states(self, session_id: str):
+        conn = self.connect()
+        with conn:
+            conn.execute("DELETE FROM game_states WHERE session_id = ?", (session_id,))
+        conn.close()
+
+    def delete_session(self, session_id: str):
+        conn = self.connect()
+        with conn:
+            conn.execute("DELETE FROM users WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM game_states WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM game_events WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM runs WHERE session_id = ?", (session_id,))
+        conn.close()
+
+    def scan_users(self) -> Iterator[Tuple[str, str]]:
+        conn = self.connect()
+        try:
+            for row in conn.execute("SELECT session_id, data FROM users ORDER BY id"):
+                yield row["session_id"], row["data"]
+        finally:
+            conn.close()
+
+    def scan_game_states(self) -> Iterator[Tuple[str, str]]:
+        conn = self.connect()
+        try:
+            for row in conn.execute("SELECT session_id, data FROM game_states ORDER BY id"):
+                yield row["session_id"], row["data"]
+        finally:
+            conn.close()
+
+    def touch_users(self, session_ids: List[str]):
+        conn = self.connect()
+        with conn:
+            conn.executemany(
+                "UPDATE users SET updated_at = CURRENT_TIMESTAMP WHERE session_id = ?",
+                [(session_id,) for session_id in session_ids]
+            )
+        conn.close()
+
+    def expire_sessions(self, max_age: float, limit: int) -> Tuple[int, List[str]]:
+        age = f"-{int(max_age)} seconds"
+        expired = []
+        conn = self.connect()
+        with conn:
+            rows = conn.execute("""
+                SELECT u.session_id, datetime('now', :age) AS cutoff,
+                    (SELECT g.updated_at FROM game_states g WHERE g.session_id = u.session_id
+                     ORDER BY g.id DESC LIMIT 1) AS state_updated_at
+                FROM users u
+                WHERE u.updated_at < datetime('now', :age)
+                ORDER BY u.updated_at
+                LIMIT :limit
+            """, {"age": age, "limit": limit}).fetchall()
+            for row in rows:
+                if row["state_updated_at"] and row["state_updated_at"] >= row["cutoff"]:
+                    # プロフィールは古いがプレイは続いている: 最終更新時刻を追いつかせる
+                    conn.execute("UPDATE users SET updated_at = ? WHERE session_id = ?",
+                                 (row["state_updated_at"], row["session_id"]))
+                    continue
+                for table in ("users", "game_states", "game_events", "runs"):
+                    conn.execute(f"DELETE FROM {table} WHERE session_id = ?", (row["session_id"],))
+                expired.append(row["session_id"])
+        conn.close()
+        return len(rows), expired
+
+    def compact_game_states(self, max_age: float, limit: int) -> Tuple[int, int]:
+        conn = self.connect()
+        window = conn.execute("""
+            SELECT COUNT(*) AS n, MAX(id) AS upper FROM (
+                SELECT id FROM game_states WHERE id > ? ORDER BY id LIMIT ?
+            )
+        """, (self._compact_cursor, limit)).fetchone()
+        if window["n"] == 0:
+            conn.close()
+            self._compact_cursor = 0
+            return 0, 0
+        with conn:
+            deleted = conn.execute("""
+                DELETE FROM game_states WHERE id IN (
+                    SELECT g.id FROM game_states g
+                    WHERE g.id > :lower AND g.id <= :upper AND (
+                        g.id < (SELECT MAX(id) FROM game_states WHERE session_id = g.session_id)
+                        OR (g.updated_at < datetime('now', :age)
+                            AND NOT EXISTS (SELECT 1 FROM users u WHERE u.session_id = g.session_id))
+                    )
+                )
+            """, {"lower": self._compact_cursor, "upper": window["upper"],
+                  "age": f"-{int(max_age)} seconds"}).rowcount
+        conn.close()
+        self._compact_cursor = window["upper"]
+        return window["n"], deleted
+
+    def vacuum_step(self, pages: int) -> int:
+        conn = self.connect()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # INCREMENTALでないファイルでは空きページは再利用されるだけ
+            conn.close()
+            return 0
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.close()
+        return before - after
+
+    def analyze(self):
+        conn = self.connect()
+        # 統計の更新はテーブルごとに読む行数を制限して短時間で終える
+        conn.execute("PRAGMA analysis_limit = 400")
+        conn.execute("PRAGMA optimize")
+        conn.close()
+
+    def vacuum_full(self):
+        conn = self.connect()
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.close()
+
+    def space_stats(self) -> Dict[str, int]:
+        conn = self.connect()
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.close()
+        return {"bytes": page_size * page_count, "free_bytes": page_size * freelist}
+
+    def session_ids(self, after: str = "", limit: int = REBALANCE_BATCH) -> List[str]:
+        """このファイルにデータがあるセッションIDを、afterより後からID順に最大limit件"""
+        conn = self.connect()
+        rows = conn.execute("""
+            SELECT session_id FROM (
+                SELECT session_id FROM users WHERE session_id > :after
+                UNION
+                SELECT session_id FROM game_states WHERE session_id > :after
+                UNION
+                SELECT session_id FROM game_events WHERE session_id > :after
+                UNION
+                SELECT session_id FROM runs WHERE session_id > :after
+            ) ORDER BY session_id LIMIT :limit
+        """, {"after": after, "limit": limit}).fetchall()
+        conn.close()
+        return [row["session_id"] for row in rows]
+
+    def move_session(self, session_id: str, dest: "SQLiteBackend"):
+        """セッションの全データを別のファイルに移動（行の順序を保つ）"""
+        conn = self.connect()
+        user = conn.execute(
+            "SELECT data, created_at, updated_at FROM users WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        states = conn.execute(
+            "SELECT data, created_at, updated_at FROM game_states WHERE session_id = ? ORDER BY id",
+            (session_id,)
+        ).fetchall()
+        events = conn.execute(
+            "SELECT run_id, seq, data, created_at FROM game_events WHERE session_id = ? ORDER BY id",
+            (session_id,)
+        ).fetchall()
+        runs = conn.execute(
+            f"SELECT {', '.join(RUN_FIELDS)}, finished_at FROM runs WHERE session_id = ?", (session_id,)
+        ).fetchall()
+
+        dest_conn = dest.connect()
+        with dest_conn:
+            if user:
+                # 移動先に既にある場合（移動中に書き込まれた場合）はそちらが新しい
+                dest_conn.execute("""
+                    INSERT OR IGNORE INTO users (session_id, data, created_at, updated_at)
+                    VALUES (?, ?, ?, ?)
+                """, (session_id, user["data"], user["created_at"], user["updated_at"]))
+            dest_conn.executemany("""
+                INSERT INTO game_states (session_id, data, created_at, updated_at)
+                VALUES (?, ?, ?, ?)
+            """, [(session_id, r["data"], r["created_at"], r["updated_at"]) for r in states])
+            dest_conn.executemany("""
+                INSERT OR IGNORE INTO game_events (session_id, run_id, seq, data, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, [(session_id, *tuple(r)) for r in events])
+            dest_conn.executemany(f"""
+                INSERT OR IGNORE INTO runs (session_id, {", ".join(RUN_FIELDS)}, finished_at)
+                VALUES (?, {", ".join("?" for _ in RUN_FIELDS)}, ?)
+            """, [(session_id, *tuple(r)) for r in runs])
+        dest_conn.close()
+
+        with conn:
+            for table in ("users", "game_states", "game_events", "runs"):
+                conn.execute(f"DELETE FROM {table} WHERE session_id = ?", (session_id,))
+        conn.close()
+
+
+class HashRing:
+    """仮想ノード付きのコンシステントハッシュリング"""
+
+    def __init__(self, n_shards: int, virtual_nodes: int = VIRTUAL_NODES):
+        self.n_shards = n_shards
+        points = []
+        for shard in range(n_shards):
+            for v in range(virtual_nodes):
+                points.append((_hash(f"shard-{shard}#{v}"), shard))
+        points.sort()
+        self._keys = [p[0] for p in points]
+        self._shards = [p[1] for p in points]
+
+    def shard_for(self, session_id: str) -> int:
+        index = bisect.bisect(self._keys, _hash(session_id)) % len(self._keys)
+        return self._shards[index]
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class ShardedSQLiteBackend(StorageBackend):
+    """session_idのコンシステントハッシュで複数のSQLiteファイルに分散
+
+    シャード数を変えると、新しいリングで持ち主が変わるセッションだけを移動する。
+    移動はrebalance_step()で少しずつ行い、その間も読み書きできる:
+    読み込みは新しい持ち主→古い持ち主の順に探し、書き込みの前にはそのセッションを先に移動する。
+    rebalance_step()は別スレッドから呼ばれるので、セッションの移動と移動中のセッションの読み込みは
+    ロックで直列化する。
+    """
+
+    def __init__(self, directory: str, n_shards: int):
+        self.directory = directory
+        self.meta_path = os.path.join(directory, "shards.json")
+        self.ring = HashRing(n_shards)
+        self.previous_ring: Optional[HashRing] = None
+        self.shards: Dict[int, SQLiteBackend] = {}
+        # 再分散の進み具合（シャードごとに、確認し終えた最後のsession_id。走査し終えたシャードはNone）
+        self.rebalance_cursor: Dict[int, Optional[str]] = {}
+        self.rebalance_moved = 0
+        self._move_lock = threading.RLock()
+
+    def _shard(self, index: int) -> SQLiteBackend:
+        if index not in self.shards:
+            backend = SQLiteBackend(os.path.join(self.directory, f"game-{index}.db"))
+            backend.init()
+            self.shards[index] = backend
+        return self.shards[index]
+
+    def _load_meta(self) -> Dict:
+        if not os.path.exists(self.meta_path):
+            return {}
+        with open(self.meta_path) as f:
+            return json.load(f)
+
+    def _save_meta(self):
+        meta = {"shards": self.ring.n_shards}
+        if self.previous_ring:
+            meta["previous_shards"] = self.previous_ring.n_shards
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def init(self):
+        os.makedirs(self.directory, exist_ok=True)
+        meta = self._load_meta()
+        # 前回と異なるシャード数、または中断した再分散があれば再分散を開始
+        previous = meta.get("previous_shards", meta.get("shards"))
+        if previous and previous != self.ring.n_shards:
+            self.previous_ring = HashRing(previous)
+        for index in range(self.ring.n_shards):
+            self._shard(index)
+        self._save_meta()
+
+    def owner(self, session_id: str) -> SQLiteBackend:
+        return self._shard(self.ring.shard_for(session_id))
+
+    def _previous_owner(self, session_id: str) -> Optional[SQLiteBackend]:
+        if not self.previous_ring:
+            return None
+        index = self.previous_ring.shard_for(session_id)
+        if index == self.ring.shard_for(session_id):
+            return None
+        return self._shard(index)
+
+    def _migrate(self, session_id: str):
+        """再分散中なら、書き込みの前にセッションを新しい持ち主へ移動"""
+        previous = self._previous_owner(session_id)
+        if previous:
+            with self._move_lock:
+                previous.move_session(session_id, self.owner(session_id))
+
+    def _read(self, session_id: str, read: Callable[[SQLiteBackend], Any]) -> Any:
+        """新しい持ち主→古い持ち主の順に読む（移動中のセッションは移動と重ならないようにする）"""
+        previous = self._previous_owner(session_id)
+        if not previous:
+            return read(self.owner(session_id))
+        with self._move_lock:
+            return read(self.owner(session_id)) or read(previous)
+
+    def get_user(self, session_id: str) -> Optional[str]:
+        return self._read(session_id, lambda shard: shard.get_user(session_id))
+
+    def get_game_state(self, session_id: str) -> Optional[str]:
+        return self._read(session_id, lambda shard: shard.get_game_state(session_id))
+
+    def write_batch(self, users: Dict[str, str], game_states: Dict[str, str],
+                    events: Optional[Dict[str, List[str]]] = None) -> List[str]:
+        # シャードごとにまとめて、それぞれひとつのトランザクションで書き込む
+        batches: Dict[int, Tuple[Dict[str, str], Dict[str, str], Dict[str, List[str]]]] = {}
+        for position, records in enumerate((users, game_states, events or {})):
+            for session_id, data in records.items():
+                self._migrate(session_id)
+                batches.setdefault(self.ring.shard_for(session_id), ({}, {}, {}))[position][session_id] = data
+        rejected = []
+        for index, (shard_users, shard_states, shard_events) in batches.items():
+            rejected.extend(self._shard(index).write_batch(shard_users, shard_states, shard_events))
+        return rejected
+
+    def get_events(self, session_id: str, run_id: str, after_seq: int) -> List[str]:
+        return self._read(session_id, lambda shard: shard.get_events(session_id, run_id, after_seq))
+
+    def record_run(self, session_id: str, run: Dict[str, Any]):
+        self._migrate(session_id)
+        self.owner(session_id).record_run(session_id, run)
+
+    def list_runs(self, session_id: str, limit: int) -> List[Dict[str, Any]]:
+        self._migrate(session_id)
+        return self.owner(session_id).list_runs(session_id, limit)
+
+    def run_stats(self, session_id: str) -> Dict[str, Any]:
+        self._migrate(session_id)
+        return self.owner(session_id).run_stats(session_id)
+
+    def delete_game_states(self, session_id: str):
+        self._migrate(session_id)
+        self.owner(session_id).delete_game_states(session_id)
+
+    def delete_session(self, session_id: str):
+        self._migrate(session_id)
+        self.owner(session_id).delete_session(session_id)
+
+    def aggregate_users(self, field: Optional[str] = None, group_by: Optional[str] = None,
+                        filters: List[Tuple[str, str, Any]] = ()) -> Dict[Any, Dict[str, Any]]:
+        # シャードごとの部分集計を合算する
+        results: Dict[Any, Dict[str, Any]] = {}
+        for index in self._existing_shard_indexes():
+            for key, entry in self._shard(index).aggregate_users(field, group_by, filters).items():
+                accumulate(results, key, entry["count"], entry["sum"], entry["min"], entry["max"])
+        return results
+
+    def count_sessions_by_dungeon(self) -> Dict[str, int]:
+        # セッションは（移動中の一瞬を除き）どれかひとつのシャードにだけある
+        counts: Dict[str, int] = {}
+        for index in self._existing_shard_indexes():
+            for dungeon_id, count in self._shard(index).count_sessions_by_dungeon().items():
+                counts[dungeon_id] = counts.get(dungeon_id, 0) + count
+        return counts
+
+    def maintenance_targets(self) -> List[StorageBackend]:
+        return [self._shard(index) for index in self._existing_shard_indexes()]
+
+    def touch_users(self, session_ids: List[str]):
+        batches: Dict[int, List[str]] = {}
+        for session_id in session_ids:
+            self._migrate(session_id)
+            batches.setdefault(self.ring.shard_for(session_id), []).append(session_id)
+        for index, shard_ids in batches.items():
+            self._shard(index).touch_users(shard_ids)
+
+    def scan_users(self) -> Iterator[Tuple[str, str]]:
+        for index in sorted(self.shards):
+            yield from self.shards[index].scan_users()
+
+    def scan_game_states(self) -> Iterator[Tuple[str, str]]:
+        for index in sorted(self.shards):
+            yield from self.shards[index].scan_game_states()
+
+    def _existing_shard_indexes(self) -> List[int]:
+        """ディレクトリにあるシャードファイルの番号（縮小後の旧シャードを含む）"""
+        indexes = set(self.shards)
+        for name in os.listdir(self.directory):
+            if name.startswith("game-") and name.endswith(".db"):
+                indexes.add(int(name[len("game-"):-len(".db")]))
+        return sorted(indexes)
+
+    def start_rebalance(self, n_shards: int):
+        """シャード数を変更し、オンライン再分散を開始"""
+        if n_shards == self.ring.n_shards:
+            return
+        self.previous_ring = self.ring
+        self.ring = HashRing(n_shards)
+        self.rebalance_cursor = {}
+        self.rebalance_moved = 0
+        for index in range(n_shards):
+            self._shard(index)
+        self._save_meta()
+
+    def rebalance_step(self, limit: int = REBALANCE_BATCH) -> int:
+        """各シャードの続きから最大limit件のセッションを確認し、持ち主が変わったものを移動する
+
+        確認したセッションの件数を返し、0を返したら再分散は完了。
+        シャードごとにsession_id順のカーソルで進むので、全体でも各セッションを1回ずつ確認するだけで済む
+        （再分散中に増えるセッションは新しい持ち主に書き込まれるため、確認済みの範囲に移動対象は増えない）。
+        """
+        checked = 0
+        for index in self._existing_shard_indexes():
+            after = self.rebalance_cursor.get(index, "")
+            if after is None:
+                continue
+            shard = self._shard(index)
+            batch = limit - checked
+            session_ids = shard.session_ids(after, batch)
+            for session_id in session_ids:
+                owner = self.ring.shard_for(session_id)
+                if owner != index:
+                    with self._move_lock:
+                        shard.move_session(session_id, self._shard(owner))
+                    self.rebalance_moved += 1
+            checked += len(session_ids)
+            self.rebalance_cursor[index] = session_ids[-1] if len(session_ids) == batch else None
+            if checked >= limit:
+                return checked
+
+        if checked == 0 and self.previous_ring:
+            self.previous_ring = None
+            self._save_meta()
+        return checked
+
+    def rebalancing(self) -> bool:
+        return self.previous_ring is not None
+
+    def stats(self) -> Dict:
+        per_shard = {}
+        for index in self._existing_shard_indexes():
+            per_shard[index] = self._shard(index).stats()
+        return {
+            "shards": self.ring.n_shards,
+            "rebalancing": self.rebalancing(),
+            "per_shard": per_shard,
+            "users": sum(s["users"] for s in per_shard.values()),
+            "game_states": sum(s["game_states"] for s in per_shard.values()),
+            "game_events": sum(s["game_events"] for s in per_shard.values()),
+            "runs": sum(s["runs"] for s in per_shard.values()),
+        }
+
+
+class MemoryBackend(StorageBackend):
+    """テスト用のインメモリ実装"""
+
+    def __init__(self):
+        self.users: Dict[str, str] = {}
+        self.game_states: List[Tuple[str, str]] = []
+        # (session_id, run_id, seq, JSON)
+        self.game_events: List[Tuple[str, str, int, str]] = []
+        # session_idごとの完了した挑戦（古い順）
+        self.runs: Dict[str, List[Dict[str, Any]]] = {}
+        # session_idごとの最終更新時刻（UNIX時間）
+        self.updated_at: Dict[str, float] = {}
+        self._compact_cursor = 0
+
+    def init(self):
+        pass
+
+    def get_user(self, session_id: str) -> Optional[str]:
+        return self.users.get(session_id)
+
+    def get_game_state(self, session_id: str) -> Optional[str]:
+        for sid, data in reversed(self.game_states):
+            if sid == session_id:
+                return data
+        return None
+
+    def write_batch(self, users: Dict[str, str], game_states: Dict[str, str],
+                    events: Optional[Dict[str, List[str]]] = None) -> List[str]:
+        rejected = []
+        now = time.time()
+        for session_id, session_events in (events or {}).items():
+            if not self._append_events(session_id, session_events):
+                rejected.append(session_id)
+        self.users.update(users)
+        self.updated_at.update((session_id, now) for session_id in users)
+        for session_id, data in game_states.items():
+            if session_id in rejected:
+                continue
+            latest = self.get_game_state(session_id)
+            if latest is not None:
+                old, new = json.loads(latest), json.loads(data)
+                if old.get("run_id") is not None and old.get("run_id") == new.get("run_id") \
+                        and old.get("version", 0) >= new.get("version", 0):
+                    rejected.append(session_id)
+                    continue
+            self.game_states.append((session_id, data))
+            self.updated_at[session_id] = now
+        return rejected
+
+    def _append_events(self, session_id: str, events: List[str]) -> bool:
+        latest = self.get_game_state(session_id)
+        snapshot = json.loads(latest) if latest else {}
+        for data in events:
+            event = json.loads(data)
+            head = max([seq for _, run_id, seq, _ in self.game_events if run_id == event["run_id"]], default=0)
+            if snapshot.get("run_id") == event["run_id"]:
+                head = max(head, snapshot.get("version", 0))
+            if event["seq"] <= head:
+                return False
+            self.game_events.append((session_id, event["run_id"], event["seq"], data))
+        return True
+
+    def get_events(self, session_id: str, run_id: str, after_seq: int) -> List[str]:
+        events = [(seq, data) for _, rid, seq, data in self.game_events if rid == run_id and seq > after_seq]
+        return [data for _, data in sorted(events)]
+
+    def record_run(self, session_id: str, run: Dict[str, Any]):
+        runs = self.runs.setdefault(session_id, [])
+        if all(existing["run_id"] != run["run_id"] for existing in runs):
+            runs.append({**{key: run[key] for key in RUN_FIELDS}, "finished_at": time.strftime("%Y-%m-%d %H:%M:%S")})
+
+    def list_runs(self, session_id: str, limit: int) -> List[Dict[str, Any]]:
+        return list(reversed(self.runs.get(session_id, [])))[:limit]
+
+    def delete_game_states(self, session_id: str):
+        self.game_states = [(sid, data) for sid, data in self.game_states if sid != session_id]
+
+    def delete_session(self, session_id: str):
+        self.users.pop(session_id, None)
+        self.updated_at.pop(session_id, None)
+        self.delete_game_states(session_id)
+        self.game_events = [row for row in self.game_events if row[0] != session_id]
+        self.runs.pop(session_id, None)
+
+    def touch_users(self, session_ids: List[str]):
+        now = time.time()
+        for session_id in session_ids:
+            if session_id in self.users:
+                self.updated_at[session_id] = now
+
+    def expire_sessions(self, max_age: float, limit: int) -> Tuple[int, List[str]]:
+        cutoff = time.time() - max_age
+        expired = [sid for sid, updated in self.updated_at.items() if updated < cutoff][:limit]
+        for session_id in expired:
+            self.delete_session(session_id)
+        return len(expired), expired
+
+    def compact_game_states(self, max_age: float, limit: int) -> Tuple[int, int]:
+        start = self._compact_cursor
+        if start >= len(self.game_states):
+            self._compact_cursor = 0
+            return 0, 0
+        end = min(start + limit, len(self.game_states))
+        latest = {sid: i for i, (sid, _) in enumerate(self.game_states)}
+        kept = [row for i, row in enumerate(self.game_states)
+                if not start <= i < end or latest[row[0]] == i]
+        deleted = len(self.game_states) - len(kept)
+        self.game_states = kept
+        self._compact_cursor = end - deleted
+        return end - start, deleted
+
+    def scan_users(self) -> Iterator[Tuple[str, str]]:
+        yield from list(self.users.items())
+
+    def scan_game_states(self) -> Iterator[Tuple[str, str]]:
+        yield from list(self.game_states)
+
+
+if __name__ == "__main__":
+    # 使い方:
+    #   python storage.py stats <dir>                シャードごとの件数を表示
+    #   python storage.py rebalance <dir> <shards>   シャード数を変更して再分散
+    if len(sys.argv) < 3 or sys.argv[1] not in ("stats", "rebalance"):
+        print("usage: python storage.py stats <dir> | rebalance <dir> <shards>")
+        sys.exit(1)
+
+    directory = sys.argv[2]
+    with open(os.path.join(directory, "shards.json")) as f:
+        current = json.load(f)["shards"]
+    backend = ShardedSQLiteBackend(directory, current)
+    backend.init()
+
+    if sys.argv[1] == "stats":
+        print(json.dumps(backend.stats(), indent=2))
+    else:
+        n_shards = int(sys.argv[3])
+        backend.start_rebalance(n_shards)
+        while backend.rebalance_step():
+            pass
+        print(f"Moved {backend.rebalance_moved} sessions to {n_shards} shards")
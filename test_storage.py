@@ -0,0 +1,147 @@
+"""ストレージバックエンドの共通シナリオ（MemoryBackend / SQLiteBackend / ShardedSQLiteBackend）
+
+同じ操作を各バックエンドに行い、結果がそろうことを確かめる。シャーディングは途中でシャード数を
+変えてオンライン再分散を進め、再分散の前・途中・後で読み書きしても失われないことを確かめる。
+
+使い方:
+    python -m pytest -q test_storage.py
+"""
+import json
+import os
+
+import pytest
+
+from storage import MemoryBackend, RUN_FIELDS, ShardedSQLiteBackend, SQLiteBackend
+
+SESSIONS = 600
+
+
+def _state(run_id: str, version: int) -> str:
+    return json.dumps({"run_id": run_id, "version": version, "current_day": version})
+
+
+def _event(run_id: str, seq: int) -> str:
+    return json.dumps({"type": "advance", "run_id": run_id, "seq": seq, "day": seq - 1})
+
+
+def _run(run_id: str, trades: int) -> dict:
+    run = dict.fromkeys(RUN_FIELDS)
+    run.update(run_id=run_id, dungeon_id="tutorial-1", trades=trades, sells=trades // 2, wins=1,
+               profit_loss=10.0, profit_loss_percent=0.1, carried_over=0, xp_earned=100, gold_earned=500)
+    return run
+
+
+def _session(i: int) -> str:
+    return f"session-{i:04d}"
+
+
+def _make_backend(kind: str, directory: str):
+    if kind == "memory":
+        backend = MemoryBackend()
+    elif kind == "sqlite":
+        backend = SQLiteBackend(os.path.join(directory, "game.db"))
+    else:
+        backend = ShardedSQLiteBackend(os.path.join(directory, "shards"), 2)
+    backend.init()
+    return backend
+
+
+def _snapshot(backend, session_ids) -> dict:
+    """セッションごとの読める内容（比較用）"""
+    result = {}
+    for session_id in session_ids:
+        runs = backend.list_runs(session_id, 10)
+        result[session_id] = {
+            "user": backend.get_user(session_id),
+            "state": backend.get_game_state(session_id),
+            "events": backend.get_events(session_id, f"run-{session_id}", 0),
+            "runs": [{key: run[key] for key in RUN_FIELDS} for run in runs],
+            "stats": backend.run_stats(session_id),
+        }
+    return result
+
+
+def scenario(backend, rebalance_to: int = 0) -> dict:
+    """全バックエンドで同じ操作を行い、読める内容を返す"""
+    session_ids = [_session(i) for i in range(SESSIONS)]
+    users = {session_id: json.dumps({"player_class": "hero", "level": 1}) for session_id in session_ids}
+    states = {session_id: _state(f"run-{session_id}", 1) for session_id in session_ids}
+    assert backend.write_batch(users, states) == []
+
+    # イベントの追記（スナップショットの版より後ろから）
+    events = {session_id: [_event(f"run-{session_id}", 2), _event(f"run-{session_id}", 3)]
+              for session_id in session_ids}
+    assert backend.write_batch({}, {}, events) == []
+
+    if rebalance_to:
+        # 再分散を始めて1ステップだけ進め、移動中のまま読み書きする
+        backend.start_rebalance(rebalance_to)
+        assert backend.rebalancing()
+        assert backend.rebalance_step(limit=50) > 0
+
+    # 古い版のスナップショットと、既にあるseqのイベントは捨てられる
+    stale = _session(1)
+    assert backend.write_batch({}, {stale: _state(f"run-{stale}", 1)}) == [stale]
+    conflict = _session(2)
+    assert backend.write_batch({}, {}, {conflict: [_event(f"run-{conflict}", 3)]}) == [conflict]
+    # 新しい版は書き込める
+    fresh = _session(3)
+    assert backend.write_batch({}, {fresh: _state(f"run-{fresh}", 4)}, {fresh: [_event(f"run-{fresh}", 4)]}) == []
+
+    assert backend.get_events(stale, f"run-{stale}", 2) == [_event(f"run-{stale}", 3)]
+
+    # 挑戦の記録は run_id ごとに一度だけ
+    for i, session_id in enumerate(session_ids[:100]):
+        backend.record_run(session_id, _run(f"done-{session_id}", i % 7))
+        backend.record_run(session_id, _run(f"done-{session_id}", i % 7))
+    backend.record_run(_session(0), _run("second", 4))
+
+    if rebalance_to:
+        while backend.rebalance_step():
+            pass
+        assert not backend.rebalancing()
+
+    # 削除したセッションは何も読めない
+    deleted = _session(5)
+    backend.delete_session(deleted)
+    assert backend.get_user(deleted) is None
+    assert backend.get_game_state(deleted) is None
+    assert backend.get_events(deleted, f"run-{deleted}", 0) == []
+    assert backend.list_runs(deleted, 10) == []
+    assert backend.run_stats(deleted)["runs"] == 0
+
+    return _snapshot(backend, session_ids)
+
+
+@pytest.fixture(scope="module")
+def expected(tmp_path_factory):
+    return scenario(_make_backend("memory", str(tmp_path_factory.mktemp("memory"))))
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite", "sharded"])
+def test_backends_agree(kind, tmp_path, expected):
+    assert scenario(_make_backend(kind, str(tmp_path))) == expected
+
+
+def test_stats_after_scenario(expected):
+    stats = expected[_session(0)]["stats"]
+    assert stats["runs"] == 2 and stats["trades"] == 4 and stats["sells"] == 2
+    assert json.loads(expected[_session(3)]["state"])["version"] == 4
+    assert len(expected[_session(2)]["events"]) == 2
+    assert expected[_session(5)]["user"] is None
+
+
+def test_online_rebalance_moves_sessions_without_losing_any(tmp_path):
+    backend = _make_backend("sharded", str(tmp_path))
+    expected = scenario(_make_backend("memory", str(tmp_path)))
+    assert scenario(backend, rebalance_to=5) == expected
+    assert backend.rebalance_moved > 0
+
+    # どのセッションも新しい持ち主のシャードにだけある
+    owners = {}
+    for index, shard in backend.shards.items():
+        for session_id in shard.session_ids(limit=SESSIONS * 2):
+            assert session_id not in owners, f"{session_id} is on shards {owners[session_id]} and {index}"
+            owners[session_id] = index
+    assert len(owners) == SESSIONS - 1
+    assert all(backend.ring.shard_for(session_id) == index for session_id, index in owners.items())
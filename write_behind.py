@@ -0,0 +1,228 @@
+"""ゲーム状態・プロフィール保存のwrite-behindキュー
+
+クリックごとにSQLiteのトランザクションをコミットする代わりに、更新されたレコードを
+メモリに溜めておき、一定間隔または一定件数ごとにひとつのトランザクションでまとめて
+書き込む（グループコミット）。同じセッションの未書き込みの更新は最新のものだけが残る。
+トレードや日送りのイベントは追記専用なので、まとめずに順番どおりすべて書き込む。
+
+読み込み側はまずこのキューを参照するので、自分の書き込みはすぐに読める。
+版つきのゲーム状態・イベントを書いたリクエストは commit() で結果を待つ: GROUP_COMMIT_DELAY の間に
+来た他のリクエストの更新とまとめてコミットし、古い版として捨てられたかどうかを応答の前に返す。
+イベントループのスレッドからのみ使う想定のため、ロックは持たない。
+"""
+import asyncio
+from typing import Callable, Dict, List, Optional, Set
+
+WriteBatch = Callable[[Dict[str, str], Dict[str, str], Dict[str, List[str]]], List[str]]
+
+# この件数の未書き込みレコードが溜まったら即座に書き込む
+FLUSH_MAX_PENDING = 256
+# 定期書き込みの間隔（秒）
+FLUSH_INTERVAL = 0.5
+# commit() で結果を待つ書き込みを、この時間（秒）だけ待って同時に来たものとまとめてコミットする
+GROUP_COMMIT_DELAY = 0.002
+
+
+class WriteBehindQueue:
+    """ユーザー・ゲーム状態・イベントの未書き込みJSONを保持し、まとめて書き込む"""
+
+    def __init__(self, write_batch: WriteBatch, max_pending: int = FLUSH_MAX_PENDING,
+                 flush_interval: float = FLUSH_INTERVAL, group_commit_delay: float = GROUP_COMMIT_DELAY):
+        self.write_batch = write_batch
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.group_commit_delay = group_commit_delay
+        # 次の書き込みの結果（捨てたsession_idの集合）を待っているリクエストに渡すFuture
+        self._waiters: Optional[asyncio.Future] = None
+        self._users: Dict[str, str] = {}
+        self._game_states: Dict[str, str] = {}
+        self._events: Dict[str, List[str]] = {}
+        self._event_count = 0
+        self.metrics = {
+            "writes": 0,     # 保存要求の数
+            "coalesced": 0,  # 書き込み前に上書きされた保存要求の数
+            "commits": 0,    # 実際にコミットしたトランザクション数
+            "rows": 0,       # 書き込んだレコード数
+            "events": 0,     # 追記したイベントの数
+            "conflicts": 0,  # 他のリクエストが先に新しい版を書き込んでいたため捨てたセッションの数
+            "waits": 0,      # commit() で結果を待った書き込みの数
+        }
+        # 直前の書き込みで捨てられた（イベントとゲーム状態の）session_id
+        self.last_rejected: Set[str] = set()
+
+    def pending(self) -> int:
+        return len(self._users) + len(self._game_states) + self._event_count
+
+    def put_user(self, session_id: str, data_json: str):
+        self._put(self._users, session_id, data_json)
+
+    def put_game_state(self, session_id: str, data_json: str):
+        self._put(self._game_states, session_id, data_json)
+
+    def put_event(self, session_id: str, event_json: str):
+        """イベントを追記（上書きされない）"""
+        self.metrics["writes"] += 1
+        self._events.setdefault(session_id, []).append(event_json)
+        self._event_count += 1
+        if self.pending() >= self.max_pending:
+            self.flush()
+
+    def _put(self, buffer: Dict[str, str], session_id: str, data_json: str):
+        self.metrics["writes"] += 1
+        if session_id in buffer:
+            self.metrics["coalesced"] += 1
+        buffer[session_id] = data_json
+        if self.pending() >= self.max_pending:
+            self.flush()
+
+    def get_user(self, session_id: str) -> Optional[str]:
+        return self._users.get(session_id)
+
+    def get_game_state(self, session_id: str) -> Optional[str]:
+        return self._game_states.get(session_id)
+
+    def get_events(self, session_id: str) -> List[str]:
+        return self._events.get(session_id, [])
+
+    def discard_user(self, session_id: str):
+        self._users.pop(session_id, None)
+
+    def discard_game_state(self, session_id: str):
+        self._game_states.pop(session_id, None)
+
+    def discard_events(self, session_id: str):
+        self._event_count -= len(self._events.pop(session_id, []))
+
+    def is_pending(self, session_id: str) -> bool:
+        return session_id in self._game_states or session_id in self._events or session_id in self._users
+
+    def flush(self) -> int:
+        """溜まっている更新をひとつのトランザクションで書き込む"""
+        # 待っているリクエストの更新はすべてこの書き込みに含まれる
+        waiters, self._waiters = self._waiters, None
+        if not self.pending():
+            self.last_rejected = set()
+            if waiters:
+                waiters.set_result(self.last_rejected)
+            return 0
+        users, game_states, events = self._users, self._game_states, self._events
+        event_count = self._event_count
+        self._users, self._game_states, self._events = {}, {}, {}
+        self._event_count = 0
+        try:
+            rejected = self.write_batch(users, game_states, events) or []
+        except Exception as e:
+            # 書き込みに失敗したら、その間の新しい更新を優先して戻す（イベントは古い順に並べ直す）
+            self._users = {**users, **self._users}
+            self._game_states = {**game_states, **self._game_states}
+            for session_id, session_events in events.items():
+                self._events[session_id] = session_events + self._events.get(session_id, [])
+            self._event_count += event_count
+            if waiters:
+                waiters.set_exception(e)
+            raise
+        self.last_rejected = set(rejected)
+        if waiters:
+            waiters.set_result(self.last_rejected)
+        rows = len(users) + len(game_states) + event_count - len(rejected)
+        self.metrics["events"] += event_count
+        self.metrics["conflicts"] += len(rejected)
+        self.metrics["commits"] += 1
+        self.metrics["rows"] += rows
+        return rows
+
+    async def commit(self, session_id: str) -> bool:
+        """session_idの未書き込みの更新がコミットされるのを待ち、古い版として捨てられたらFalseを返す
+
+        最初に待ち始めたリクエストがGROUP_COMMIT_DELAY後の書き込みを予約し、それまでに来た
+        他のリクエストの更新も同じトランザクションでコミットする（定期書き込みが先に来ればそれを待つ）。
+        """
+        if not self.is_pending(session_id):
+            # 追記と同時に件数の上限で書き込まれた（またはsyncモードで書き込み済み）
+            return session_id not in self.last_rejected
+        self.metrics["waits"] += 1
+        if self._waiters is None:
+            loop = asyncio.get_running_loop()
+            self._waiters = loop.create_future()
+            loop.call_later(self.group_commit_delay, self._flush_waiters, self._waiters)
+        rejected = await asyncio.shield(self._waiters)
+        return session_id not in rejected
+
+    def _flush_waiters(self, waiters: asyncio.Future):
+        if self._waiters is not waiters:
+            return  # 定期書き込みや件数の上限で書き込み済み
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error flushing write-behind queue: {e}")
+
+    async def run(self):
+        """一定間隔で書き込み続ける（アプリ起動中のバックグラウンドタスク）"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing write-behind queue: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.metrics, "pending": self.pending()}
+
+
+if __name__ == "__main__":
+    # 負荷シナリオ: 多数のプレイヤーが同時に「次の日へ」とトレードを繰り返す
+    # 使い方: python write_behind.py [players] [clicks]
+    import os
+    import sys
+    import tempfile
+    import time
+
+    import database
+    from models import GameState, apply_event
+
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    clicks = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    bar = {"date": "2020-01-01", "open": 23000.0, "high": 23100.0, "low": 22900.0,
+           "close": 23050.0, "volume": 100000, "sma_25": 23010.5, "sma_75": 22950.1,
+           "rsi_14": 55.2, "macd": 12.3, "macd_signal": 10.1, "macd_hist": 2.2,
+           "bb_upper": 23500.0, "bb_middle": 23000.0, "bb_lower": 22500.0}
+    stock_data = [dict(bar) for _ in range(128)]
+
+    def run_scenario(durability: str, events: bool = False):
+        database.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+        database.WRITE_DURABILITY = durability
+        database.write_queue = WriteBehindQueue(database.write_batch)
+        database.init_db()
+
+        states = {f"player-{i}": GameState(dungeon_id="castle-1", total_days=128, stock_data=stock_data)
+                  for i in range(players)}
+        started = time.perf_counter()
+        # 各プレイヤーが書き込み間隔ごとに1回クリックする想定
+        for day in range(clicks):
+            for session_id, state in states.items():
+                if events:
+                    # 日送りをイベントとして追記（スナップショットはSNAPSHOT_INTERVALごと）
+                    event = {"type": "advance", "day": state.current_day}
+                    apply_event(state, event)
+                    database.append_event(session_id, state, event)
+                else:
+                    state.current_day = day
+                    database.save_game_state(session_id, state)
+            database.write_queue.flush()
+        elapsed = time.perf_counter() - started
+
+        total = players * clicks
+        commits = database.write_queue.metrics["commits"]
+        size = os.path.getsize(database.DB_PATH)
+        label = f"{durability}+events" if events else durability
+        print(f"{label:15s} clicks={total} commits={commits} db={size / 1e6:.1f}MB "
+              f"elapsed={elapsed:.2f}s throughput={total / elapsed:,.0f} clicks/s")
+        return commits, total / elapsed
+
+    sync_commits, sync_rate = run_scenario("sync")
+    batched_commits, batched_rate = run_scenario("batched")
+    _, events_rate = run_scenario("batched", events=True)
+    print(f"commit reduction: {sync_commits / max(batched_commits, 1):.0f}x, "
+          f"throughput gain: {batched_rate / sync_rate:.1f}x, "
+          f"with event log: {events_rate / sync_rate:.1f}x")